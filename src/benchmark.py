@@ -0,0 +1,326 @@
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from .metadata import catalog_row, to_catalog_netcdf
+from .pyramid_builder import build_pyramid, gen_pyramid_levels
+from .query_executor_find_area import FindAreaExecutor
+from .query_executor_find_time import FindTimeExecutor
+from .query_executor_get_raster import GetRasterExecutor
+from .query_executor_heatmap import HeatmapExecutor
+from .query_executor_timeseries import TimeseriesExecutor
+from .utils.cds_downloader import cds_downloader
+from .utils.const import long_short_name_dict
+from .utils.dataset_pool import dataset_pool
+from .utils.raster_cache import raster_cache
+from .utils.tracing import read_bytes, tracer
+
+EXECUTORS = {
+    "get_raster": GetRasterExecutor,
+    "timeseries": TimeseriesExecutor,
+    "heatmap": HeatmapExecutor,
+    "find_time": FindTimeExecutor,
+    "find_area": FindAreaExecutor,
+}
+# side of the query bbox in degrees, centered in the synthetic extent; None for the whole extent
+BBOX_SIZES = {"small": 2, "medium": 8, "large": None}
+TIME_SPANS = ("week", "month", "year", "all", "unaligned")
+DEFAULT_PREDICATES = ((">", 265.0), ("<", 250.0))
+
+
+def gen_synthetic_year(variable, year, min_lat, max_lat, min_lon, max_lon, seed=0):
+    """
+    Return: ERA5-like hourly 0.25 degree raster of one year, a seasonal and diurnal cycle colder towards the pole
+    with reproducible noise
+    """
+    latitude = np.arange(max_lat, min_lat - 0.125, -0.25)
+    longitude = np.arange(min_lon, max_lon + 0.125, 0.25)
+    valid_time = pd.date_range(f"{year}-01-01 00:00", f"{year}-12-31 23:00", freq="h")
+    season = 15 * np.sin(2 * np.pi * (valid_time.dayofyear.values / 366 - 0.3))
+    diurnal = 3 * np.sin(2 * np.pi * valid_time.hour.values / 24)
+    values = (
+        (270 + season + diurnal)[:, None, None]
+        - 0.6 * (latitude - min_lat)[None, :, None]
+        + 0.05 * (longitude - min_lon)[None, None, :]
+    ).astype("float32")
+    rng = np.random.default_rng([seed, year])
+    values += rng.normal(0, 2, values.shape).astype("float32")
+    return xr.Dataset(
+        data_vars={long_short_name_dict[variable]: (["valid_time", "latitude", "longitude"], values)},
+        coords=dict(valid_time=valid_time, latitude=latitude, longitude=longitude),
+    )
+
+
+def gen_synthetic_catalog(
+    output_dir,
+    years=(2020, 2021),
+    extent=(70, 80, -40, -20),  # min_lat, max_lat, min_lon, max_lon on the 0.25 grid
+    variable="2m_temperature",
+    temporal_resolutions=("day", "month", "year"),  # pyramid levels built, () for raw hourly files only
+    spatial_resolutions=(0.25, 0.5, 1.0),
+    tile_size=None,
+    seed=0,
+):
+    """
+    Write one raw hourly file per year and its pyramid under output_dir.
+    Return: path of the catalog file
+    """
+    min_lat, max_lat, min_lon, max_lon = extent
+    raw_dir = os.path.join(output_dir, "raw")
+    os.makedirs(raw_dir, exist_ok=True)
+    rows = []
+    for year in years:
+        ds = gen_synthetic_year(variable, year, min_lat, max_lat, min_lon, max_lon, seed)
+        file_path = os.path.join(raw_dir, f"{variable}-{year}.nc")
+        print("synthetic:", file_path)
+        to_catalog_netcdf(ds, file_path)
+        valid_time = ds.indexes["valid_time"]
+        rows.append(catalog_row(ds, variable, valid_time[0], valid_time[-1], "hour", None, 0.25, None, file_path))
+    metadata_path = os.path.join(output_dir, "metadata.csv")
+    pd.DataFrame(rows).to_csv(metadata_path, index=False)
+    levels = gen_pyramid_levels(
+        temporal_resolutions=("hour",) + tuple(temporal_resolutions), spatial_resolutions=spatial_resolutions
+    )
+    if levels:
+        build_pyramid(metadata_path, os.path.join(output_dir, "pyramid"), levels=levels, tile_size=tile_size)
+    return metadata_path
+
+
+def _bbox(extent, size):
+    min_lat, max_lat, min_lon, max_lon = extent
+    if size is None:
+        return dict(min_lat=min_lat, max_lat=max_lat, min_lon=min_lon, max_lon=max_lon)
+    lat = np.round((min_lat + max_lat) / 2 * 4) / 4
+    lon = np.round((min_lon + max_lon) / 2 * 4) / 4
+    return dict(
+        min_lat=max(min_lat, lat - size / 2),
+        max_lat=min(max_lat, lat + size / 2),
+        min_lon=max(min_lon, lon - size / 2),
+        max_lon=min(max_lon, lon + size / 2),
+    )
+
+
+def _time_span(years, span):
+    first, last = min(years), max(years)
+    if span == "week":
+        return f"{first}-06-01 00:00:00", f"{first}-06-07 23:00:00"
+    elif span == "month":
+        return f"{first}-06-01 00:00:00", f"{first}-06-30 23:00:00"
+    elif span == "year":
+        return f"{first}-01-01 00:00:00", f"{first}-12-31 23:00:00"
+    elif span == "all":
+        return f"{first}-01-01 00:00:00", f"{last}-12-31 23:00:00"
+    elif span == "unaligned":
+        return f"{first}-02-03 05:00:00", f"{last}-11-20 17:00:00"
+    else:
+        raise ValueError("Invalid time span")
+
+
+def gen_cases(
+    years,
+    extent,
+    variable="2m_temperature",
+    executors=tuple(EXECUTORS),
+    bbox_sizes=tuple(BBOX_SIZES),
+    time_spans=TIME_SPANS,
+    predicates=DEFAULT_PREDICATES,
+):
+    """
+    Return: [{"name", "executor", "kwargs"}], the executor x bbox size x time span (x predicate) matrix
+    """
+    cases = []
+    for executor in executors:
+        for bbox_size in bbox_sizes:
+            for span in time_spans:
+                start_datetime, end_datetime = _time_span(years, span)
+                kwargs = dict(
+                    variable=variable,
+                    start_datetime=start_datetime,
+                    end_datetime=end_datetime,
+                    **_bbox(extent, BBOX_SIZES[bbox_size]),
+                )
+                name = f"{executor}/{bbox_size}/{span}"
+                if executor == "get_raster":
+                    if span in ("week", "month"):
+                        kwargs.update(temporal_resolution="hour")
+                    else:
+                        kwargs.update(temporal_resolution="day", temporal_aggregation="mean")
+                    cases.append(dict(name=name, executor=executor, kwargs=kwargs))
+                elif executor == "timeseries":
+                    kwargs.update(temporal_resolution="day", temporal_aggregation="mean")
+                    kwargs.update(time_series_aggregation_method="mean")
+                    cases.append(dict(name=name, executor=executor, kwargs=kwargs))
+                elif executor == "heatmap":
+                    kwargs.update(heatmap_aggregation_method="mean")
+                    cases.append(dict(name=name, executor=executor, kwargs=kwargs))
+                else:
+                    for predicate, value in predicates:
+                        if executor == "find_time":
+                            extra = dict(temporal_resolution="hour", temporal_aggregation=None)
+                            extra.update(time_series_aggregation_method="mean", spatial_resolution=0.25)
+                        else:
+                            extra = dict(heatmap_aggregation_method="mean")
+                        extra.update(filter_predicate=predicate, filter_value=value)
+                        cases.append(
+                            dict(name=f"{name}/{predicate}{value:g}", executor=executor, kwargs={**kwargs, **extra})
+                        )
+    return cases
+
+
+class OfflineClient:
+    """
+    CDS client stand-in: a benchmark must read only the synthetic catalog
+    """
+
+    def retrieve(self, dataset, request):
+        raise RuntimeError("Benchmark query is not covered by the synthetic catalog")
+
+
+def _peak_rss():
+    # VmHWM belongs to this process image; ru_maxrss would carry the parent's peak over fork and exec
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # ru_maxrss is in KiB on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if platform.system() == "Darwin" else peak * 1024
+
+
+def run_case(case, metadata_path, repeat=3):
+    """
+    Run one case repeat times from cold pools and caches, in the calling process, after an untimed warm-up run
+    that takes the one-off import and first-call costs.
+    Return: dict of wall seconds per run, peak RSS, bytes read and files opened of the first timed run
+    """
+    cds_downloader.configure(client_factory=OfflineClient, retries=0)
+    tracer.configure(quiet=True)
+    result = dict(case)
+    result.update(wall_seconds=[], rss_before_bytes=_peak_rss())
+    try:
+        for run in range(repeat + 1):
+            dataset_pool.clear()
+            raster_cache.clear()
+            opens = dataset_pool.opens
+            bytes_read = read_bytes()
+            start = time.perf_counter()
+            EXECUTORS[case["executor"]](**case["kwargs"], metadata=metadata_path).execute().compute()
+            if run == 0:
+                continue
+            result["wall_seconds"].append(time.perf_counter() - start)
+            if run == 1:
+                result["files_opened"] = dataset_pool.opens - opens
+                result["bytes_read"] = None if bytes_read is None else read_bytes() - bytes_read
+    except Exception as e:
+        result["error"] = repr(e)
+    result["peak_rss_bytes"] = _peak_rss()
+    return result
+
+
+def run_benchmark(metadata_path, cases, repeat=3):
+    """
+    Run every case in a fresh process, so peak RSS and the pools belong to that case alone.
+    Return: [case results]
+    """
+    results = []
+    context = multiprocessing.get_context("spawn")
+    for case in cases:
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+            result = pool.submit(run_case, case, metadata_path, repeat).result()
+        if "error" in result:
+            print(f"{case['name']:<40} error: {result['error']}")
+        else:
+            print(
+                f"{case['name']:<40} {min(result['wall_seconds']):8.3f}s"
+                f" {result['peak_rss_bytes'] / 2**20:8.1f} MiB RSS"
+                f" {(result['bytes_read'] or 0) / 2**20:8.1f} MiB read {result['files_opened']:4d} files"
+            )
+        results.append(result)
+    return results
+
+
+def compare(results, previous):
+    """
+    Return: str, best wall time of each case against a previous run's JSON results
+    """
+    previous = {result["name"]: result for result in previous["results"]}
+    lines = []
+    for result in results:
+        before = previous.get(result["name"])
+        if before is None or "error" in before or "error" in result:
+            continue
+        old, new = min(before["wall_seconds"]), min(result["wall_seconds"])
+        lines.append(f"{result['name']:<40} {old:8.3f}s -> {new:8.3f}s  x{new / old:.2f}")
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time every executor over a synthetic ERA5-like catalog")
+    parser.add_argument("catalog_dir", help="synthetic catalog directory, generated when it has no metadata.csv")
+    parser.add_argument("--years", type=int, nargs="+", default=[2020, 2021])
+    parser.add_argument(
+        "--extent", type=float, nargs=4, default=[70, 80, -40, -20], help="MIN_LAT MAX_LAT MIN_LON MAX_LON"
+    )
+    parser.add_argument("--temporal-resolution", action="append", help="e.g. day, month, year (repeatable)")
+    parser.add_argument("--spatial-resolution", action="append", type=float, help="e.g. 0.25, 0.5, 1.0 (repeatable)")
+    parser.add_argument("--tile-size", type=float, help="write the pyramid as tiles of this many degrees")
+    parser.add_argument("--regenerate", action="store_true", help="regenerate the synthetic catalog")
+    parser.add_argument("--executor", action="append", choices=sorted(EXECUTORS), help="(repeatable)")
+    parser.add_argument("--bbox", action="append", choices=sorted(BBOX_SIZES), help="(repeatable)")
+    parser.add_argument("--span", action="append", choices=TIME_SPANS, help="(repeatable)")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", default="benchmark.json", help="JSON results path")
+    parser.add_argument("--compare", help="previous JSON results to compare wall times with")
+    args = parser.parse_args()
+
+    metadata_path = os.path.join(args.catalog_dir, "metadata.csv")
+    if args.regenerate or not os.path.exists(metadata_path):
+        gen_synthetic_catalog(
+            args.catalog_dir,
+            years=args.years,
+            extent=args.extent,
+            temporal_resolutions=args.temporal_resolution or ("day", "month", "year"),
+            spatial_resolutions=args.spatial_resolution or (0.25, 0.5, 1.0),
+            tile_size=args.tile_size,
+        )
+    cases = gen_cases(
+        args.years,
+        args.extent,
+        executors=args.executor or tuple(EXECUTORS),
+        bbox_sizes=args.bbox or tuple(BBOX_SIZES),
+        time_spans=args.span or TIME_SPANS,
+    )
+    results = run_benchmark(os.path.abspath(metadata_path), cases, args.repeat)
+    report = {
+        "created": pd.Timestamp.now().isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "catalog": os.path.abspath(metadata_path),
+        "years": args.years,
+        "extent": args.extent,
+        "repeat": args.repeat,
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print("results:", args.output)
+    if args.compare:
+        with open(args.compare) as f:
+            print(compare(results, json.load(f)))
+
+
+if __name__ == "__main__":
+    main()
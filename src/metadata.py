@@ -1,11 +1,30 @@
+import os
+import threading
+import uuid
+from typing import NamedTuple
+
 import numpy as np
 import pandas as pd
 import xarray as xr
 
 from .utils.const import get_lat_lon_range, time_resolution_to_freq
+from .utils.tracing import tracer
 
 
-def gen_empty_xarray(
+class LeftoverBox(NamedTuple):
+    """
+    Grid-aligned hyper-rectangle of the query not covered by the catalog, bounds inclusive.
+    """
+
+    start_datetime: pd.Timestamp
+    end_datetime: pd.Timestamp
+    min_lat: float
+    max_lat: float
+    min_lon: float
+    max_lon: float
+
+
+def gen_query_axes(
     min_lat,
     max_lat,
     min_lon,
@@ -15,53 +34,376 @@ def gen_empty_xarray(
     temporal_resolution,
     spatial_resolution,
 ):
-    lat_range, lon_range, lat_range_reverse = get_lat_lon_range(spatial_resolution)
+    """
+    Return: valid_time, latitude (ascending), longitude grid points of the query
+    """
+    lat_range, lon_range, _ = get_lat_lon_range(spatial_resolution)
     lat_start = lat_range.searchsorted(min_lat, side="left")
     lat_end = lat_range.searchsorted(max_lat, side="right")
-    lat_reverse_start = len(lat_range) - lat_end
-    lat_reverse_end = len(lat_range) - lat_start
     lon_start = lon_range.searchsorted(min_lon, side="left")
     lon_end = lon_range.searchsorted(max_lon, side="right")
-    ds_empty = xr.Dataset()
-    ds_empty["valid_time"] = pd.date_range(
+    time_range = pd.date_range(
         start=start_datetime,
         end=end_datetime,
         freq=time_resolution_to_freq(temporal_resolution),
     )
-    ds_empty["latitude"] = lat_range_reverse[lat_reverse_start:lat_reverse_end]
-    ds_empty["longitude"] = lon_range[lon_start:lon_end]
+    return time_range.values, lat_range[lat_start:lat_end], lon_range[lon_start:lon_end]
+
+
+def gen_empty_xarray(
+    min_lat,
+    max_lat,
+    min_lon,
+    max_lon,
+    start_datetime,
+    end_datetime,
+    temporal_resolution,
+    spatial_resolution,
+):
+    time_range, lat_range, lon_range = gen_query_axes(
+        min_lat,
+        max_lat,
+        min_lon,
+        max_lon,
+        start_datetime,
+        end_datetime,
+        temporal_resolution,
+        spatial_resolution,
+    )
+    ds_empty = xr.Dataset()
+    ds_empty["valid_time"] = time_range
+    ds_empty["latitude"] = lat_range[::-1]
+    ds_empty["longitude"] = lon_range
     return ds_empty
 
 
+def subtract_box(box, cut):
+    """
+    box, cut: half-open index bounds (t0, t1, lat0, lat1, lon0, lon1)
+    Return: disjoint boxes covering box minus cut
+    """
+    if any(max(box[i], cut[i]) >= min(box[i + 1], cut[i + 1]) for i in (0, 2, 4)):
+        return [box]
+    pieces = []
+    remain = list(box)
+    for i in (0, 2, 4):
+        lo, hi = remain[i], remain[i + 1]
+        cut_lo, cut_hi = max(lo, cut[i]), min(hi, cut[i + 1])
+        if lo < cut_lo:
+            piece = list(remain)
+            piece[i], piece[i + 1] = lo, cut_lo
+            pieces.append(tuple(piece))
+        if cut_hi < hi:
+            piece = list(remain)
+            piece[i], piece[i + 1] = cut_hi, hi
+            pieces.append(tuple(piece))
+        remain[i], remain[i + 1] = cut_lo, cut_hi
+    return pieces
+
+
+def split_into_tiles(ds, tile_size):
+    """
+    tile_size: degrees, dividing 180, e.g. 10
+    Return: [(tile's south edge, west edge, ds restricted to the tile)] for the tiles of the global tile_size grid ds
+    has points in; tiles are disjoint, the 90 / 180 edge points belong to the last tile
+    """
+    if tile_size <= 0 or 180 % tile_size:
+        raise ValueError("Invalid tile_size")
+    lat_tile = np.clip(np.floor((ds.latitude.values + 90) / tile_size), 0, 180 // tile_size - 1).astype(int)
+    lon_tile = np.clip(np.floor((ds.longitude.values + 180) / tile_size), 0, 360 // tile_size - 1).astype(int)
+    tiles = []
+    for i in np.unique(lat_tile):
+        for j in np.unique(lon_tile):
+            tiles.append(
+                (i * tile_size - 90, j * tile_size - 180, ds.isel(latitude=lat_tile == i, longitude=lon_tile == j))
+            )
+    return tiles
+
+
+def tile_suffix(south, west):
+    return f"{abs(south):02g}{'S' if south < 0 else 'N'}{abs(west):03g}{'W' if west < 0 else 'E'}"
+
+
+def to_catalog_netcdf(ds, file_path, compute=True):
+    """
+    Write ds as plain float32 without packing or inherited encoding, so re-reads equal the values written
+    """
+    ds = ds.copy()
+    for name in ds.variables:
+        ds[name].encoding = {}
+    encoding = {name: {"dtype": "float32", "zlib": True, "complevel": 1} for name in ds.data_vars}
+    return ds.to_netcdf(file_path, engine="netcdf4", encoding=encoding, compute=compute)
+
+
+# on-disk chunks of Zarr catalog entries, about 10MB of float32 each
+ZARR_LAYOUTS = {
+    # a year of hours over 4 x 4 degrees: a small-area time series reads one chunk per year
+    "series": {"valid_time": 8784, "latitude": 16, "longitude": 16},
+    # 6 hours over a quarter of the globe: a map reads a few chunks
+    "map": {"valid_time": 6, "latitude": 361, "longitude": 720},
+    # a week over 30 x 30 degrees, for both access patterns
+    "balanced": {"valid_time": 168, "latitude": 120, "longitude": 120},
+}
+
+
+def to_catalog_zarr(ds, store_path, layout="balanced", compute=True):
+    """
+    Write ds as a plain float32 Zarr group with the on-disk chunks of a ZARR_LAYOUTS layout
+    """
+    if layout not in ZARR_LAYOUTS:
+        raise ValueError("Invalid zarr layout")
+    ds = ds.copy()
+    for name in ds.variables:
+        ds[name].encoding = {}
+    encoding = {}
+    for name, da in ds.data_vars.items():
+        chunks = tuple(min(ZARR_LAYOUTS[layout].get(dim, size), size) for dim, size in zip(da.dims, da.shape))
+        encoding[name] = {"dtype": "float32", "chunks": chunks}
+        if da.chunks is not None:
+            # Dask chunks must not straddle Zarr chunks for parallel writes
+            ds[name] = da.chunk(dict(zip(da.dims, chunks)))
+    return ds.to_zarr(store_path, mode="w", encoding=encoding, consolidated=True, compute=compute)
+
+
+def catalog_row(
+    ds,
+    variable,
+    start_datetime,
+    end_datetime,
+    temporal_resolution,
+    temporal_aggregation,
+    spatial_resolution,
+    spatial_aggregation,
+    file_path,
+):
+    """
+    Return: dict, metadata.csv row for a file holding ds
+    """
+    return {
+        "variable": variable,
+        "start_datetime": pd.Timestamp(start_datetime).strftime("%Y-%m-%d %H:%M"),
+        "end_datetime": pd.Timestamp(end_datetime).strftime("%Y-%m-%d %H:%M"),
+        "max_lat": ds.latitude.values.max().item(),
+        "min_lat": ds.latitude.values.min().item(),
+        "max_lon": ds.longitude.values.max().item(),
+        "min_lon": ds.longitude.values.min().item(),
+        "temporal_resolution": temporal_resolution,
+        "temporal_aggregation": temporal_aggregation or "none",
+        "spatial_resolution": spatial_resolution,
+        "spatial_aggregation": spatial_aggregation or "none",
+        "file_path": file_path,
+    }
+
+
+class TimeIntervalIndex:
+    """
+    Sorted-array interval index over catalog rows sharing one resolution/aggregation key.
+    Rows are sorted by start time; a running max of end times bounds the overlap scan.
+    """
+
+    def __init__(self, positions, starts, ends):
+        order = np.argsort(starts, kind="stable")
+        self.positions = positions[order]
+        self.starts = starts[order]
+        self.ends = ends[order]
+        self.max_ends = np.maximum.accumulate(self.ends)
+
+    def overlap(self, start, end):
+        """
+        Return: catalog row positions whose [start, end] overlaps the query [start, end]
+        """
+        hi = self.starts.searchsorted(end, side="right")
+        lo = self.max_ends[:hi].searchsorted(start, side="left")
+        candidates = slice(lo, hi)
+        return self.positions[candidates][self.ends[candidates] >= start]
+
+
+class TileIndex:
+    """
+    Catalog rows of one resolution/aggregation key grouped by lat/lon extent, i.e. global files or spatial tiles,
+    each extent with its own TimeIntervalIndex; a query only scans the time index of the extents its bbox touches.
+    """
+
+    def __init__(self, positions, starts, ends, extents):
+        self.extents, inverse = np.unique(extents, axis=0, return_inverse=True)
+        order = np.argsort(inverse.ravel(), kind="stable")
+        groups = np.split(order, np.cumsum(np.bincount(inverse.ravel(), minlength=len(self.extents)))[:-1])
+        self.tiles = [TimeIntervalIndex(positions[group], starts[group], ends[group]) for group in groups]
+
+    def overlap(self, start, end, min_lat, max_lat, min_lon, max_lon):
+        """
+        Return: catalog row positions overlapping the query in time and space
+        """
+        hit = np.flatnonzero(
+            (self.extents[:, 0] <= max_lat)
+            & (self.extents[:, 1] >= min_lat)
+            & (self.extents[:, 2] <= max_lon)
+            & (self.extents[:, 3] >= min_lon)
+        )
+        if len(hit) == 0:
+            return np.array([], dtype=int)
+        return np.concatenate([self.tiles[i].overlap(start, end) for i in hit])
+
+
 class Metadata:
     def __init__(self, f_path):
         self.f_path = f_path
+        self.mtime = os.path.getmtime(f_path)
         self.df_meta = pd.read_csv(f_path)
+        self.materialize_dir = None
+        self.materialize_tile_size = None
+        self._register_lock = threading.Lock()
+        self._build_index()
 
     @staticmethod
-    def _gen_xarray_for_meta_row(row, overwrite_temporal_resolution=None):
-        if overwrite_temporal_resolution is not None:
-            t_resolution = overwrite_temporal_resolution
-        else:
-            t_resolution = row.temporal_resolution
-        return gen_empty_xarray(
-            row.min_lat,
-            row.max_lat,
-            row.min_lon,
-            row.max_lon,
-            row.start_datetime,
-            row.end_datetime,
-            t_resolution,
-            row.spatial_resolution,
+    def _index_key(variable, temporal_resolution, temporal_aggregation, spatial_resolution, spatial_aggregation):
+        if temporal_aggregation is None:
+            temporal_aggregation = "none"
+        if spatial_aggregation is None:
+            spatial_aggregation = "none"
+        return (variable, temporal_resolution, temporal_aggregation, float(spatial_resolution), spatial_aggregation)
+
+    def _build_index(self):
+        # rows are only ever appended, so positions held by a concurrent reader stay valid while rebuilding
+        self.start_datetimes = pd.to_datetime(self.df_meta["start_datetime"]).to_numpy(dtype="datetime64[ns]")
+        self.end_datetimes = pd.to_datetime(self.df_meta["end_datetime"]).to_numpy(dtype="datetime64[ns]")
+        index = {}
+        key_columns = [
+            "variable",
+            "temporal_resolution",
+            "temporal_aggregation",
+            "spatial_resolution",
+            "spatial_aggregation",
+        ]
+        extents = self.df_meta[["min_lat", "max_lat", "min_lon", "max_lon"]].to_numpy(dtype="float64")
+        for key, positions in self.df_meta.groupby(key_columns, sort=False).indices.items():
+            index[self._index_key(*key)] = TileIndex(
+                positions, self.start_datetimes[positions], self.end_datetimes[positions], extents[positions]
+            )
+        self.index = index
+
+    def enable_materialization(self, directory, tile_size=None):
+        """
+        Opt in to persisting downloaded and computed rasters under directory and registering them in this catalog,
+        written as one file per tile_size-degree tile when tile_size is given
+        """
+        if tile_size is not None and (tile_size <= 0 or 180 % tile_size):
+            raise ValueError("Invalid tile_size")
+        os.makedirs(directory, exist_ok=True)
+        self.materialize_dir = directory
+        self.materialize_tile_size = tile_size
+
+    def register(self, rows):
+        """
+        rows: [dict], one per new file, with the catalog columns
+        Appends rows to the catalog file and the in-memory index.
+        """
+        df_new = pd.DataFrame(rows, columns=self.df_meta.columns)
+        with self._register_lock:
+            with open(self.f_path, "rb+") as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    f.write(b"\n")
+            df_new.to_csv(self.f_path, mode="a", header=False, index=False)
+            self.df_meta = pd.concat([self.df_meta, df_new], ignore_index=True)
+            self._build_index()
+            self.mtime = os.path.getmtime(self.f_path)
+
+    def repoint(self, file_paths):
+        """
+        file_paths: {old file path: new file path}, e.g. NetCDF files converted to Zarr groups
+        Rewrites the catalog file with the rows pointing at the new paths; the rows' coverage is unchanged.
+        """
+        with self._register_lock:
+            self.df_meta["file_path"] = self.df_meta["file_path"].replace(file_paths)
+            tmp_path = f"{self.f_path}.{uuid.uuid4().hex[:8]}.tmp"
+            self.df_meta.to_csv(tmp_path, index=False)
+            os.replace(tmp_path, self.f_path)
+            self.mtime = os.path.getmtime(self.f_path)
+
+    def materialize(
+        self,
+        ds,
+        variable,
+        start_datetime,
+        end_datetime,
+        temporal_resolution,
+        temporal_aggregation,
+        spatial_resolution,
+        spatial_aggregation,
+    ):
+        """
+        ds: raster that exactly covers [start_datetime, end_datetime] and its lat/lon extent
+        Writes ds to materialize_dir, one file per tile when materialize_tile_size is set, and registers it.
+        Return: [paths of the files written]
+        """
+        start_datetime = pd.Timestamp(start_datetime)
+        end_datetime = pd.Timestamp(end_datetime)
+        temporal_aggregation = temporal_aggregation or "none"
+        spatial_aggregation = spatial_aggregation or "none"
+        file_name = (
+            f"{variable}-{temporal_resolution}-{temporal_aggregation}-{spatial_resolution}-{spatial_aggregation}"
+            f"-{start_datetime:%Y%m%d%H}-{end_datetime:%Y%m%d%H}-{uuid.uuid4().hex[:8]}"
         )
+        if self.materialize_tile_size is None:
+            tiles = [(file_name, ds)]
+        else:
+            tiles = [
+                (f"{file_name}-{tile_suffix(south, west)}", ds_tile)
+                for south, west, ds_tile in split_into_tiles(ds, self.materialize_tile_size)
+            ]
+        rows = []
+        for tile_name, ds_tile in tiles:
+            file_path = os.path.join(self.materialize_dir, f"{tile_name}.nc")
+            to_catalog_netcdf(ds_tile, file_path)
+            rows.append(
+                catalog_row(
+                    ds_tile,
+                    variable,
+                    start_datetime,
+                    end_datetime,
+                    temporal_resolution,
+                    temporal_aggregation,
+                    spatial_resolution,
+                    spatial_aggregation,
+                    file_path,
+                )
+            )
+            tracer.log("materialized:", file_path)
+        self.register(rows)
+        return [row["file_path"] for row in rows]
 
-    @staticmethod
-    def _mask_query_with_meta(ds_query, ds_meta):
-        return (
-            ds_query["valid_time"].isin(ds_meta["valid_time"])
-            & ds_query["latitude"].isin(ds_meta["latitude"])
-            & ds_query["longitude"].isin(ds_meta["longitude"])
+    def query_overlap(
+        self,
+        variable,
+        start_datetime,
+        end_datetime,
+        min_lat,
+        max_lat,
+        min_lon,
+        max_lon,
+        temporal_resolution,
+        temporal_aggregation,
+        spatial_resolution,
+        spatial_aggregation,
+    ):
+        """
+        Return: pd.DataFrame, catalog rows overlapping the query in time and space, in catalog order
+        """
+        key = self._index_key(
+            variable, temporal_resolution, temporal_aggregation, spatial_resolution, spatial_aggregation
+        )
+        if key not in self.index:
+            return self.df_meta.iloc[[]]
+        positions = self.index[key].overlap(
+            np.datetime64(pd.Timestamp(start_datetime)),
+            np.datetime64(pd.Timestamp(end_datetime)),
+            min_lat,
+            max_lat,
+            min_lon,
+            max_lon,
         )
+        return self.df_meta.iloc[np.sort(positions)]
 
     def query_get_overlap_and_leftover(
         self,
@@ -77,26 +419,21 @@ class Metadata:
         spatial_resolution,
         spatial_aggregation,
     ):
-        if temporal_aggregation is None:
-            temporal_aggregation = "none"
-        if spatial_aggregation is None:
-            spatial_aggregation = "none"
-
-        df_overlap = self.df_meta[
-            (self.df_meta["variable"] == variable)
-            & (self.df_meta["min_lat"] <= max_lat)
-            & (self.df_meta["max_lat"] >= min_lat)
-            & (self.df_meta["min_lon"] <= max_lon)
-            & (self.df_meta["max_lon"] >= min_lon)
-            & (pd.to_datetime(self.df_meta["start_datetime"]) <= pd.to_datetime(end_datetime))
-            & (pd.to_datetime(self.df_meta["end_datetime"]) >= pd.to_datetime(start_datetime))
-            & (self.df_meta["temporal_resolution"] == temporal_resolution)
-            & (self.df_meta["spatial_resolution"] == spatial_resolution)
-            & (self.df_meta["temporal_aggregation"] == temporal_aggregation)
-            & (self.df_meta["spatial_aggregation"] == spatial_aggregation)
-        ]
+        df_overlap = self.query_overlap(
+            variable,
+            start_datetime,
+            end_datetime,
+            min_lat,
+            max_lat,
+            min_lon,
+            max_lon,
+            temporal_resolution,
+            temporal_aggregation,
+            spatial_resolution,
+            spatial_aggregation,
+        )
 
-        ds_query = gen_empty_xarray(
+        time_range, lat_range, lon_range = gen_query_axes(
             min_lat,
             max_lat,
             min_lon,
@@ -107,30 +444,49 @@ class Metadata:
             spatial_resolution,
         )
 
-        false_mask = xr.DataArray(
-            data=np.zeros(
-                (
-                    ds_query.sizes["valid_time"],
-                    ds_query.sizes["latitude"],
-                    ds_query.sizes["longitude"],
-                ),
-                dtype=bool,
-            ),
-            coords={
-                "valid_time": ds_query["valid_time"],
-                "latitude": ds_query["latitude"],
-                "longitude": ds_query["longitude"],
-            },
-            dims=["valid_time", "latitude", "longitude"],
-        )
-
+        # leftover is computed as index boxes over the query axes, never as a dense time x lat x lon mask
+        leftover = [(0, len(time_range), 0, len(lat_range), 0, len(lon_range))]
+        if 0 in (len(time_range), len(lat_range), len(lon_range)):
+            leftover = []
         for row in df_overlap.itertuples():
-            ds_meta = self._gen_xarray_for_meta_row(row)
-            mask = self._mask_query_with_meta(ds_query, ds_meta)
-            false_mask = false_mask | mask
+            covered = (
+                time_range.searchsorted(self.start_datetimes[row.Index], side="left"),
+                time_range.searchsorted(self.end_datetimes[row.Index], side="right"),
+                lat_range.searchsorted(row.min_lat, side="left"),
+                lat_range.searchsorted(row.max_lat, side="right"),
+                lon_range.searchsorted(row.min_lon, side="left"),
+                lon_range.searchsorted(row.max_lon, side="right"),
+            )
+            leftover = [piece for box in leftover for piece in subtract_box(box, covered)]
+            if not leftover:
+                break
 
-        leftover = false_mask.where(false_mask == False, drop=True)
-        if leftover.values.size > 0:
-            return df_overlap, leftover
-        else:
-            return df_overlap, None
+        leftover = [
+            LeftoverBox(
+                pd.Timestamp(time_range[t0]),
+                pd.Timestamp(time_range[t1 - 1]),
+                lat_range[lat0].item(),
+                lat_range[lat1 - 1].item(),
+                lon_range[lon0].item(),
+                lon_range[lon1 - 1].item(),
+            )
+            for t0, t1, lat0, lat1, lon0, lon1 in leftover
+        ]
+        return df_overlap, leftover
+
+
+_metadata_cache = {}
+_metadata_cache_lock = threading.Lock()
+
+
+def load_metadata(f_path):
+    """
+    Return: Metadata shared process-wide per file, re-read only when the file's mtime changes
+    """
+    key = os.path.abspath(f_path)
+    with _metadata_cache_lock:
+        metadata = _metadata_cache.get(key)
+        if metadata is None or metadata.mtime != os.path.getmtime(key):
+            metadata = Metadata(f_path)
+            _metadata_cache[key] = metadata
+        return metadata
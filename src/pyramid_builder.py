@@ -0,0 +1,192 @@
+import argparse
+import os
+
+import dask
+import pandas as pd
+import xarray as xr
+
+from .metadata import catalog_row, load_metadata, split_into_tiles, tile_suffix, to_catalog_netcdf
+from .query_executor_get_raster import coarsen_to_grid, temporal_resample
+from .utils.chunk_policy import ChunkPolicy
+from .utils.dataset_pool import file_engine
+from .utils.get_whole_period import get_period_bounds
+from .utils.tracing import tracer
+
+# month-long chunks over about a quarter of the globe, tiles rounded to whole on-disk chunks of the raw file
+DEFAULT_CHUNK_POLICY = ChunkPolicy(time="month", latitude=361, longitude=720)
+
+
+def gen_pyramid_levels(
+    temporal_resolutions=("hour", "day", "month", "year"),
+    temporal_aggregations=("min", "mean", "max"),
+    spatial_resolutions=(0.25, 0.5, 1.0),
+    spatial_aggregations=("min", "mean", "max"),
+):
+    """
+    Return: [(temporal_resolution, temporal_aggregation, spatial_resolution, spatial_aggregation)], raw level excluded
+    """
+    levels = []
+    for temporal_resolution in temporal_resolutions:
+        for temporal_aggregation in [None] if temporal_resolution == "hour" else temporal_aggregations:
+            for spatial_resolution in spatial_resolutions:
+                for spatial_aggregation in [None] if spatial_resolution == 0.25 else spatial_aggregations:
+                    if temporal_resolution == "hour" and spatial_resolution == 0.25:
+                        continue
+                    levels.append((temporal_resolution, temporal_aggregation, spatial_resolution, spatial_aggregation))
+    return levels
+
+
+def _complete_periods(ds, temporal_resolution, hour_start, hour_end):
+    """
+    Return: ds restricted to periods fully inside [hour_start, hour_end], first hour, last hour; None if there are none
+    """
+    if temporal_resolution == "hour":
+        return ds, hour_start, hour_end
+    period_starts, period_ends = get_period_bounds(ds.indexes["valid_time"], temporal_resolution)
+    complete = (period_starts >= hour_start) & (period_ends <= hour_end)
+    if not complete.any():
+        return None
+    return (
+        ds.isel(valid_time=complete),
+        pd.Timestamp(period_starts[complete][0]),
+        pd.Timestamp(period_ends[complete][-1]),
+    )
+
+
+def build_file_pyramid(row, output_dir, levels, metadata, policy=DEFAULT_CHUNK_POLICY, tile_size=None):
+    """
+    Compute every missing pyramid level of one raw hourly catalog file in a single Dask pass over the file,
+    written as one file per tile_size-degree tile when tile_size is given.
+    Return: [catalog rows] of the files written
+    """
+    ds_raw = policy.apply(xr.open_dataset(row.file_path, engine=file_engine(row.file_path)))
+    if "number" in ds_raw.coords:
+        ds_raw = ds_raw.drop_vars("number")
+    if "expver" in ds_raw.coords:
+        ds_raw = ds_raw.drop_vars("expver")
+    hour_start, hour_end = ds_raw.indexes["valid_time"][[0, -1]]
+
+    rows = []
+    writes = []
+    temporal = {}
+    for temporal_resolution, temporal_aggregation, spatial_resolution, spatial_aggregation in levels:
+        _, leftover = metadata.query_get_overlap_and_leftover(
+            row.variable,
+            hour_start,
+            hour_end,
+            row.min_lat,
+            row.max_lat,
+            row.min_lon,
+            row.max_lon,
+            temporal_resolution,
+            temporal_aggregation,
+            spatial_resolution,
+            spatial_aggregation,
+        )
+        if not leftover:
+            continue
+        # temporal aggregate is shared by all spatial levels built on it; Dask also shares the raw chunk reads
+        if (temporal_resolution, temporal_aggregation) not in temporal:
+            temporal[(temporal_resolution, temporal_aggregation)] = _complete_periods(
+                temporal_resample(ds_raw, temporal_resolution, temporal_aggregation),
+                temporal_resolution,
+                hour_start,
+                hour_end,
+            )
+        complete = temporal[(temporal_resolution, temporal_aggregation)]
+        if complete is None:
+            continue
+        ds, start_datetime, end_datetime = complete
+        ds = coarsen_to_grid(ds, spatial_resolution, spatial_aggregation)
+        file_name = (
+            f"{row.variable}-{start_datetime:%Y%m%d%H}-{end_datetime:%Y%m%d%H}"
+            f"-{temporal_resolution}-{temporal_aggregation or 'none'}"
+            f"-{spatial_resolution}-{spatial_aggregation or 'none'}"
+        )
+        if tile_size is None:
+            tiles = [(file_name, ds)]
+        else:
+            tiles = [
+                (f"{file_name}-{tile_suffix(south, west)}", ds_tile)
+                for south, west, ds_tile in split_into_tiles(ds, tile_size)
+            ]
+        os.makedirs(os.path.join(output_dir, row.variable), exist_ok=True)
+        for tile_name, ds_tile in tiles:
+            file_path = os.path.join(output_dir, row.variable, f"{tile_name}.nc")
+            writes.append(to_catalog_netcdf(ds_tile, file_path, compute=False))
+            rows.append(
+                catalog_row(
+                    ds_tile,
+                    row.variable,
+                    start_datetime,
+                    end_datetime,
+                    temporal_resolution,
+                    temporal_aggregation,
+                    spatial_resolution,
+                    spatial_aggregation,
+                    file_path,
+                )
+            )
+    if writes:
+        dask.compute(*writes)
+    ds_raw.close()
+    return rows
+
+
+def build_pyramid(
+    metadata, output_dir, variables=None, levels=None, policy=DEFAULT_CHUNK_POLICY, tile_size=None, register=True
+):
+    """
+    Build the temporal / spatial pyramid for every raw hourly 0.25 degree file in the catalog.
+    metadata: metadata file path or Metadata instance
+    Return: [catalog rows] of the files written, also appended to the catalog when register is True
+    """
+    if isinstance(metadata, str):
+        metadata = load_metadata(metadata)
+    if levels is None:
+        levels = gen_pyramid_levels()
+    df_raw = metadata.df_meta[
+        (metadata.df_meta["temporal_resolution"] == "hour") & (metadata.df_meta["spatial_resolution"] == 0.25)
+    ]
+    if variables is not None:
+        df_raw = df_raw[df_raw["variable"].isin(variables)]
+    all_rows = []
+    for row in df_raw.itertuples():
+        tracer.log("pyramid:", row.file_path)
+        rows = build_file_pyramid(row, output_dir, levels, metadata, policy, tile_size)
+        if register and rows:
+            metadata.register(rows)
+        all_rows += rows
+    return all_rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build pre-aggregated pyramid files from raw hourly catalog files")
+    parser.add_argument("metadata", help="metadata.csv path")
+    parser.add_argument("output_dir", help="directory to write pyramid files into")
+    parser.add_argument("--variable", action="append", help="only build for this variable (repeatable)")
+    parser.add_argument("--temporal-resolution", action="append", help="e.g. hour, day, month, year (repeatable)")
+    parser.add_argument("--spatial-resolution", action="append", type=float, help="e.g. 0.25, 0.5, 1.0 (repeatable)")
+    parser.add_argument("--tile-size", type=float, help="write tiles of this many degrees, e.g. 10")
+    parser.add_argument("--no-register", action="store_true", help="write files without appending catalog rows")
+    args = parser.parse_args()
+
+    level_args = {}
+    if args.temporal_resolution:
+        level_args["temporal_resolutions"] = args.temporal_resolution
+    if args.spatial_resolution:
+        level_args["spatial_resolutions"] = args.spatial_resolution
+    rows = build_pyramid(
+        args.metadata,
+        args.output_dir,
+        variables=args.variable,
+        levels=gen_pyramid_levels(**level_args),
+        tile_size=args.tile_size,
+        register=not args.no_register,
+    )
+    for row in rows:
+        print(",".join(str(value) for value in row.values()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,296 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple
+
+import dask
+import pandas as pd
+
+from .metadata import load_metadata
+from .query_executor import QueryExecutor
+from .query_executor_find_area import FindAreaExecutor
+from .query_executor_find_time import FindTimeExecutor
+from .query_executor_get_raster import GetRasterExecutor
+from .query_executor_heatmap import HeatmapExecutor
+from .query_executor_timeseries import TimeseriesExecutor, aggregate_area
+from .utils.get_whole_period import get_period_bounds
+from .utils.tracing import Span, in_current_context, tracer
+
+QUERY_EXECUTORS = {
+    "get_raster": GetRasterExecutor,
+    "timeseries": TimeseriesExecutor,
+    "heatmap": HeatmapExecutor,
+    "find_time": FindTimeExecutor,
+    "find_area": FindAreaExecutor,
+}
+
+
+class BatchRead(NamedTuple):
+    """
+    One GetRaster read of a batch: the union of the members' time windows and bboxes, sliced back per member.
+    """
+
+    executor: GetRasterExecutor
+    members: list  # [GetRasterExecutor] of the queries served by the read
+
+
+def _window(executor):
+    return pd.Timestamp(executor.start_datetime), pd.Timestamp(executor.end_datetime)
+
+
+def _volume(start, end, min_lat, max_lat, min_lon, max_lon, spatial_resolution):
+    hours = (end - start) / pd.Timedelta(hours=1) + 1
+    return hours * (max_lat - min_lat + spatial_resolution) * (max_lon - min_lon + spatial_resolution)
+
+
+def _executor_volume(executor):
+    start, end = _window(executor)
+    return _volume(
+        start, end, executor.min_lat, executor.max_lat, executor.min_lon, executor.max_lon, executor.spatial_resolution
+    )
+
+
+def _is_aligned(executor):
+    """
+    Return: True when the read covers whole periods of its temporal resolution, so its time steps are the same
+    whether read alone or sliced from a longer read
+    """
+    if executor.temporal_resolution == "hour":
+        return True
+    start, end = _window(executor)
+    period_starts, period_ends = get_period_bounds([start, end], executor.temporal_resolution)
+    return period_starts[0] == start and period_ends[-1] == end
+
+
+class _Cluster:
+    def __init__(self, executor):
+        self.members = [executor]
+        self.start, self.end = _window(executor)
+        self.min_lat, self.max_lat = executor.min_lat, executor.max_lat
+        self.min_lon, self.max_lon = executor.min_lon, executor.max_lon
+        self.aligned = _is_aligned(executor)
+        self.member_volume = _executor_volume(executor)
+
+    def _union_volume(self, executor):
+        start, end = _window(executor)
+        return _volume(
+            min(self.start, start),
+            max(self.end, end),
+            min(self.min_lat, executor.min_lat),
+            max(self.max_lat, executor.max_lat),
+            min(self.min_lon, executor.min_lon),
+            max(self.max_lon, executor.max_lon),
+            executor.spatial_resolution,
+        )
+
+    def accepts(self, executor, max_expansion):
+        start, end = _window(executor)
+        step = pd.Timedelta(hours=1)
+        if executor.temporal_resolution != "hour" and not (self.aligned and _is_aligned(executor)):
+            # a partial period would aggregate different hours in a longer read
+            if (start, end) != (self.start, self.end):
+                return False
+        elif start > self.end + step or end < self.start - step:
+            return False
+        resolution = executor.spatial_resolution
+        if executor.min_lat > self.max_lat + resolution or executor.max_lat < self.min_lat - resolution:
+            return False
+        if executor.min_lon > self.max_lon + resolution or executor.max_lon < self.min_lon - resolution:
+            return False
+        return self._union_volume(executor) <= max_expansion * (self.member_volume + _executor_volume(executor))
+
+    def add(self, executor):
+        start, end = _window(executor)
+        self.member_volume += _executor_volume(executor)
+        self.members.append(executor)
+        self.start, self.end = min(self.start, start), max(self.end, end)
+        self.min_lat, self.max_lat = min(self.min_lat, executor.min_lat), max(self.max_lat, executor.max_lat)
+        self.min_lon, self.max_lon = min(self.min_lon, executor.min_lon), max(self.max_lon, executor.max_lon)
+        self.aligned = self.aligned and _is_aligned(executor)
+
+    def to_read(self):
+        first = self.members[0]
+        if len(self.members) == 1:
+            return BatchRead(first, self.members)
+        executor = GetRasterExecutor(
+            first.variable,
+            str(self.start),
+            str(self.end),
+            self.min_lat,
+            self.max_lat,
+            self.min_lon,
+            self.max_lon,
+            temporal_resolution=first.temporal_resolution,
+            temporal_aggregation=first.temporal_aggregation,
+            spatial_resolution=first.spatial_resolution,
+            spatial_aggregation=first.spatial_aggregation,
+            metadata=first.metadata,
+            downloader=first.downloader,
+        )
+        return BatchRead(executor, self.members)
+
+
+class BatchExecutor:
+    """
+    Runs many queries together: the GetRaster reads of Timeseries, Heatmap and GetRaster queries on the same
+    catalog level are merged into one read of the union bbox and time window when they overlap or touch,
+    and every query is answered from slices of the shared reads. FindTime and FindArea queries prune
+    adaptively and run on their own, concurrently with the shared reads.
+    """
+
+    def __init__(
+        self,
+        queries,  # [QueryExecutor or spec dict], e.g. {"executor": "heatmap", "variable": ..., ...}
+        metadata=None,  # metadata file path or Metadata instance, for specs that do not give one
+        max_workers=None,  # reads run concurrently, 1 to run serially
+        max_expansion=1.5,  # a merged read may cover at most this times the members' summed volume
+    ):
+        if isinstance(metadata, str):
+            metadata = load_metadata(metadata)
+        self.metadata = metadata
+        self.queries = [self._gen_executor(query) for query in queries]
+        self.max_workers = max_workers
+        self.max_expansion = max_expansion
+        self.trace = None  # Span tree of the last traced execute(), see QueryExecutor.trace
+
+    def _gen_executor(self, query):
+        if isinstance(query, QueryExecutor):
+            return query
+        spec = dict(query)
+        name = spec.pop("executor", None)
+        if name not in QUERY_EXECUTORS:
+            raise ValueError(f"Invalid query executor: {name}")
+        spec.setdefault("metadata", self.metadata)
+        return QUERY_EXECUTORS[name](**spec)
+
+    @staticmethod
+    def _decompose(query):
+        """
+        Return: [GetRasterExecutors] the query is computed from, function of their rasters to the query result;
+        None for queries run on their own
+        """
+        if isinstance(query, GetRasterExecutor):
+            if query.time_points is not None:
+                return None
+            return [query], lambda rasters: rasters[0]
+        if isinstance(query, TimeseriesExecutor):
+            method = query.time_series_aggregation_method
+            return [query._gen_raster_executor()], lambda rasters: aggregate_area(rasters[0], method)
+        if isinstance(query, HeatmapExecutor):
+            if query.heatmap_aggregation_method not in ("mean", "max", "min"):
+                raise ValueError("Invalid heatmap_aggregation_method")
+            executors, hours = query._get_sub_executors()
+            return executors, lambda rasters: query._aggregate(rasters, hours)
+        return None
+
+    def _group_reads(self, executors):
+        """
+        Return: [BatchRead], greedy clusters of reads of the same level, catalog and downloader
+        """
+        groups = {}
+        for executor in sorted(executors, key=lambda executor: _window(executor)[0]):
+            key = (
+                executor.variable,
+                executor.temporal_resolution,
+                executor.temporal_aggregation,
+                executor.spatial_resolution,
+                executor.spatial_aggregation,
+                id(executor.metadata),
+                id(executor.downloader),
+            )
+            clusters = groups.setdefault(key, [])
+            for cluster in clusters:
+                if cluster.accepts(executor, self.max_expansion):
+                    cluster.add(executor)
+                    break
+            else:
+                clusters.append(_Cluster(executor))
+        return [cluster.to_read() for clusters in groups.values() for cluster in clusters]
+
+    def _plan(self):
+        """
+        Return: [BatchRead], {query index: ([GetRasterExecutors], finish function)} of the batched queries
+        """
+        batched = {}
+        for i, query in enumerate(self.queries):
+            decomposed = self._decompose(query)
+            if decomposed is not None:
+                batched[i] = decomposed
+        reads = self._group_reads([executor for executors, _ in batched.values() for executor in executors])
+        return reads, batched
+
+    def plan(self):
+        """
+        Return: [BatchRead] of the batched queries
+        """
+        return self._plan()[0]
+
+    def explain(self):
+        return self._explain(self.plan())
+
+    @staticmethod
+    def _explain(reads):
+        members = sum(len(read.members) for read in reads)
+        lines = [f"{members} query reads merged into {len(reads)} reads"]
+        for read in reads:
+            e = read.executor
+            lines.append(
+                f"  {e.temporal_resolution}/{e.temporal_aggregation or 'none'}"
+                f" {e.spatial_resolution}/{e.spatial_aggregation or 'none'}"
+                f" {e.start_datetime} - {e.end_datetime}"
+                f" lat [{e.min_lat}, {e.max_lat}] lon [{e.min_lon}, {e.max_lon}]: {len(read.members)} queries"
+            )
+        return "\n".join(lines)
+
+    @staticmethod
+    def _slice(read, ds, member):
+        if member is read.executor:
+            return ds
+        return ds.sel(
+            valid_time=slice(member.start_datetime, member.end_datetime),
+            latitude=slice(member.max_lat, member.min_lat),
+            longitude=slice(member.min_lon, member.max_lon),
+        )
+
+    def execute(self):
+        """
+        Return: [query result] in query order, each as the query's own execute() would return it;
+        results sliced from one uncached lazy read share its chunks only when computed together, e.g. by compute()
+        """
+        with tracer.span("BatchExecutor", queries=len(self.queries)) as span:
+            if isinstance(span, Span):
+                self.trace = span
+            reads, batched = self._plan()
+            span.set(
+                query_reads=sum(len(read.members) for read in reads),
+                reads=len(reads),
+                unbatched=len(self.queries) - len(batched),
+            )
+            tracer.log(self._explain(reads))
+            tasks = [read.executor.execute for read in reads]
+            tasks += [query.execute for i, query in enumerate(self.queries) if i not in batched]
+            if self.max_workers == 1 or len(tasks) <= 1:
+                outputs = [task() for task in tasks]
+            else:
+                with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+                    futures = [pool.submit(in_current_context(task)) for task in tasks]
+                    outputs = [future.result() for future in futures]
+
+            sliced = {}
+            for read, ds in zip(reads, outputs):
+                for member in read.members:
+                    sliced[id(member)] = self._slice(read, ds, member)
+            unbatched = iter(outputs[len(reads) :])
+            results = []
+            for i, query in enumerate(self.queries):
+                if i not in batched:
+                    results.append(next(unbatched))
+                    continue
+                executors, finish = batched[i]
+                with query._trace_span():
+                    results.append(finish([sliced[id(executor)] for executor in executors]))
+            return results
+
+    def compute(self):
+        """
+        Return: [query result] with data variables loaded in memory, computed in one pass over the shared reads
+        """
+        return list(dask.compute(*self.execute()))
@@ -1,8 +1,12 @@
+import asyncio
+import contextlib
 from abc import ABC, abstractmethod
 import xarray as xr
 
-from .metadata import Metadata
+from .metadata import Metadata, load_metadata
+from .utils.cancellation import CancelToken, cancellable_compute, run_cancellable
 from .utils.const import long_short_name_dict
+from .utils.tracing import Span, tracer
 
 
 class QueryExecutor(ABC):
@@ -19,7 +23,7 @@ class QueryExecutor(ABC):
         temporal_aggregation=None,  # e.g., "mean", "max", "min"
         spatial_resolution=0.25,  # e.g., 0.25, 0.5, 1.0
         spatial_aggregation=None,  # e.g., "mean", "max", "min"
-        metadata=None,  # metadata file path
+        metadata=None,  # metadata file path or Metadata instance
     ):
         if temporal_resolution == "hour":
             temporal_aggregation = None
@@ -40,10 +44,40 @@ class QueryExecutor(ABC):
 
         # query internal variables
         self.variable_short_name = long_short_name_dict[self.variable]
-        if metadata:
-            self.metadata = Metadata(metadata)
+        self.trace = None  # Span tree of the last traced execute(), kept per executor as queries may run concurrently
+        if isinstance(metadata, Metadata):
+            self.metadata = metadata
+        elif metadata:
+            self.metadata = load_metadata(metadata)
         else:
-            self.metadata = Metadata("metadata.csv")
+            self.metadata = load_metadata("metadata.csv")
+
+    def _trace_attrs(self):
+        """
+        Return: dict, the query parameters recorded on the executor's trace span
+        """
+        return {
+            "variable": self.variable,
+            "start_datetime": str(self.start_datetime),
+            "end_datetime": str(self.end_datetime),
+            "bbox": [self.min_lat, self.max_lat, self.min_lon, self.max_lon],
+            "temporal_resolution": self.temporal_resolution,
+            "temporal_aggregation": self.temporal_aggregation,
+            "spatial_resolution": self.spatial_resolution,
+            "spatial_aggregation": self.spatial_aggregation,
+        }
+
+    @contextlib.contextmanager
+    def _trace_span(self, **attrs):
+        """
+        Open the executor's span, named after its class; once closed, the span is kept as self.trace
+        """
+        with tracer.span(type(self).__name__, **self._trace_attrs(), **attrs) as span:
+            try:
+                yield span
+            finally:
+                if isinstance(span, Span):
+                    self.trace = span
 
     @abstractmethod
     def execute(self) -> xr.Dataset:
@@ -57,3 +91,24 @@ class QueryExecutor(ABC):
         Return: xarray.Dataset, with data variable as loaded-in-memory Numpy array
         """
         return self.execute().compute()
+
+    def _execute_blocking(self, compute):
+        ds = self.execute()
+        return cancellable_compute(ds) if compute else ds
+
+    async def execute_async(self, timeout=None, compute=True):
+        """
+        Run execute() in a worker thread, so the event loop keeps serving while files are opened and data downloaded.
+        timeout: seconds before TimeoutError is raised; on timeout or cancellation of the awaiting task the worker
+            raises QueryCancelled at its next file open, download attempt or Dask task
+        compute: also load the result in the worker thread; a lazy result blocks the thread that computes it later
+        Return: xarray.Dataset
+        """
+        token = CancelToken()
+        try:
+            return await asyncio.wait_for(
+                asyncio.to_thread(run_cancellable, token, self._execute_blocking, compute), timeout
+            )
+        except (asyncio.CancelledError, asyncio.TimeoutError):
+            token.cancel()
+            raise
@@ -1,5 +1,12 @@
+import numpy as np
+import pandas as pd
+import xarray as xr
+
 from .query_executor import QueryExecutor
 from .query_executor_heatmap import HeatmapExecutor
+from .utils.cancellation import cancellable_compute
+from .utils.filter import apply_filter, decide_by_bounds
+from .utils.tracing import tracer
 
 
 class FindAreaExecutor(QueryExecutor):
@@ -17,7 +24,7 @@ class FindAreaExecutor(QueryExecutor):
         filter_value: float,
         spatial_resolution=0.25,  # e.g., 0.25, 0.5, 1.0
         spatial_aggregation=None,  # e.g., "mean", "max", "min"
-        metadata=None,  # metadata file path
+        metadata=None,  # metadata file path or Metadata instance
     ):
         super().__init__(
             variable,
@@ -36,37 +43,113 @@ class FindAreaExecutor(QueryExecutor):
         self.filter_value = filter_value
 
     def execute(self):
+        with self._trace_span(
+            aggregation=self.heatmap_aggregation_method,
+            filter=f"{self.filter_predicate} {self.filter_value}",
+        ):
+            return self._execute_pyramid()
+
+    def execute_baseline(self):
         return self._execute_baseline()
 
-    def _execute_baseline(self):
-        heatmap_executor = HeatmapExecutor(
+    def explain(self):
+        return self._gen_heatmap_executor().explain()
+
+    def _gen_heatmap_executor(self, min_lat=None, max_lat=None, min_lon=None, max_lon=None):
+        return HeatmapExecutor(
             self.variable,
             self.start_datetime,
             self.end_datetime,
-            self.min_lat,
-            self.max_lat,
-            self.min_lon,
-            self.max_lon,
+            self.min_lat if min_lat is None else min_lat,
+            self.max_lat if max_lat is None else max_lat,
+            self.min_lon if min_lon is None else min_lon,
+            self.max_lon if max_lon is None else max_lon,
             self.heatmap_aggregation_method,
             self.spatial_resolution,
             self.spatial_aggregation,
-            metadata=self.metadata.f_path,
+            metadata=self.metadata,
         )
+
+    def _execute_baseline(self, min_lat=None, max_lat=None, min_lon=None, max_lon=None):
+        heatmap_executor = self._gen_heatmap_executor(min_lat, max_lat, min_lon, max_lon)
         hm = heatmap_executor.execute()
-        if self.filter_predicate == ">":
-            res = hm.where(hm > self.filter_value, drop=False)
-        elif self.filter_predicate == "<":
-            res = hm.where(hm < self.filter_value, drop=False)
-        elif self.filter_predicate == "==":
-            res = hm.where(hm == self.filter_value, drop=False)
-        elif self.filter_predicate == "!=":
-            res = hm.where(hm != self.filter_value, drop=False)
-        elif self.filter_predicate == ">=":
-            res = hm.where(hm >= self.filter_value, drop=False)
-        elif self.filter_predicate == "<=":
-            res = hm.where(hm <= self.filter_value, drop=False)
+        return apply_filter(hm, self.filter_predicate, self.filter_value)
+
+    def _execute_pyramid(self):
+        """
+        Optimizations heuristics:
+            The heatmap splits into whole year/month/day ranges, read from pre-aggregated rasters, and hour residuals,
+            read from raw hourly data. Every residual hour of a cell lies within the day-min / day-max of the days the
+            residual spans, so:
+            - heatmap max: [max(whole, max residual day-min), max(whole, max residual day-max)]
+            - heatmap min: [min(whole, min residual day-min), min(whole, min residual day-max)]
+            - heatmap mean: (whole weighted sum + residual hours x residual day-min / day-max) / total hours
+            Cells whose bounds settle the predicate are decided without the hourly data; the undetermined cells,
+            as a spatial mask, are computed exactly from the hourly data over their bounding box only.
+        """
+        heatmap_executor = self._gen_heatmap_executor()
+        executors, hours = heatmap_executor._get_sub_executors()
+        whole = [(e, h) for e, h in zip(executors, hours) if e.temporal_resolution != "hour"]
+        residual = [(e, h) for e, h in zip(executors, hours) if e.temporal_resolution == "hour"]
+        if not residual:
+            # pre-aggregated rasters alone give the exact heatmap
+            return self._execute_baseline()
+
+        bound_executors = []
+        for executor, _ in residual:
+            first_day = pd.Timestamp(executor.start_datetime).normalize()
+            last_day = pd.Timestamp(executor.end_datetime).normalize()
+            for aggregation in ("min", "max"):
+                bound_executors.append(
+                    heatmap_executor._gen_raster_executor(
+                        first_day, last_day + pd.Timedelta(hours=23), "day", aggregation
+                    )
+                )
+        ds_list = heatmap_executor._execute_all([e for e, _ in whole] + bound_executors)
+        whole_list = [ds[self.variable_short_name] for ds in ds_list[: len(whole)]]
+        residual_min = [ds[self.variable_short_name].min(dim="valid_time") for ds in ds_list[len(whole) :: 2]]
+        residual_max = [ds[self.variable_short_name].max(dim="valid_time") for ds in ds_list[len(whole) + 1 :: 2]]
+
+        if self.heatmap_aggregation_method == "max":
+            lower = xr.concat(residual_min, dim="residual").max(dim="residual")
+            upper = xr.concat(residual_max, dim="residual").max(dim="residual")
+            if whole_list:
+                whole_max = xr.concat(whole_list, dim="valid_time").max(dim="valid_time")
+                lower, upper = np.fmax(whole_max, lower), np.fmax(whole_max, upper)
+        elif self.heatmap_aggregation_method == "min":
+            lower = xr.concat(residual_min, dim="residual").min(dim="residual")
+            upper = xr.concat(residual_max, dim="residual").min(dim="residual")
+            if whole_list:
+                whole_min = xr.concat(whole_list, dim="valid_time").min(dim="valid_time")
+                lower, upper = np.fmin(whole_min, lower), np.fmin(whole_min, upper)
+        elif self.heatmap_aggregation_method == "mean":
+            total_hours = sum(sum(h) for h in hours)
+            residual_hours = [sum(h) for _, h in residual]
+            lower = sum(n * da for n, da in zip(residual_hours, residual_min))
+            upper = sum(n * da for n, da in zip(residual_hours, residual_max))
+            for da, (_, h) in zip(whole_list, whole):
+                weighted = (da * xr.DataArray(np.array(h, dtype="float64"), dims="valid_time")).sum(dim="valid_time")
+                lower, upper = lower + weighted, upper + weighted
+            lower, upper = lower / total_hours, upper / total_hours
         else:
-            raise ValueError("Invalid filter_predicate")
-        res = res.fillna(False)
-        res = res.astype(bool)
+            raise ValueError("Invalid heatmap_aggregation_method")
+
+        with tracer.span("bounds", "compute") as span:
+            lower, upper = cancellable_compute(lower), cancellable_compute(upper)
+            is_true, is_false = decide_by_bounds(self.filter_predicate, self.filter_value, lower.values, upper.values)
+            undetermined = ~(is_true | is_false)
+            span.set(true=int(is_true.sum()), false=int(is_false.sum()), undetermined=int(undetermined.sum()))
+        tracer.log(f"cells: {is_true.sum()} True, {is_false.sum()} False, {undetermined.sum()} undetermined")
+        res = xr.Dataset(
+            {self.variable_short_name: (["latitude", "longitude"], is_true)},
+            coords={"latitude": lower.latitude, "longitude": lower.longitude},
+        )
+        if not undetermined.any():
+            return res
+
+        lat = lower.latitude.values[undetermined.any(axis=1)]
+        lon = lower.longitude.values[undetermined.any(axis=0)]
+        exact = self._execute_baseline(lat.min(), lat.max(), lon.min(), lon.max())
+        exact = exact[self.variable_short_name].reindex_like(res, fill_value=False)
+        res[self.variable_short_name] = res[self.variable_short_name].where(~undetermined, exact)
         return res
@@ -1,10 +1,22 @@
+import numpy as np
 import pandas as pd
 import xarray as xr
 
 from .query_executor import QueryExecutor
-from .query_executor_get_raster import GetRasterExecutor
-from .query_executor_timeseries import TimeseriesExecutor
-from .utils.get_whole_period import get_whole_period_between, get_last_date_of_month, time_array_to_range
+from .query_executor_get_raster import GetRasterExecutor, coarsen_to_grid
+from .query_executor_timeseries import TimeseriesExecutor, aggregate_area
+from .query_planner import QueryPlanner
+from .utils.cancellation import cancellable_compute, check_cancelled
+from .utils.filter import apply_filter, decide_by_bounds
+from .utils.get_whole_period import (
+    get_whole_period_between,
+    get_last_date_of_month,
+    get_period_bounds,
+    mark_periods,
+    mask_to_index_ranges,
+    time_array_to_range,
+)
+from .utils.tracing import tracer
 
 
 class FindTimeExecutor(QueryExecutor):
@@ -24,7 +36,7 @@ class FindTimeExecutor(QueryExecutor):
         filter_value: float,
         spatial_resolution=1.0,  # e.g., 0.25, 0.5, 1.0
         spatial_aggregation="mean",  # e.g., "mean", "max", "min"
-        metadata=None,  # metadata file path
+        metadata=None,  # metadata file path or Metadata instance
     ):
         super().__init__(
             variable,
@@ -45,9 +57,13 @@ class FindTimeExecutor(QueryExecutor):
         self.filter_value = filter_value
 
     def execute(self):
-        if self.temporal_resolution == "hour" and self.filter_predicate != "!=":
-            return self._execute_pyramid_hour()
-        return self._execute_baseline()
+        with self._trace_span(
+            aggregation=self.time_series_aggregation_method,
+            filter=f"{self.filter_predicate} {self.filter_value}",
+        ):
+            if self.temporal_resolution == "hour" and self.filter_predicate != "!=":
+                return self._execute_pyramid_hour()
+            return self._execute_baseline()
 
     def execute_baseline(self):
         return self._execute_baseline()
@@ -70,26 +86,35 @@ class FindTimeExecutor(QueryExecutor):
             self.time_series_aggregation_method,
             spatial_resolution=self.spatial_resolution,
             spatial_aggregation=self.spatial_aggregation,
-            metadata=self.metadata.f_path,
+            metadata=self.metadata,
         )
         ts = timeseries_executor.execute()
-        if self.filter_predicate == ">":
-            res = ts.where(ts > self.filter_value, drop=False)
-        elif self.filter_predicate == "<":
-            res = ts.where(ts < self.filter_value, drop=False)
-        elif self.filter_predicate == "==":
-            res = ts.where(ts == self.filter_value, drop=False)
-        elif self.filter_predicate == "!=":
-            res = ts.where(ts != self.filter_value, drop=False)
-        elif self.filter_predicate == ">=":
-            res = ts.where(ts >= self.filter_value, drop=False)
-        elif self.filter_predicate == "<=":
-            res = ts.where(ts <= self.filter_value, drop=False)
-        else:
-            raise ValueError("Invalid filter_predicate")
-        res = res.fillna(False)
-        res = res.astype(bool)
-        return res
+        return apply_filter(ts, self.filter_predicate, self.filter_value)
+
+    def _execute_hours(self, hours):
+        """
+        hours: sorted hourly time points, possibly spread over many disjoint ranges
+        Return: baseline result at exactly those hours, from one raster read selecting them and one reduction
+        """
+        get_raster_executor = GetRasterExecutor(
+            variable=self.variable,
+            start_datetime=str(pd.Timestamp(hours[0])),
+            end_datetime=str(pd.Timestamp(hours[-1])),
+            min_lat=self.min_lat,
+            max_lat=self.max_lat,
+            min_lon=self.min_lon,
+            max_lon=self.max_lon,
+            temporal_resolution="hour",
+            spatial_resolution=self.spatial_resolution,
+            spatial_aggregation=self.spatial_aggregation,
+            metadata=self.metadata,
+            time_points=hours,
+        )
+        raster = get_raster_executor.execute()
+        if raster.sizes["valid_time"] != len(hours):
+            raise ValueError("Hourly data missing for undetermined time points")
+        ts = aggregate_area(raster, self.time_series_aggregation_method)
+        return apply_filter(ts, self.filter_predicate, self.filter_value)
 
     def _execute_pyramid_hour(self):
         """
@@ -99,129 +124,160 @@ class FindTimeExecutor(QueryExecutor):
             - find hour == x: if year-min >  x, return False; if year-max <  x, return False
             - find hour >= x: if year-min >= x, return True ; if year-max <  x, return False
             - find hour <= x: if year-min >  x, return False; if year-max <= x, return True
+        year-min / year-max are the time series aggregation over the area of the per-cell year min / max raster,
+        i.e. the same spatial pipeline as the hourly series: 0.25 degree rasters read with the coarse cells' margin
+        and coarsened on the global grid (coarsen_to_grid). Coarsening windows are then the series' own, and
+        mean/max/min are monotone, so they bound every hour of the year and are tighter than the plain area
+        min / max for "mean".
+        Each pyramid level is decided for all of its periods at once and written to the hourly result as one mask.
         """
         years, months, days, hours = get_whole_period_between(self.start_datetime, self.end_datetime)
-        # year_range, month_range, day_range, hour_range = get_whole_ranges_between(
-        #     self.start_datetime, self.end_datetime
-        # )
-        time_points = pd.date_range(start=self.start_datetime, end=self.end_datetime, freq="h")
-        result = xr.Dataset(
-            data_vars={self.variable_short_name: (["valid_time"], [None] * len(time_points))},
-            coords=dict(valid_time=time_points),
-        )
+        time_points = pd.date_range(start=self.start_datetime, end=self.end_datetime, freq="h").values
+        # -1: undetermined, 0: False, 1: True
+        state = np.full(len(time_points), -1, dtype=np.int8)
+        planner = self._gen_planner()
 
+        years, missing = self._split_local(planner, years, "year")
+        months = months + self._expand_years(missing)
         if years:
-            year_range = time_array_to_range(years, "year")
-            year_min, year_max = self._get_range_min_max(year_range, "year")
-            for year in years:
-                year_determined = False
-                year_datetime = f"{year}-12-31 00:00:00"
-                curr_year_min = year_min.sel(valid_time=year_datetime)[self.variable_short_name].values.min()
-                curr_year_max = year_max.sel(valid_time=year_datetime)[self.variable_short_name].values.max()
-                if self.filter_predicate == ">":
-                    if curr_year_min > self.filter_value:
-                        print(f"{year}: min > filter, True")
-                        year_determined = True
-                        result[self.variable_short_name].loc[str(year) : str(year)] = True
-                    elif curr_year_max <= self.filter_value:
-                        print(f"{year}: max <= filter, False")
-                        year_determined = True
-                        result[self.variable_short_name].loc[str(year) : str(year)] = False
-                elif self.filter_predicate == "<":
-                    if curr_year_min >= self.filter_value:
-                        print(f"{year}: min >= filter, False")
-                        year_determined = True
-                        result[self.variable_short_name].loc[str(year) : str(year)] = False
-                    elif curr_year_max < self.filter_value:
-                        print(f"{year}: max < filter, True")
-                        year_determined = True
-                        result[self.variable_short_name].loc[str(year) : str(year)] = True
-                elif self.filter_predicate == "==":
-                    if curr_year_min > self.filter_value or curr_year_max < self.filter_value:
-                        print(f"{year}: min > filter or max < filter, False")
-                        year_determined = True
-                        result[self.variable_short_name].loc[str(year) : str(year)] = False
-                if not year_determined:
-                    # add months to months
-                    months = months + [f"{year}-{month:02d}" for month in range(1, 13)]
+            undetermined = self._prune_level(state, time_points, time_array_to_range(years, "year"), "year")
+            months = months + self._expand_years(undetermined)
 
+        months, missing = self._split_local(planner, months, "month")
+        days = days + self._expand_months(missing)
         if months:
-            # update month_range
-            month_range = time_array_to_range(months, "month")
-            month_min, month_max = self._get_range_min_max(month_range, "month")
-            for month in months:
-                month_determined = False
-                month_datetime = f"{month}-{get_last_date_of_month(pd.Timestamp(month))} 00:00:00"
-                curr_month_min = month_min.sel(valid_time=month_datetime)[self.variable_short_name].values.min()
-                curr_month_max = month_max.sel(valid_time=month_datetime)[self.variable_short_name].values.max()
-                if self.filter_predicate == ">":
-                    if curr_month_min > self.filter_value:
-                        print(f"{month}: min > filter, True")
-                        month_determined = True
-                        result[self.variable_short_name].loc[month:month] = True
-                    elif curr_month_max <= self.filter_value:
-                        print(f"{month}: max <= filter, False")
-                        month_determined = True
-                        result[self.variable_short_name].loc[month:month] = False
-                elif self.filter_predicate == "<":
-                    if curr_month_min >= self.filter_value:
-                        print(f"{month}: min >= filter, False")
-                        month_determined = True
-                        result[self.variable_short_name].loc[month:month] = False
-                    elif curr_month_max < self.filter_value:
-                        print(f"{month}: max < filter, True")
-                        month_determined = True
-                        result[self.variable_short_name].loc[month:month] = True
-                elif self.filter_predicate == "==":
-                    if curr_month_min > self.filter_value or curr_month_max < self.filter_value:
-                        print(f"{month}: min > filter or max < filter, False")
-                        month_determined = True
-                        result[self.variable_short_name].loc[month:month] = False
-                if not month_determined:
-                    # add days to days
-                    days = days + [
-                        f"{month}-{day:02d}" for day in range(1, get_last_date_of_month(pd.Timestamp(month)) + 1)
-                    ]
+            undetermined = self._prune_level(state, time_points, time_array_to_range(months, "month"), "month")
+            days = days + self._expand_months(undetermined)
 
+        # days missing from the catalog are left undetermined and read hourly
+        days, _ = self._split_local(planner, days, "day")
         if days:
-            day_range = time_array_to_range(days, "day")
-            day_min, day_max = self._get_range_min_max(day_range, "day")
-            for day in days:
-                day_datetime = f"{day} 00:00:00"
-                curr_day_min = day_min.sel(valid_time=day_datetime)[self.variable_short_name].values.min()
-                curr_day_max = day_max.sel(valid_time=day_datetime)[self.variable_short_name].values.max()
-                if self.filter_predicate == ">":
-                    if curr_day_min > self.filter_value:
-                        print(f"{day}: min > filter, True")
-                        result[self.variable_short_name].loc[day:day] = True
-                    elif curr_day_max <= self.filter_value:
-                        print(f"{day}: max <= filter, False")
-                        result[self.variable_short_name].loc[day:day] = False
-                elif self.filter_predicate == "<":
-                    if curr_day_min >= self.filter_value:
-                        print(f"{day}: min >= filter, False")
-                        result[self.variable_short_name].loc[day:day] = False
-                    elif curr_day_max < self.filter_value:
-                        print(f"{day}: max < filter, True")
-                        result[self.variable_short_name].loc[day:day] = True
-                elif self.filter_predicate == "==":
-                    if curr_day_min > self.filter_value or curr_day_max < self.filter_value:
-                        print(f"{day}: min > filter or max < filter, False")
-                        result[self.variable_short_name].loc[day:day] = False
+            self._prune_level(state, time_points, time_array_to_range(days, "day"), "day")
+
+        undetermined = state == -1
+        if undetermined.any():
+            for start, end in mask_to_index_ranges(undetermined):
+                tracer.log("Check hour: ", pd.Timestamp(time_points[start]), pd.Timestamp(time_points[end]))
+            with tracer.span("check_hours", "compute", hours=int(undetermined.sum())):
+                rest = self._execute_hours(time_points[undetermined])
+            state[undetermined] = cancellable_compute(rest[self.variable_short_name]).values
+
+        return xr.Dataset(
+            data_vars={self.variable_short_name: (["valid_time"], state.astype(bool))},
+            coords=dict(valid_time=time_points),
+        )
+
+    def explain(self):
+        """
+        Return: str, the whole periods each pyramid level is read for before any pruning, and those pushed down a level
+        because the catalog does not hold their min / max
+        """
+        if not (self.temporal_resolution == "hour" and self.filter_predicate != "!="):
+            return "baseline: filtered time series of the whole range"
+        years, months, days, _ = get_whole_period_between(self.start_datetime, self.end_datetime)
+        planner = self._gen_planner()
+        lines = []
+        years, missing = self._split_local(planner, years, "year")
+        lines += self._explain_level("year", years, missing, "month")
+        months, missing = self._split_local(planner, months + self._expand_years(missing), "month")
+        lines += self._explain_level("month", months, missing, "day")
+        days, missing = self._split_local(planner, days + self._expand_months(missing), "day")
+        lines += self._explain_level("day", days, missing, "hour")
+        return "\n".join(lines)
 
-        result_undetermined = result["valid_time"].where(result[self.variable_short_name].isnull(), drop=True)
-        if result_undetermined.size > 0:
-            hour_range = time_array_to_range(result_undetermined.values, "hour")
-            for start, end in hour_range:
-                start = start.strftime("%Y-%m-%d %H:%M:%S")
-                end = end.strftime("%Y-%m-%d %H:%M:%S")
-                print("Check hour: ", start, end)
-                rest = self._execute_baseline(start_datetime=start, end_datetime=end)
-                result[self.variable_short_name].loc[f"{start}":f"{end}"] = rest[self.variable_short_name]
-        result[self.variable_short_name] = result[self.variable_short_name].astype(bool)
-        return result
+    @staticmethod
+    def _explain_level(temporal_res, labels, missing, finer_res):
+        lines = [
+            f"{temporal_res:<5} {start:%Y-%m-%d %H:%M} - {end:%Y-%m-%d %H:%M}  min/max"
+            for start, end in time_array_to_range(labels, temporal_res)
+        ]
+        if missing:
+            lines.append(f"{temporal_res:<5} {len(missing)} periods not in the catalog, checked by {finer_res}")
+        return lines
+
+    def _gen_planner(self):
+        # _get_range_min_max reads the min / max rasters at 0.25 degree, over the bbox padded by _bounds_margin
+        margin = self._bounds_margin()
+        return QueryPlanner(
+            self.metadata,
+            self.variable,
+            self.start_datetime,
+            self.end_datetime,
+            self.min_lat - margin,
+            self.max_lat + margin,
+            self.min_lon - margin,
+            self.max_lon + margin,
+        )
+
+    @staticmethod
+    def _split_local(planner, labels, temporal_res):
+        """
+        labels: whole periods, e.g. 2020, "2020-01", "2020-01-01", or pd.Timestamp
+        Return: [labels whose min and max rasters are in the catalog], [pd.Timestamp of the other periods' starts]
+        """
+        if not labels:
+            return [], []
+        starts = [pd.Timestamp(f"{label}-01-01") if temporal_res == "year" else pd.Timestamp(label) for label in labels]
+        period_starts, period_ends = get_period_bounds(starts, temporal_res)
+        local = []
+        missing = []
+        for label, start, end in zip(labels, period_starts, period_ends):
+            if all(
+                planner.local_source(temporal_res, aggregation, pd.Timestamp(start), pd.Timestamp(end)) is not None
+                for aggregation in ("min", "max")
+            ):
+                local.append(label)
+            else:
+                missing.append(pd.Timestamp(start))
+        return local, missing
+
+    @staticmethod
+    def _expand_years(labels):
+        return [f"{label.year}-{month:02d}" for label in labels for month in range(1, 13)]
+
+    @staticmethod
+    def _expand_months(labels):
+        return [
+            f"{label.year}-{label.month:02d}-{day:02d}"
+            for label in labels
+            for day in range(1, get_last_date_of_month(label) + 1)
+        ]
+
+    def _prune_level(self, state, time_points, _range, temporal_res):
+        """
+        Decide every period of one pyramid level with array comparisons and write the decided ones into state.
+        Return: pd.DatetimeIndex, labels of the periods left undetermined
+        """
+        check_cancelled()
+        with tracer.span(f"prune_{temporal_res}", "compute", ranges=len(_range)) as span:
+            range_min, range_max = self._get_range_min_max(_range, temporal_res)
+            period_min = self._reduce_area(range_min)
+            period_max = self._reduce_area(range_max)
+            is_true, is_false = decide_by_bounds(self.filter_predicate, self.filter_value, period_min, period_max)
+            labels = range_min.indexes["valid_time"]
+            period_starts, period_ends = get_period_bounds(labels, temporal_res)
+            state[mark_periods(time_points, period_starts, period_ends, is_true)] = 1
+            state[mark_periods(time_points, period_starts, period_ends, is_false)] = 0
+            span.set(periods=len(labels), true=int(is_true.sum()), false=int(is_false.sum()))
+        tracer.log(f"{temporal_res}: {is_true.sum()} True, {is_false.sum()} False, {len(labels)} periods")
+        return labels[~(is_true | is_false)]
+
+    def _bounds_margin(self):
+        # half a coarse cell less half a 0.25 degree cell: the raw points around the coarse cells of the bbox
+        return max(self.spatial_resolution - 0.25, 0) / 2
+
+    def _reduce_area(self, ds):
+        """
+        ds: per-period 0.25 degree raster of the bbox padded by _bounds_margin
+        Return: np.ndarray, the hourly series' spatial pipeline applied to a per-period raster
+        """
+        ds = coarsen_to_grid(ds, self.spatial_resolution, self.spatial_aggregation)
+        ds = ds.sel(latitude=slice(self.max_lat, self.min_lat), longitude=slice(self.min_lon, self.max_lon))
+        series = aggregate_area(ds[self.variable_short_name], self.time_series_aggregation_method)
+        return cancellable_compute(series).values
 
     def _get_range_min_max(self, _range, temporal_res):
+        margin = self._bounds_margin()
         ds_min = []
         ds_max = []
         for start, end in _range:
@@ -229,25 +285,25 @@ class FindTimeExecutor(QueryExecutor):
                 variable=self.variable,
                 start_datetime=start,
                 end_datetime=end,
-                min_lat=self.min_lat,
-                max_lat=self.max_lat,
-                min_lon=self.min_lon,
-                max_lon=self.max_lon,
+                min_lat=self.min_lat - margin,
+                max_lat=self.max_lat + margin,
+                min_lon=self.min_lon - margin,
+                max_lon=self.max_lon + margin,
                 temporal_resolution=temporal_res,
                 temporal_aggregation="min",
-                metadata=self.metadata.f_path,
+                metadata=self.metadata,
             )
             get_max_executor = GetRasterExecutor(
                 variable=self.variable,
                 start_datetime=start,
                 end_datetime=end,
-                min_lat=self.min_lat,
-                max_lat=self.max_lat,
-                min_lon=self.min_lon,
-                max_lon=self.max_lon,
+                min_lat=self.min_lat - margin,
+                max_lat=self.max_lat + margin,
+                min_lon=self.min_lon - margin,
+                max_lon=self.max_lon + margin,
                 temporal_resolution=temporal_res,
                 temporal_aggregation="max",
-                metadata=self.metadata.f_path,
+                metadata=self.metadata,
             )
             range_min = get_min_executor.execute()
             range_max = get_max_executor.execute()
@@ -255,4 +311,4 @@ class FindTimeExecutor(QueryExecutor):
             ds_max.append(range_max)
         ds_min_concat = xr.concat(ds_min, dim="valid_time")
         ds_max_concat = xr.concat(ds_max, dim="valid_time")
-        return ds_min_concat.compute(), ds_max_concat.compute()
+        return cancellable_compute(ds_min_concat), cancellable_compute(ds_max_concat)
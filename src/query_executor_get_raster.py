@@ -1,11 +1,170 @@
-from datetime import datetime
-import math
-import cdsapi
+import os
+import numpy as np
 import pandas as pd
 import xarray as xr
 
+from .metadata import LeftoverBox, gen_query_axes, subtract_box
 from .query_executor import QueryExecutor
-from .utils.const import time_resolution_to_freq
+from .utils.const import get_lat_lon_range, time_resolution_to_freq
+from .utils.cancellation import cancellable_compute, check_cancelled
+from .utils.cds_downloader import cds_downloader
+from .utils.dataset_pool import dataset_pool
+from .utils.get_whole_period import get_period_bounds, get_time_products
+from .utils.raster_cache import raster_cache
+from .utils.tracing import tracer
+
+
+def temporal_resample(ds, temporal_resolution, temporal_aggregation):
+    """
+    Resample hourly data to temporal_resolution; no-op for "hour"
+    """
+    if temporal_resolution == "hour":
+        return ds
+    resampled = ds.resample(valid_time=time_resolution_to_freq(temporal_resolution))
+    if temporal_aggregation == "mean":
+        return resampled.mean()
+    elif temporal_aggregation == "max":
+        return resampled.max()
+    elif temporal_aggregation == "min":
+        return resampled.min()
+    else:
+        raise ValueError("Invalid temporal_aggregation")
+
+
+def spatial_coarsen(ds, spatial_resolution, spatial_aggregation, source_resolution=0.25):
+    """
+    Coarsen source_resolution data to spatial_resolution, windows start at the first grid point of ds;
+    no-op when the resolutions match
+    """
+    if spatial_resolution <= source_resolution:
+        return ds
+    c_f = int(spatial_resolution / source_resolution)
+    coarsened = ds.coarsen(latitude=c_f, longitude=c_f, boundary="trim")
+    if spatial_aggregation == "mean":
+        return coarsened.mean()
+    elif spatial_aggregation == "max":
+        return coarsened.max()
+    elif spatial_aggregation == "min":
+        return coarsened.min()
+    else:
+        raise ValueError("Invalid spatial_aggregation")
+
+
+def coarsen_to_grid(ds, spatial_resolution, spatial_aggregation, source_resolution=0.25):
+    """
+    Coarsen source_resolution data with windows on the global spatial_resolution grid of get_lat_lon_range,
+    dropping edge cells whose window is not complete in ds; coordinates are snapped to that grid
+    """
+    if spatial_resolution <= source_resolution:
+        return ds
+    c_f = int(spatial_resolution / source_resolution)
+    source_lat_range, source_lon_range, _ = get_lat_lon_range(source_resolution)
+    for dim, origin in (("latitude", source_lat_range[0]), ("longitude", source_lon_range[0])):
+        block = np.rint((ds[dim].values - origin) / source_resolution).astype(int) // c_f
+        blocks, counts = np.unique(block, return_counts=True)
+        ds = ds.isel({dim: np.isin(block, blocks[counts == c_f])})
+    ds = spatial_coarsen(ds, spatial_resolution, spatial_aggregation, source_resolution)
+    lat_range, lon_range, _ = get_lat_lon_range(spatial_resolution)
+    return ds.assign_coords(
+        latitude=lat_range[np.abs(lat_range[None, :] - ds.latitude.values[:, None]).argmin(axis=1)],
+        longitude=lon_range[np.abs(lon_range[None, :] - ds.longitude.values[:, None]).argmin(axis=1)],
+    )
+
+
+def concat_in_time(parts):
+    """
+    Concatenate parts on one grid in time order without alignment; time steps an earlier part already holds are
+    dropped, as catalog files may overlap in time. Parts are not assumed contiguous, a part may have gaps that
+    other parts fill.
+    """
+    parts = [part for part in parts if part.sizes["valid_time"] > 0] or parts[:1]
+    parts = sorted(parts, key=lambda part: part.indexes["valid_time"][0] if part.sizes["valid_time"] else pd.NaT)
+    stitched = parts[:1]
+    held = parts[0].indexes["valid_time"]
+    for part in parts[1:]:
+        valid_time = part.indexes["valid_time"]
+        new = ~valid_time.isin(held)
+        if not new.any():
+            continue
+        if not new.all():
+            part = part.isel(valid_time=np.flatnonzero(new))
+        stitched.append(part)
+        held = held.append(part.indexes["valid_time"])
+    if len(stitched) == 1:
+        return stitched[0]
+    ds = xr.concat(
+        stitched, dim="valid_time", data_vars="minimal", coords="minimal", compat="override", join="override"
+    )
+    if not ds.indexes["valid_time"].is_monotonic_increasing:
+        ds = ds.sortby("valid_time")
+    return ds
+
+
+def assemble_parts(ds_list):
+    """
+    Return: one raster from the parts read for a query; parts on the same grid are concatenated in time,
+    only parts on different grids (tiles next to or overlapping each other) are merged
+    """
+    grids = {}
+    for ds in ds_list:
+        grid = tuple(np.round(ds[dim].values.astype("float64"), 6).tobytes() for dim in ("latitude", "longitude"))
+        grids.setdefault(grid, []).append(ds)
+    stitched = [concat_in_time(parts) for parts in grids.values()]
+    if len(stitched) == 1:
+        return stitched[0]
+    # compat="override" is a temporal walkaround as pre-aggregation value conflicts with downloaded data
+    # materialized files are written unpacked as float32 (Metadata.materialize), so they merge without conflict
+    # the outer join sorts latitude ascending, ERA5 files and the selections on the result are descending
+    try:
+        ds = xr.merge(stitched, compat="no_conflicts", join="outer")
+    except ValueError:
+        tracer.log("WARNING: conflict in merging data, use override")
+        ds = xr.merge(stitched, compat="override", join="outer")
+    return ds.sortby("latitude", ascending=False)
+
+
+HOURS_PER_STEP = {"hour": 1, "day": 24, "month": 730, "year": 8760}
+
+
+def derivation_levels(temporal_resolution, temporal_aggregation, spatial_resolution, spatial_aggregation):
+    """
+    Return: [(temporal_resolution, temporal_aggregation, spatial_resolution, spatial_aggregation)] of finer levels
+    the requested level can be computed from exactly, nearest (fewest values to read) first
+    """
+    levels = []
+    for source_temporal_resolution in ("hour", "day", "month", "year"):
+        if HOURS_PER_STEP[source_temporal_resolution] > HOURS_PER_STEP[temporal_resolution]:
+            break
+        for source_spatial_resolution in (0.25, 0.5, 1.0):
+            if source_spatial_resolution > spatial_resolution:
+                break
+            temporal_step = source_temporal_resolution != temporal_resolution
+            spatial_step = source_spatial_resolution != spatial_resolution
+            if not temporal_step and not spatial_step:
+                continue
+            if source_temporal_resolution == "hour":
+                source_temporal_aggregation = None
+            elif temporal_step and temporal_aggregation == "mean" and source_temporal_resolution != "day":
+                # months and years hold unequal numbers of hours, so their means do not average to the coarser mean
+                continue
+            else:
+                source_temporal_aggregation = temporal_aggregation
+            if source_spatial_resolution == 0.25:
+                source_spatial_aggregation = None
+            elif temporal_step and spatial_aggregation != temporal_aggregation:
+                # resampling in time commutes with the spatial aggregation only when both are the same reduction
+                continue
+            else:
+                source_spatial_aggregation = spatial_aggregation
+            levels.append(
+                (
+                    source_temporal_resolution,
+                    source_temporal_aggregation,
+                    source_spatial_resolution,
+                    source_spatial_aggregation,
+                )
+            )
+    return sorted(levels, key=lambda level: -HOURS_PER_STEP[level[0]] * (level[2] / 0.25) ** 2)
 
 
 class GetRasterExecutor(QueryExecutor):
@@ -22,7 +181,9 @@ class GetRasterExecutor(QueryExecutor):
         temporal_aggregation=None,  # e.g., "mean", "max", "min"
         spatial_resolution=0.25,  # e.g., 0.25, 0.5, 1.0
         spatial_aggregation=None,  # e.g., "mean", "max", "min"
-        metadata=None,  # metadata file path
+        metadata=None,  # metadata file path or Metadata instance
+        time_points=None,  # optional subset of valid_time to return, e.g. disjoint ranges within the window
+        downloader=None,  # CDSDownloader for leftover data, default the shared cds_downloader
     ):
         super().__init__(
             variable,
@@ -38,14 +199,272 @@ class GetRasterExecutor(QueryExecutor):
             spatial_aggregation,
             metadata=metadata,
         )
+        self.time_points = None if time_points is None else pd.DatetimeIndex(time_points)
+        self.downloader = cds_downloader if downloader is None else downloader
+
+    def _select_time_points(self, ds):
+        if self.time_points is None:
+            return ds
+        positions = ds.indexes["valid_time"].get_indexer(self.time_points)
+        positions = positions[positions >= 0]
+        if len(positions) == 0:
+            return ds.isel(valid_time=slice(0, 0))
+        if ds.chunks:
+            # Dask selects the positions chunk by chunk, so only chunks holding requested time steps are read
+            return ds.isel(valid_time=positions)
+        # slice each consecutive run on the lazily-indexed file, so only the requested time steps are read
+        runs = np.split(positions, np.flatnonzero(np.diff(positions) != 1) + 1)
+        return xr.concat([ds.isel(valid_time=slice(run[0], run[-1] + 1)) for run in runs], dim="valid_time")
+
+    @staticmethod
+    def _is_gap_free_hourly(valid_time):
+        if len(valid_time) == 0:
+            return False
+        expected = int((valid_time[-1] - valid_time[0]) / pd.Timedelta(hours=1)) + 1
+        return valid_time.is_monotonic_increasing and len(valid_time) == expected
+
+    def _materialize_download(self, ds):
+        # the raw download is registered as hourly 0.25 data; only gap-free hourly series are safe to register
+        valid_time = ds.indexes["valid_time"]
+        if not self._is_gap_free_hourly(valid_time):
+            return
+        self.metadata.materialize(ds, self.variable, valid_time[0], valid_time[-1], "hour", None, 0.25, None)
+
+    def _materialize_aggregate(self, ds, ds_hour):
+        """
+        ds: ds_hour resampled / coarsened for this query; edge periods only partly covered by ds_hour are not persisted,
+        nor is anything computed from hourly data with gaps
+        """
+        if not self._is_gap_free_hourly(ds_hour.indexes["valid_time"]):
+            return
+        hour_start, hour_end = ds_hour.indexes["valid_time"][[0, -1]]
+        if self.temporal_resolution != "hour":
+            period_starts, period_ends = get_period_bounds(ds.indexes["valid_time"], self.temporal_resolution)
+            complete = (period_starts >= hour_start) & (period_ends <= hour_end)
+            if not complete.any():
+                return
+            ds = ds.isel(valid_time=complete)
+            start_datetime, end_datetime = period_starts[complete][0], period_ends[complete][-1]
+        else:
+            start_datetime, end_datetime = hour_start, hour_end
+        self.metadata.materialize(
+            ds,
+            self.variable,
+            start_datetime,
+            end_datetime,
+            self.temporal_resolution,
+            self.temporal_aggregation,
+            self.spatial_resolution,
+            self.spatial_aggregation,
+        )
+
+    def _gen_api_calls(self, leftover):
+        """
+        Return: [(dataset, request)] exactly covering the hourly 0.25 degree data the leftover boxes are computed from:
+        per box, a partial first day, whole days per month (or year, per the downloader's split), a partial last day
+        """
+        if self.downloader.split not in ("month", "year"):
+            raise ValueError("Invalid download split")
+        margin = (self.spatial_resolution - 0.25) / 2
+        api_calls = []
+        for box in leftover:
+            hour_start, hour_end = self._hour_window(box)
+            area = [box.max_lat + margin, box.min_lon - margin, box.min_lat - margin, box.max_lon + margin]
+            for year, months, days, hours in get_time_products(hour_start, hour_end, self.downloader.split):
+                request = {
+                    "product_type": ["reanalysis"],
+                    "variable": [self.variable],
+                    "year": [str(year)],
+                    "month": [f"{month:02d}" for month in months],
+                    "day": [f"{day:02d}" for day in days],
+                    "time": [f"{hour:02d}:00" for hour in hours],
+                    "data_format": "netcdf",
+                    "download_format": "unarchived",
+                    "area": area,
+                }
+                api_calls.append(("reanalysis-era5-single-levels", request))
+        return api_calls
+
+    def _hour_window(self, box):
+        """
+        Return: first hour, last hour of the hourly data aggregated into the box's time steps; like a local file of
+        the level, a step aggregates its whole period, also hours outside the query
+        """
+        if self.temporal_resolution == "hour":
+            return box.start_datetime, box.end_datetime
+        period_starts, period_ends = get_period_bounds([box.start_datetime, box.end_datetime], self.temporal_resolution)
+        return pd.Timestamp(period_starts[0]), pd.Timestamp(period_ends[-1])
+
+    def _trim_leftover(self, leftover):
+        """
+        Return: leftover boxes without the time steps whose label is before the query start, e.g. the first day of a
+        query starting mid-day; local files of the level do not return them either
+        """
+        if self.temporal_resolution == "hour":
+            return leftover
+        trimmed = []
+        for box in leftover:
+            if box.start_datetime.normalize() < pd.Timestamp(self.start_datetime):
+                if box.start_datetime == box.end_datetime:
+                    continue
+                labels = pd.date_range(
+                    box.start_datetime, periods=2, freq=time_resolution_to_freq(self.temporal_resolution)
+                )
+                box = box._replace(start_datetime=labels[1])
+            trimmed.append(box)
+        return trimmed
+
+    def _label_window(self, box):
+        """
+        Return: first, last valid_time label of the box's time steps in resampled data. The box's labels carry the
+        time of day of the query start, resampled day / month / year labels are at midnight.
+        """
+        if self.temporal_resolution == "hour":
+            return box.start_datetime, box.end_datetime
+        return box.start_datetime.normalize(), box.end_datetime
+
+    def _split_by_source(self, box, level):
+        """
+        Split a leftover box by the coverage of the finer level's local data: a time step / grid cell is covered when
+        every source value it aggregates is local.
+        Return: [(covered box, source files)], [uncovered boxes]
+        """
+        source_temporal_resolution, _, source_spatial_resolution, _ = level
+        time_range, lat_range, lon_range = gen_query_axes(
+            box.min_lat,
+            box.max_lat,
+            box.min_lon,
+            box.max_lon,
+            box.start_datetime,
+            box.end_datetime,
+            self.temporal_resolution,
+            self.spatial_resolution,
+        )
+        # first / last hour of the whole period each time step of the box aggregates, a coarser source's periods
+        # never straddle them
+        if self.temporal_resolution == "hour":
+            starts = ends = time_range
+        else:
+            starts, ends = get_period_bounds(time_range, self.temporal_resolution)
+        window_start, window_end = starts[0], ends[-1]
+        full = (0, len(time_range), 0, len(lat_range), 0, len(lon_range))
+        uncovered = []
+        margin = (self.spatial_resolution - source_spatial_resolution) / 2
+        _, source_leftover = self.metadata.query_get_overlap_and_leftover(
+            self.variable,
+            window_start,
+            window_end,
+            box.min_lat - margin,
+            box.max_lat + margin,
+            box.min_lon - margin,
+            box.max_lon + margin,
+            *level,
+        )
+        for source_box in source_leftover:
+            source_start, source_end = source_box.start_datetime, source_box.end_datetime
+            if source_temporal_resolution != "hour":
+                period_starts, period_ends = get_period_bounds([source_start, source_end], source_temporal_resolution)
+                source_start, source_end = period_starts[0], period_ends[-1]
+            # time steps and grid cells aggregating any value of the source box
+            uncovered.append(
+                (
+                    ends.searchsorted(np.datetime64(source_start), side="left"),
+                    starts.searchsorted(np.datetime64(source_end), side="right"),
+                    lat_range.searchsorted(source_box.min_lat - margin, side="left"),
+                    lat_range.searchsorted(source_box.max_lat + margin, side="right"),
+                    lon_range.searchsorted(source_box.min_lon - margin, side="left"),
+                    lon_range.searchsorted(source_box.max_lon + margin, side="right"),
+                )
+            )
+        covered = [full]
+        for cut in uncovered:
+            covered = [piece for covered_box in covered for piece in subtract_box(covered_box, cut)]
+        uncovered = [full]
+        for cut in covered:
+            uncovered = [piece for uncovered_box in uncovered for piece in subtract_box(uncovered_box, cut)]
+
+        def to_box(piece):
+            t0, t1, lat0, lat1, lon0, lon1 = piece
+            return LeftoverBox(
+                pd.Timestamp(time_range[t0]),
+                pd.Timestamp(time_range[t1 - 1]),
+                lat_range[lat0].item(),
+                lat_range[lat1 - 1].item(),
+                lon_range[lon0].item(),
+                lon_range[lon1 - 1].item(),
+            )
+
+        derived = []
+        for piece in covered:
+            piece_box = to_box(piece)
+            piece_start, piece_end = self._hour_window(piece_box)
+            df_source = self.metadata.query_overlap(
+                self.variable,
+                piece_start,
+                piece_end,
+                piece_box.min_lat - margin,
+                piece_box.max_lat + margin,
+                piece_box.min_lon - margin,
+                piece_box.max_lon + margin,
+                *level,
+            )
+            derived.append((piece_box, df_source["file_path"].tolist()))
+        return derived, [to_box(piece) for piece in uncovered]
+
+    def _plan_derivation(self, leftover):
+        """
+        Find finer local data the leftover boxes can be computed from; the parts of a box a level does not cover
+        try the next level.
+        Return: [(box, source level, source files)], [boxes left for the API]
+        """
+        if self.temporal_resolution == "hour" and self.spatial_resolution == 0.25:
+            return [], leftover
+        levels = derivation_levels(
+            self.temporal_resolution, self.temporal_aggregation, self.spatial_resolution, self.spatial_aggregation
+        )
+        derived = []
+        for level in levels:
+            remaining = []
+            for box in leftover:
+                covered, uncovered = self._split_by_source(box, level)
+                derived += [(covered_box, level, files) for covered_box, files in covered]
+                remaining += uncovered
+            leftover = remaining
+            if not leftover:
+                break
+        return derived, leftover
 
-    def _gen_download_file_name(self):
-        dt = datetime.now().strftime("%Y%m%d_%H%M%S")
-        return f"download_{dt}.nc"
+    def _derive(self, box, level, file_list):
+        """
+        Return: the box's time steps and grid points computed lazily from the finer local files
+        """
+        source_temporal_resolution, _, source_spatial_resolution, _ = level
+        window_start, window_end = self._hour_window(box)
+        margin = (self.spatial_resolution - source_spatial_resolution) / 2
+        source_list = []
+        for file in file_list:
+            ds = dataset_pool.open_chunked(file)
+            ds = ds.sel(
+                valid_time=slice(window_start, window_end),
+                latitude=slice(box.max_lat + margin, box.min_lat - margin),
+                longitude=slice(box.min_lon - margin, box.max_lon + margin),
+            )
+            source_list.append(ds)
+        # source files are tiles next to each other or periods of one grid, assembled like the parts of a query
+        ds = assemble_parts(source_list)
+        if source_temporal_resolution != self.temporal_resolution:
+            ds = temporal_resample(ds, self.temporal_resolution, self.temporal_aggregation)
+        ds = coarsen_to_grid(ds, self.spatial_resolution, self.spatial_aggregation, source_spatial_resolution)
+        ds = ds.sel(
+            valid_time=slice(*self._label_window(box)),
+            latitude=slice(box.max_lat, box.min_lat),
+            longitude=slice(box.min_lon, box.max_lon),
+        )
+        return self._select_time_points(ds)
 
     def _check_metadata(self):
         """
-        Return: [local_files], [api_calls]
+        Return: [local_files], [(leftover box, finer source level, source files)], [api_calls]
         """
         df_overlap, leftover = self.metadata.query_get_overlap_and_leftover(
             self.variable,
@@ -62,124 +481,162 @@ class GetRasterExecutor(QueryExecutor):
         )
 
         local_files = df_overlap["file_path"].tolist()
-        api_calls = []
-        if leftover is not None:
-            leftover_min_lat = math.floor(leftover.latitude.min().item())
-            leftover_max_lat = math.ceil(leftover.latitude.max().item())
-            leftover_min_lon = math.floor(leftover.longitude.min().item())
-            leftover_max_lon = math.ceil(leftover.longitude.max().item())
-            leftover_start_datetime = pd.Timestamp(leftover.valid_time.min().item())
-            leftover_end_datetime = pd.Timestamp(leftover.valid_time.max().item())
-            leftover_start_year, leftover_start_month, leftover_start_day = (
-                leftover_start_datetime.year,
-                leftover_start_datetime.month,
-                leftover_start_datetime.day,
-            )
-            leftover_end_year, leftover_end_month, leftover_end_day = (
-                leftover_end_datetime.year,
-                leftover_end_datetime.month,
-                leftover_end_datetime.day,
-            )
+        derived, leftover = self._plan_derivation(self._trim_leftover(leftover))
+        api_calls = self._gen_api_calls(leftover)
+        tracer.log("local files:", local_files)
+        tracer.log("derived:", [(level, files) for _, level, files in derived])
+        tracer.log("api:", api_calls)
+        return local_files, derived, api_calls
 
-            years = [str(i) for i in range(leftover_start_year, leftover_end_year + 1)]
-            months = [str(i).zfill(2) for i in range(1, 13)]
-            days = [str(i).zfill(2) for i in range(1, 32)]
-            if self.temporal_resolution == "month":
-                if leftover_start_year == leftover_end_year:
-                    months = [str(i).zfill(2) for i in range(leftover_start_month, leftover_end_month + 1)]
-            if self.temporal_resolution == "day" or self.temporal_resolution == "hour":
-                if leftover_start_year == leftover_end_year:
-                    months = [str(i).zfill(2) for i in range(leftover_start_month, leftover_end_month + 1)]
-                    if leftover_start_month == leftover_end_month:
-                        days = [str(i).zfill(2) for i in range(leftover_start_day, leftover_end_day + 1)]
-
-            dataset = "reanalysis-era5-single-levels"
-            request = {
-                "product_type": ["reanalysis"],
-                "variable": [self.variable],
-                "year": years,
-                "month": months,
-                "day": days,
-                "time": [f"{str(i).zfill(2)}:00" for i in range(0, 24)],
-                "data_format": "netcdf",
-                "download_format": "unarchived",
-                "area": [leftover_max_lat, leftover_min_lon, leftover_min_lat, leftover_max_lon],
-            }
-            api_calls.append((dataset, request))
-        print("local files:", local_files)
-        print("api:", api_calls)
-        return local_files, api_calls
+    @staticmethod
+    def _file_identity(file):
+        stat = os.stat(file)
+        return os.path.abspath(file), stat.st_mtime_ns, stat.st_size
+
+    def _cache_key(self, plan):
+        """
+        Return: key of the query and the files it reads, so a rewritten or repointed file misses;
+        None when the result is not cached
+        """
+        if self.time_points is not None:
+            return None
+        file_list, derived, _ = plan
+        try:
+            files = tuple(self._file_identity(file) for file in file_list)
+            files += tuple(self._file_identity(file) for _, _, source_files in derived for file in source_files)
+        except OSError:
+            return None
+        return (
+            os.path.abspath(self.metadata.f_path),
+            self.metadata.mtime,
+            files,
+            self.variable,
+            pd.Timestamp(self.start_datetime).isoformat(),
+            pd.Timestamp(self.end_datetime).isoformat(),
+            float(self.min_lat),
+            float(self.max_lat),
+            float(self.min_lon),
+            float(self.max_lon),
+            self.temporal_resolution,
+            self.temporal_aggregation or "none",
+            float(self.spatial_resolution),
+            self.spatial_aggregation or "none",
+        )
 
     def execute(self):
+        with self._trace_span() as span:
+            plan = self._plan()
+            key = self._cache_key(plan) if raster_cache.enabled else None
+            if key is not None:
+                ds = raster_cache.get(key)
+                span.set(cache="hit" if ds is not None else "miss")
+                if ds is not None:
+                    return ds
+            ds = self._execute(plan)
+            if key is not None and raster_cache.cacheable(ds):
+                with tracer.span("compute", "compute"):
+                    ds = cancellable_compute(ds)
+                raster_cache.put(key, ds)
+            return ds
+
+    def _plan(self):
+        with tracer.span("check_metadata", "metadata") as span:
+            file_list, derived, api = self._check_metadata()
+            span.set(local_files=file_list, derived=[level for _, level, _ in derived], api_calls=len(api))
+        return file_list, derived, api
+
+    def _execute(self, plan=None):
         # 1. check metadata
-        file_list, api = self._check_metadata()
+        file_list, derived, api = self._plan() if plan is None else plan
 
-        # 2. call apis
-        download_file_list = []
-        if api:
-            c = cdsapi.Client()
-            for dataset, request in api:
-                file_name = self._gen_download_file_name()
-                c.retrieve(dataset, request).download(file_name)
-                download_file_list.append(file_name)
+        # 2. call apis, each downloaded piece is committed to the catalog as it arrives
+        download_list = [None] * len(api)
+        with tracer.span("download", "io", requests=len(api)):
+            for i, file in self.downloader.download_all(api):
+                ds = dataset_pool.open_chunked(file)
+                if "number" in ds.coords:
+                    ds = ds.drop_vars("number")
+                if "expver" in ds.coords:
+                    ds = ds.drop_vars("expver")
+                if self.metadata.materialize_dir:
+                    self._materialize_download(ds)
+                download_list[i] = ds
 
         # 3. execute query
         ds_list = []
-        # 3.1 read downloaded files
-        for file in download_file_list:
-            ds = xr.open_dataset(file, engine="netcdf4")
-            # if "valid_time" in ds.coords:
-            #     ds = ds.rename({"valid_time": "time"})
-            if "number" in ds.coords:
-                ds = ds.drop_vars("number")
-            if "expver" in ds.coords:
-                ds = ds.drop_vars("expver")
-            ds = ds.sel(
-                valid_time=slice(self.start_datetime, self.end_datetime),
-                latitude=slice(self.max_lat, self.min_lat),
-                longitude=slice(self.min_lon, self.max_lon),
-            )
-            # temporal resample
-            if self.temporal_resolution != "hour":
-                resampled = ds.resample(valid_time=time_resolution_to_freq(self.temporal_resolution))
-                if self.temporal_aggregation == "mean":
-                    ds = resampled.mean()
-                elif self.temporal_aggregation == "max":
-                    ds = resampled.max()
-                elif self.temporal_aggregation == "min":
-                    ds = resampled.min()
-                else:
-                    raise ValueError("Invalid temporal_aggregation")
-            # spatial resample
-            if self.spatial_resolution > 0.25:
-                c_f = int(self.spatial_resolution / 0.25)
-                coarsened = ds.coarsen(latitude=c_f, longitude=c_f, boundary="trim")
-                if self.spatial_aggregation == "mean":
-                    ds = coarsened.mean()
-                elif self.spatial_aggregation == "max":
-                    ds = coarsened.max()
-                elif self.spatial_aggregation == "min":
-                    ds = coarsened.min()
-                else:
-                    raise ValueError("Invalid spatial_aggregation")
-            ds_list.append(ds)
+        # 3.1 read downloaded files: a box's pieces share its area and are joined in time before resampling,
+        # so no period is split across pieces; boxes are disjoint parts assembled with the local ones
+        if download_list:
+            with tracer.span("read_downloads", "io", pieces=len(download_list)):
+                ds_list += self._read_downloads(api, download_list)
 
         # 3.2 read local files
-        for file in file_list:
-            ds = xr.open_dataset(file, engine="netcdf4")
-            ds = ds.sel(
-                valid_time=slice(self.start_datetime, self.end_datetime),
-                latitude=slice(self.max_lat, self.min_lat),
-                longitude=slice(self.min_lon, self.max_lon),
-            )
-            ds_list.append(ds)
+        with tracer.span("read_local", "io", files=len(file_list)):
+            for file in file_list:
+                ds = dataset_pool.open_chunked(file)
+                ds = ds.sel(
+                    valid_time=slice(self.start_datetime, self.end_datetime),
+                    latitude=slice(self.max_lat, self.min_lat),
+                    longitude=slice(self.min_lon, self.max_lon),
+                )
+                ds = self._select_time_points(ds)
+                ds_list.append(ds)
 
-        # 3.3 assemble result
-        # compat="override" is a temporal walkaround as pre-aggregation value conflicts with downloaded data
-        # future solution: use new encoding when write pre-aggregated data
-        try:
-            ds = xr.merge([i.chunk() for i in ds_list], compat="no_conflicts")
-        except ValueError:
-            print("WARNING: conflict in merging data, use override")
-            ds = xr.merge([i.chunk() for i in ds_list], compat="override")
-        return ds
+        # 3.3 derive coarser resolutions from finer local files
+        for box, level, source_files in derived:
+            with tracer.span("derive", "compute", level=level, files=source_files):
+                ds_list.append(self._derive(box, level, source_files))
+
+        # 3.4 assemble result, every part is already chunked by the open-time chunk policy
+        check_cancelled()
+        with tracer.span("assemble", "assembly", parts=len(ds_list)):
+            return assemble_parts(ds_list)
+
+    def _read_downloads(self, api, download_list):
+        """
+        Return: [the query's raster computed from the downloaded pieces of each leftover box]
+        """
+        areas = {}
+        for (_, request), ds in zip(api, download_list):
+            areas.setdefault(tuple(request["area"]), []).append(ds)
+        boxes = []
+        for pieces in areas.values():
+            pieces = sorted(pieces, key=lambda piece: piece.valid_time.values[0])
+            # the pieces of one box follow each other hour by hour, a gap starts another box of the same area,
+            # e.g. the leftovers before and after the local files
+            box = pieces[:1]
+            for piece in pieces[1:]:
+                if piece.indexes["valid_time"][0] - box[-1].indexes["valid_time"][-1] > pd.Timedelta(hours=1):
+                    boxes.append(box)
+                    box = []
+                box.append(piece)
+            boxes.append(box)
+        # each box is resampled on its own, so no period bin is made up for the time between boxes
+        return [
+            self._read_download_box(xr.concat(box, dim="valid_time") if len(box) > 1 else box[0], len(boxes) == 1)
+            for box in boxes
+        ]
+
+    def _read_download_box(self, ds, materialize):
+        # coarse cells are computed on the global grid from the raw points around them, like derived local data;
+        # the download holds the whole periods of the box's time steps, also hours outside the query
+        margin = (self.spatial_resolution - 0.25) / 2
+        ds_hour = ds.sel(
+            latitude=slice(self.max_lat + margin, self.min_lat - margin),
+            longitude=slice(self.min_lon - margin, self.max_lon + margin),
+        )
+        ds = temporal_resample(ds_hour, self.temporal_resolution, self.temporal_aggregation)
+        ds = coarsen_to_grid(ds, self.spatial_resolution, self.spatial_aggregation)
+        # like local and derived data, only labels within the query are part of the result
+        ds = ds.sel(
+            valid_time=slice(pd.Timestamp(self.start_datetime), pd.Timestamp(self.end_datetime)),
+            latitude=slice(self.max_lat, self.min_lat),
+            longitude=slice(self.min_lon, self.max_lon),
+        )
+        if (
+            materialize
+            and self.metadata.materialize_dir
+            and (self.temporal_resolution != "hour" or self.spatial_resolution > 0.25)
+        ):
+            self._materialize_aggregate(ds, ds_hour)
+        return self._select_time_points(ds)
@@ -1,17 +1,12 @@
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 import xarray as xr
 
 from .query_executor import QueryExecutor
 from .query_executor_get_raster import GetRasterExecutor
-from .utils.get_whole_period import (
-    get_whole_ranges_between,
-    get_total_hours_in_year,
-    get_total_hours_in_month,
-    iterate_months,
-    number_of_days_inclusive,
-    number_of_hours_inclusive,
-    get_total_hours_between,
-)
+from .query_planner import QueryPlanner, step_hours
+from .utils.tracing import in_current_context, tracer
 
 
 class HeatmapExecutor(QueryExecutor):
@@ -27,7 +22,8 @@ class HeatmapExecutor(QueryExecutor):
         heatmap_aggregation_method: str,  # e.g., "mean", "max", "min"
         spatial_resolution=0.25,  # e.g., 0.25, 0.5, 1.0
         spatial_aggregation=None,  # e.g., "mean", "max", "min"
-        metadata=None,  # metadata file path
+        metadata=None,  # metadata file path or Metadata instance
+        max_workers=None,  # sub-range rasters fetched concurrently, 1 to run serially
     ):
         super().__init__(
             variable,
@@ -42,257 +38,118 @@ class HeatmapExecutor(QueryExecutor):
             metadata=metadata,
         )
         self.heatmap_aggregation_method = heatmap_aggregation_method
+        self.max_workers = max_workers
 
     def execute(self):
-        if self.heatmap_aggregation_method == "mean":
-            return self._get_mean_heatmap()
-        elif self.heatmap_aggregation_method == "max":
-            return self._get_max_heatmap()
-        elif self.heatmap_aggregation_method == "min":
-            return self._get_min_heatmap()
-        else:
-            raise ValueError("Invalid heatmap_aggregation_method")
+        with self._trace_span(aggregation=self.heatmap_aggregation_method):
+            if self.heatmap_aggregation_method not in ("mean", "max", "min"):
+                raise ValueError("Invalid heatmap_aggregation_method")
+            ds_list, hours = self._get_sub_rasters()
+            return self._aggregate(ds_list, hours)
 
-    def _get_mean_heatmap(self):
-        year_range, month_range, day_range, hour_range = get_whole_ranges_between(
-            self.start_datetime, self.end_datetime
+    def _gen_raster_executor(self, start_datetime, end_datetime, temporal_resolution, temporal_aggregation=None):
+        if temporal_aggregation is None and temporal_resolution != "hour":
+            temporal_aggregation = self.heatmap_aggregation_method
+        return GetRasterExecutor(
+            self.variable,
+            str(start_datetime),
+            str(end_datetime),
+            self.min_lat,
+            self.max_lat,
+            self.min_lon,
+            self.max_lon,
+            temporal_resolution=temporal_resolution,
+            temporal_aggregation=temporal_aggregation,
+            spatial_resolution=self.spatial_resolution,
+            spatial_aggregation=self.spatial_aggregation,
+            metadata=self.metadata,
         )
-        ds_year = []
-        ds_month = []
-        ds_day = []
-        ds_hour = []
-        year_hours = []
-        month_hours = []
-        day_hours = []
-        hour_hours = []
-        for start_year, end_year in year_range:
-            get_raster_year = GetRasterExecutor(
-                self.variable,
-                str(start_year),
-                str(end_year),
-                self.min_lat,
-                self.max_lat,
-                self.min_lon,
-                self.max_lon,
-                temporal_resolution="year",
-                temporal_aggregation=self.heatmap_aggregation_method,
-                spatial_resolution=self.spatial_resolution,
-                spatial_aggregation=self.spatial_aggregation,
-                metadata=self.metadata.f_path,
-            )
-            ds_year.append(get_raster_year.execute())
-            year_hours += [get_total_hours_in_year(y) for y in range(start_year.year, end_year.year + 1)]
-        for start_month, end_month in month_range:
-            get_raster_month = GetRasterExecutor(
-                self.variable,
-                str(start_month),
-                str(end_month),
-                self.min_lat,
-                self.max_lat,
-                self.min_lon,
-                self.max_lon,
-                temporal_resolution="month",
-                temporal_aggregation=self.heatmap_aggregation_method,
-                spatial_resolution=self.spatial_resolution,
-                spatial_aggregation=self.spatial_aggregation,
-                metadata=self.metadata.f_path,
-            )
-            ds_month.append(get_raster_month.execute())
-            month_hours += [get_total_hours_in_month(m) for m in iterate_months(start_month, end_month)]
-        for start_day, end_day in day_range:
-            get_raster_day = GetRasterExecutor(
-                self.variable,
-                str(start_day),
-                str(end_day),
-                self.min_lat,
-                self.max_lat,
-                self.min_lon,
-                self.max_lon,
-                temporal_resolution="day",
-                temporal_aggregation=self.heatmap_aggregation_method,
-                spatial_resolution=self.spatial_resolution,
-                spatial_aggregation=self.spatial_aggregation,
-                metadata=self.metadata.f_path,
-            )
-            ds_day.append(get_raster_day.execute())
-            day_hours += [24 for _ in range(number_of_days_inclusive(start_day, end_day))]
-        for start_hour, end_hour in hour_range:
-            get_raster_hour = GetRasterExecutor(
-                self.variable,
-                str(start_hour),
-                str(end_hour),
-                self.min_lat,
-                self.max_lat,
-                self.min_lon,
-                self.max_lon,
-                temporal_resolution="hour",
-                temporal_aggregation=None,
-                spatial_resolution=self.spatial_resolution,
-                spatial_aggregation=self.spatial_aggregation,
-                metadata=self.metadata.f_path,
-            )
-            ds_hour.append(get_raster_hour.execute())
-            hour_hours += [1 for _ in range(number_of_hours_inclusive(start_hour, end_hour))]
 
-        xrds_concat = xr.concat(ds_year + ds_month + ds_day + ds_hour, dim="valid_time")
-        nd_array = xrds_concat[self.variable_short_name].to_numpy()
-        weights = np.array(year_hours + month_hours + day_hours + hour_hours)
-        total_hours = get_total_hours_between(self.start_datetime, self.end_datetime)
-        weights = weights / total_hours
-        average = np.average(nd_array, axis=0, weights=weights)
-        res = xr.Dataset(
-            {self.variable_short_name: (["latitude", "longitude"], average)},
-            coords={"latitude": xrds_concat.latitude, "longitude": xrds_concat.longitude},
+    def _gen_planner(self):
+        return QueryPlanner(
+            self.metadata,
+            self.variable,
+            self.start_datetime,
+            self.end_datetime,
+            self.min_lat,
+            self.max_lat,
+            self.min_lon,
+            self.max_lon,
+            self.spatial_resolution,
+            self.spatial_aggregation,
         )
-        return res
 
-    def _get_max_heatmap(self):
-        year_range, month_range, day_range, hour_range = get_whole_ranges_between(
-            self.start_datetime, self.end_datetime
-        )
-        ds_year = []
-        ds_month = []
-        ds_day = []
-        ds_hour = []
-        for start_year, end_year in year_range:
-            get_raster_year = GetRasterExecutor(
-                self.variable,
-                str(start_year),
-                str(end_year),
-                self.min_lat,
-                self.max_lat,
-                self.min_lon,
-                self.max_lon,
-                temporal_resolution="year",
-                temporal_aggregation=self.heatmap_aggregation_method,
-                spatial_resolution=self.spatial_resolution,
-                spatial_aggregation=self.spatial_aggregation,
-                metadata=self.metadata.f_path,
-            )
-            ds_year.append(get_raster_year.execute())
-        for start_month, end_month in month_range:
-            get_raster_month = GetRasterExecutor(
-                self.variable,
-                str(start_month),
-                str(end_month),
-                self.min_lat,
-                self.max_lat,
-                self.min_lon,
-                self.max_lon,
-                temporal_resolution="month",
-                temporal_aggregation=self.heatmap_aggregation_method,
-                spatial_resolution=self.spatial_resolution,
-                spatial_aggregation=self.spatial_aggregation,
-                metadata=self.metadata.f_path,
-            )
-            ds_month.append(get_raster_month.execute())
-        for start_day, end_day in day_range:
-            get_raster_day = GetRasterExecutor(
-                self.variable,
-                str(start_day),
-                str(end_day),
-                self.min_lat,
-                self.max_lat,
-                self.min_lon,
-                self.max_lon,
-                temporal_resolution="day",
-                temporal_aggregation=self.heatmap_aggregation_method,
-                spatial_resolution=self.spatial_resolution,
-                spatial_aggregation=self.spatial_aggregation,
-                metadata=self.metadata.f_path,
-            )
-            ds_day.append(get_raster_day.execute())
-        for start_hour, end_hour in hour_range:
-            get_raster_hour = GetRasterExecutor(
-                self.variable,
-                str(start_hour),
-                str(end_hour),
-                self.min_lat,
-                self.max_lat,
-                self.min_lon,
-                self.max_lon,
-                temporal_resolution="hour",
-                temporal_aggregation=None,
-                spatial_resolution=self.spatial_resolution,
-                spatial_aggregation=self.spatial_aggregation,
-                metadata=self.metadata.f_path,
-            )
-            ds_hour.append(get_raster_hour.execute())
+    def plan(self):
+        """
+        Return: [PlanStep], cheapest cover of the time range by the pyramid levels in the catalog
+        """
+        return self._gen_planner().plan(self.heatmap_aggregation_method)
 
-        return xr.concat(ds_year + ds_month + ds_day + ds_hour, dim="valid_time").max(dim="valid_time")
+    def explain(self):
+        return QueryPlanner.explain(self.plan())
 
-    def _get_min_heatmap(self):
-        year_range, month_range, day_range, hour_range = get_whole_ranges_between(
-            self.start_datetime, self.end_datetime
-        )
-        ds_year = []
-        ds_month = []
-        ds_day = []
-        ds_hour = []
-        for start_year, end_year in year_range:
-            get_raster_year = GetRasterExecutor(
-                self.variable,
-                str(start_year),
-                str(end_year),
-                self.min_lat,
-                self.max_lat,
-                self.min_lon,
-                self.max_lon,
-                temporal_resolution="year",
-                temporal_aggregation=self.heatmap_aggregation_method,
-                spatial_resolution=self.spatial_resolution,
-                spatial_aggregation=self.spatial_aggregation,
-                metadata=self.metadata.f_path,
-            )
-            ds_year.append(get_raster_year.execute())
-        for start_month, end_month in month_range:
-            get_raster_month = GetRasterExecutor(
-                self.variable,
-                str(start_month),
-                str(end_month),
-                self.min_lat,
-                self.max_lat,
-                self.min_lon,
-                self.max_lon,
-                temporal_resolution="month",
-                temporal_aggregation=self.heatmap_aggregation_method,
-                spatial_resolution=self.spatial_resolution,
-                spatial_aggregation=self.spatial_aggregation,
-                metadata=self.metadata.f_path,
-            )
-            ds_month.append(get_raster_month.execute())
-        for start_day, end_day in day_range:
-            get_raster_day = GetRasterExecutor(
-                self.variable,
-                str(start_day),
-                str(end_day),
-                self.min_lat,
-                self.max_lat,
-                self.min_lon,
-                self.max_lon,
-                temporal_resolution="day",
-                temporal_aggregation=self.heatmap_aggregation_method,
-                spatial_resolution=self.spatial_resolution,
-                spatial_aggregation=self.spatial_aggregation,
-                metadata=self.metadata.f_path,
+    def _get_sub_executors(self):
+        """
+        Return: [sub-range GetRasterExecutors in year, month, day, hour order], [hours covered by each one's time steps]
+        """
+        with tracer.span("plan", "metadata") as span:
+            plan = self.plan()
+            span.set(steps=len(plan), bytes=sum(step.bytes for step in plan))
+        tracer.log(QueryPlanner.explain(plan))
+        executors = []
+        hours = []
+        for step in plan:
+            executors.append(
+                self._gen_raster_executor(step.start_datetime, step.end_datetime, step.temporal_resolution)
             )
-            ds_day.append(get_raster_day.execute())
-        for start_hour, end_hour in hour_range:
-            get_raster_hour = GetRasterExecutor(
-                self.variable,
-                str(start_hour),
-                str(end_hour),
-                self.min_lat,
-                self.max_lat,
-                self.min_lon,
-                self.max_lon,
-                temporal_resolution="hour",
-                temporal_aggregation=None,
-                spatial_resolution=self.spatial_resolution,
-                spatial_aggregation=self.spatial_aggregation,
-                metadata=self.metadata.f_path,
-            )
-            ds_hour.append(get_raster_hour.execute())
+            hours.append(step_hours(step))
+        return executors, hours
+
+    def _execute_all(self, executors):
+        if self.max_workers == 1 or len(executors) <= 1:
+            return [executor.execute() for executor in executors]
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            futures = [pool.submit(in_current_context(executor.execute)) for executor in executors]
+            return [future.result() for future in futures]
+
+    def _get_sub_rasters(self):
+        """
+        Return: [sub-range rasters in year, month, day, hour order], [hours covered by each raster's time steps]
+        """
+        executors, hours = self._get_sub_executors()
+        return self._execute_all(executors), hours
+
+    def _aggregate(self, ds_list, hours):
+        """
+        ds_list: sub-range rasters of _get_sub_executors, fetched by _execute_all or sliced from a batch read
+        """
+        with tracer.span("aggregate", "compute", parts=len(ds_list)):
+            if self.heatmap_aggregation_method == "mean":
+                return self._get_mean_heatmap(ds_list, hours)
+            elif self.heatmap_aggregation_method == "max":
+                return self._get_max_heatmap(ds_list)
+            elif self.heatmap_aggregation_method == "min":
+                return self._get_min_heatmap(ds_list)
+            else:
+                raise ValueError("Invalid heatmap_aggregation_method")
+
+    def _get_mean_heatmap(self, ds_list, hours):
+        """
+        Hour-weighted mean folded one sub-range at a time into a running (lazy) weighted sum,
+        so no concatenated valid_time cube is ever materialized.
+        """
+        weighted_sum = None
+        total_hours = 0
+        for ds, ds_hours in zip(ds_list, hours):
+            weights = xr.DataArray(np.array(ds_hours, dtype="float64"), dims="valid_time")
+            partial = (ds[self.variable_short_name] * weights).sum(dim="valid_time", skipna=False)
+            weighted_sum = partial if weighted_sum is None else weighted_sum + partial
+            total_hours += sum(ds_hours)
+        average = weighted_sum / total_hours
+        return average.to_dataset(name=self.variable_short_name)
+
+    def _get_max_heatmap(self, ds_list):
+        return xr.concat(ds_list, dim="valid_time").max(dim="valid_time")
 
-        # get min heatmap from ds_year, ds_month, ds_day, ds_hour
-        return xr.concat(ds_year + ds_month + ds_day + ds_hour, dim="valid_time").min(dim="valid_time")
+    def _get_min_heatmap(self, ds_list):
+        return xr.concat(ds_list, dim="valid_time").min(dim="valid_time")
@@ -2,6 +2,17 @@ from .query_executor import *
 from .query_executor_get_raster import GetRasterExecutor
 
 
+def aggregate_area(raster, time_series_aggregation_method):
+    if time_series_aggregation_method == "mean":
+        return raster.mean(dim=["latitude", "longitude"])
+    elif time_series_aggregation_method == "max":
+        return raster.max(dim=["latitude", "longitude"])
+    elif time_series_aggregation_method == "min":
+        return raster.min(dim=["latitude", "longitude"])
+    else:
+        raise ValueError(f"Invalid time series aggregation method: {time_series_aggregation_method}")
+
+
 class TimeseriesExecutor(QueryExecutor):
     def __init__(
         self,
@@ -17,7 +28,7 @@ class TimeseriesExecutor(QueryExecutor):
         time_series_aggregation_method: str,  # e.g., "mean", "max", "min"
         spatial_resolution=1.0,  # e.g., 0.25, 0.5, 1.0
         spatial_aggregation="mean",  # e.g., "mean", "max", "min"
-        metadata=None,  # metadata file path
+        metadata=None,  # metadata file path or Metadata instance
     ):
         super().__init__(
             variable,
@@ -36,8 +47,13 @@ class TimeseriesExecutor(QueryExecutor):
         self.time_series_aggregation_method = time_series_aggregation_method
 
     def execute(self):
-        get_raster_executor = GetRasterExecutor(
-            metadata=self.metadata.f_path,
+        with self._trace_span(aggregation=self.time_series_aggregation_method):
+            raster = self._gen_raster_executor().execute()
+            return aggregate_area(raster, self.time_series_aggregation_method)
+
+    def _gen_raster_executor(self):
+        return GetRasterExecutor(
+            metadata=self.metadata,
             variable=self.variable,
             start_datetime=self.start_datetime,
             end_datetime=self.end_datetime,
@@ -50,12 +66,3 @@ class TimeseriesExecutor(QueryExecutor):
             spatial_resolution=self.spatial_resolution,
             spatial_aggregation=self.spatial_aggregation,
         )
-        raster = get_raster_executor.execute()
-        if self.time_series_aggregation_method == "mean":
-            return raster.mean(dim=["latitude", "longitude"])
-        elif self.time_series_aggregation_method == "max":
-            return raster.max(dim=["latitude", "longitude"])
-        elif self.time_series_aggregation_method == "min":
-            return raster.min(dim=["latitude", "longitude"])
-        else:
-            raise ValueError(f"Invalid time series aggregation method: {self.time_series_aggregation_method}")
@@ -0,0 +1,240 @@
+from typing import NamedTuple
+
+import numpy as np
+import pandas as pd
+
+from .metadata import gen_query_axes
+from .query_executor_get_raster import derivation_levels
+from .utils.get_whole_period import (
+    get_period_bounds,
+    get_total_hours_in_month,
+    get_total_hours_in_year,
+    iterate_months,
+    number_of_days_inclusive,
+    number_of_hours_inclusive,
+)
+
+TEMPORAL_LEVELS = ("year", "month", "day", "hour")
+
+
+class PlanStep(NamedTuple):
+    """
+    One GetRaster read of a query plan: whole periods of temporal_resolution in [start_datetime, end_datetime].
+    """
+
+    temporal_resolution: str
+    start_datetime: pd.Timestamp
+    end_datetime: pd.Timestamp
+    source: tuple  # level read: (temporal_resolution, temporal_aggregation, spatial_resolution, spatial_aggregation)
+    local: bool  # False when no local source covers the step and GetRaster will call the API
+    bytes: int  # estimated bytes read
+
+
+def step_hours(step):
+    """
+    Return: [hours covered by each time step of the plan step]
+    """
+    if step.temporal_resolution == "year":
+        return [get_total_hours_in_year(y) for y in range(step.start_datetime.year, step.end_datetime.year + 1)]
+    elif step.temporal_resolution == "month":
+        return [get_total_hours_in_month(m) for m in iterate_months(step.start_datetime, step.end_datetime)]
+    elif step.temporal_resolution == "day":
+        return [24 for _ in range(number_of_days_inclusive(step.start_datetime, step.end_datetime))]
+    return [1 for _ in range(number_of_hours_inclusive(step.start_datetime, step.end_datetime))]
+
+
+class QueryPlanner:
+    """
+    Chooses the cheapest cover of a time window by year / month / day / hour reads, from the levels the catalog
+    actually holds over the query area. Costs are estimated bytes read; a step no local level covers is charged as
+    an API download of its raw hours, api_cost_factor times more expensive per byte.
+    """
+
+    def __init__(
+        self,
+        metadata,  # Metadata instance
+        variable: str,
+        start_datetime: str,
+        end_datetime: str,
+        min_lat: float,
+        max_lat: float,
+        min_lon: float,
+        max_lon: float,
+        spatial_resolution=0.25,  # e.g., 0.25, 0.5, 1.0
+        spatial_aggregation=None,  # e.g., "mean", "max", "min"
+        api_cost_factor=100,
+        step_overhead_bytes=2**20,  # per read, e.g. file opens and task setup; favours fewer, longer steps
+    ):
+        self.metadata = metadata
+        self.variable = variable
+        self.start_datetime = pd.Timestamp(start_datetime)
+        self.end_datetime = pd.Timestamp(end_datetime)
+        self.min_lat = min_lat
+        self.max_lat = max_lat
+        self.min_lon = min_lon
+        self.max_lon = max_lon
+        self.spatial_resolution = spatial_resolution
+        self.spatial_aggregation = None if spatial_resolution == 0.25 else spatial_aggregation
+        self.api_cost_factor = api_cost_factor
+        self.step_overhead_bytes = step_overhead_bytes
+        self._missing = {}
+        self._cell_counts = {}
+        self._source_levels = {}
+
+    def _cells(self, spatial_resolution):
+        if spatial_resolution in self._cell_counts:
+            return self._cell_counts[spatial_resolution]
+        _, lat_range, lon_range = gen_query_axes(
+            self.min_lat,
+            self.max_lat,
+            self.min_lon,
+            self.max_lon,
+            self.start_datetime,
+            self.start_datetime,
+            "hour",
+            spatial_resolution,
+        )
+        self._cell_counts[spatial_resolution] = max(len(lat_range), 1) * max(len(lon_range), 1)
+        return self._cell_counts[spatial_resolution]
+
+    def _sources(self, temporal_resolution, temporal_aggregation):
+        """
+        Return: catalog levels a temporal_resolution read can be served from, the requested level first
+        """
+        if temporal_resolution == "hour":
+            temporal_aggregation = None
+        if (temporal_resolution, temporal_aggregation) in self._source_levels:
+            return self._source_levels[(temporal_resolution, temporal_aggregation)]
+        level = (temporal_resolution, temporal_aggregation, self.spatial_resolution, self.spatial_aggregation)
+        finer_spatial = derivation_levels(*level)
+        sources = [level] + [source for source in finer_spatial if source[0] == temporal_resolution]
+        self._source_levels[(temporal_resolution, temporal_aggregation)] = sources
+        return sources
+
+    def _missing_intervals(self, source):
+        """
+        Return: [(first hour, last hour)] of the window source does not cover over the query area
+        """
+        if source not in self._missing:
+            margin = (self.spatial_resolution - source[2]) / 2
+            _, leftover = self.metadata.query_get_overlap_and_leftover(
+                self.variable,
+                self.start_datetime,
+                self.end_datetime,
+                self.min_lat - margin,
+                self.max_lat + margin,
+                self.min_lon - margin,
+                self.max_lon + margin,
+                *source,
+            )
+            intervals = []
+            for box in leftover:
+                if source[0] == "hour":
+                    intervals.append((box.start_datetime, box.end_datetime))
+                else:
+                    period_starts, period_ends = get_period_bounds([box.start_datetime, box.end_datetime], source[0])
+                    intervals.append((pd.Timestamp(period_starts[0]), pd.Timestamp(period_ends[-1])))
+            self._missing[source] = intervals
+        return self._missing[source]
+
+    def local_source(self, temporal_resolution, temporal_aggregation, start_datetime, end_datetime):
+        """
+        Return: the cheapest catalog level covering [start_datetime, end_datetime] locally, None if there is none
+        """
+        for source in self._sources(temporal_resolution, temporal_aggregation):
+            if not any(
+                start <= end_datetime and end >= start_datetime for start, end in self._missing_intervals(source)
+            ):
+                return source
+        return None
+
+    def _edge_costs(self, temporal_resolution, temporal_aggregation, starts, ends, steps):
+        """
+        starts, ends: first / last hour of each candidate read; steps: time steps each read returns
+        Return: (bytes, source, local) arrays, one entry per read
+        """
+        hours = (ends - starts) // pd.Timedelta(hours=1) + 1
+        costs = np.asarray(hours * self._cells(0.25) * 4 * self.api_cost_factor, dtype="float64")
+        sources = np.full(len(starts), None, dtype=object)
+        sources[:] = [("hour", None, 0.25, None)] * len(starts)
+        local = np.zeros(len(starts), dtype=bool)
+        for source in self._sources(temporal_resolution, temporal_aggregation):
+            covered = ~local
+            for start, end in self._missing_intervals(source):
+                covered &= ~((starts <= end) & (ends >= start))
+            costs[covered] = steps[covered] * self._cells(source[2]) * 4
+            sources[np.flatnonzero(covered)] = [source] * covered.sum()
+            local |= covered
+        return costs, sources, local
+
+    def plan(self, temporal_aggregation):
+        """
+        temporal_aggregation: aggregation of the year / month / day reads, e.g. "mean", "max", "min"
+        Return: [PlanStep] in year, month, day, hour order, consecutive steps of one level and source merged
+        """
+        one_hour = pd.Timedelta(hours=1)
+        stop = self.end_datetime + one_hour
+        if stop <= self.start_datetime:
+            return []
+        # nodes are the window edges and every day boundary in between; an edge reads the hours between two nodes
+        nodes = pd.DatetimeIndex(
+            sorted({self.start_datetime, stop} | set(pd.date_range(self.start_datetime.ceil("D"), stop, freq="D")))
+        )
+        day_start = nodes[:-1] == nodes[:-1].normalize()
+        candidates = {
+            "hour": (np.ones(len(nodes) - 1, dtype=bool), nodes[1:]),
+            "day": (day_start, nodes[:-1] + pd.Timedelta(days=1)),
+            "month": (day_start & (nodes[:-1].day == 1), (nodes[:-1].to_period("M") + 1).to_timestamp()),
+            "year": (day_start & (nodes[:-1].dayofyear == 1), (nodes[:-1].to_period("Y") + 1).to_timestamp()),
+        }
+        edges = [[] for _ in range(len(nodes) - 1)]
+        for temporal_resolution, (valid, targets) in candidates.items():
+            origins = np.flatnonzero(valid & (targets <= stop))
+            targets = targets[origins]
+            if temporal_resolution == "hour":
+                step_counts = np.asarray((targets - nodes[origins]) // one_hour)
+            else:
+                step_counts = np.ones(len(origins))
+            costs, sources, local = self._edge_costs(
+                temporal_resolution, temporal_aggregation, nodes[origins], targets - one_hour, step_counts
+            )
+            for i, j, step_bytes, source, is_local in zip(origins, nodes.searchsorted(targets), costs, sources, local):
+                edges[i].append((j, temporal_resolution, source, is_local, step_bytes))
+
+        # shortest path over the (acyclic, time-ordered) nodes
+        cost = [0.0] + [np.inf] * (len(nodes) - 1)
+        previous = [None] * len(nodes)
+        for i in range(len(nodes) - 1):
+            for j, temporal_resolution, source, local, step_bytes in edges[i]:
+                if cost[i] + step_bytes + self.step_overhead_bytes < cost[j]:
+                    cost[j] = cost[i] + step_bytes + self.step_overhead_bytes
+                    previous[j] = (i, temporal_resolution, source, local, step_bytes)
+
+        steps = []
+        j = len(nodes) - 1
+        while j > 0:
+            i, temporal_resolution, source, local, step_bytes = previous[j]
+            step = PlanStep(temporal_resolution, nodes[i], nodes[j] - one_hour, source, bool(local), int(step_bytes))
+            if steps and (steps[0].temporal_resolution, steps[0].source, steps[0].local) == step[:1] + step[3:5]:
+                steps[0] = step._replace(end_datetime=steps[0].end_datetime, bytes=step.bytes + steps[0].bytes)
+            else:
+                steps.insert(0, step)
+            j = i
+        return sorted(steps, key=lambda step: (TEMPORAL_LEVELS.index(step.temporal_resolution), step.start_datetime))
+
+    @staticmethod
+    def explain(plan):
+        """
+        Return: str, one line per plan step
+        """
+        lines = []
+        for step in plan:
+            t_res, t_agg, s_res, s_agg = step.source
+            lines.append(
+                f"{step.temporal_resolution:<5}"
+                f" {step.start_datetime:%Y-%m-%d %H:%M} - {step.end_datetime:%Y-%m-%d %H:%M}"
+                f"  {'local' if step.local else 'api'} {t_res}/{t_agg or 'none'}/{s_res}/{s_agg or 'none'}"
+                f"  ~{step.bytes / 2**20:.2f} MiB"
+            )
+        lines.append(f"total ~{sum(step.bytes for step in plan) / 2**20:.2f} MiB")
+        return "\n".join(lines)
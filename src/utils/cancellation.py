@@ -0,0 +1,75 @@
+import contextvars
+import threading
+import time
+
+from dask.callbacks import Callback
+
+_current_token = contextvars.ContextVar("cancel_token", default=None)
+
+
+class QueryCancelled(Exception):
+    """
+    Raised in the threads of a query whose CancelToken is cancelled, e.g. by a timeout of execute_async.
+    """
+
+
+class CancelToken:
+    """
+    Cooperative cancellation of one query: its threads stop at the next checkpoint, i.e. a file open,
+    a download attempt, a retry wait or a Dask task. A download already talking to the API runs to completion,
+    its file is then reused by the next query asking for it.
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+
+    def cancel(self):
+        self._event.set()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def check(self):
+        if self._event.is_set():
+            raise QueryCancelled()
+
+    def sleep(self, seconds):
+        if self._event.wait(seconds):
+            raise QueryCancelled()
+
+
+def run_cancellable(token, fn, *args):
+    """
+    Return: fn(*args) run in a copy of the current context with token as its cancel token; worker threads started
+    through tracing.in_current_context inherit the token
+    """
+    context = contextvars.copy_context()
+    context.run(_current_token.set, token)
+    return context.run(fn, *args)
+
+
+def check_cancelled():
+    token = _current_token.get()
+    if token is not None:
+        token.check()
+
+
+def cancellable_sleep(seconds):
+    token = _current_token.get()
+    if token is None:
+        time.sleep(seconds)
+    else:
+        token.sleep(seconds)
+
+
+def cancellable_compute(obj):
+    """
+    Return: obj.compute(), no further Dask task is started once the current token is cancelled
+    """
+    token = _current_token.get()
+    if token is None:
+        return obj.compute()
+    # passed to this compute only, a callback registered globally would fire for every query of the process
+    callback = Callback(pretask=lambda key, dsk, state: token.check())
+    return obj.compute(callbacks=[callback._callback])
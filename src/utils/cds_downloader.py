@@ -0,0 +1,105 @@
+import hashlib
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import cdsapi
+
+from .cancellation import cancellable_sleep, check_cancelled
+from .tracing import in_current_context, tracer
+
+
+class CDSDownloader:
+    """
+    Downloads CDS API requests concurrently. Each request is written to a file named after the request,
+    so an interrupted batch resumes by downloading only the files that are missing.
+    Failed requests are retried with exponential backoff.
+    """
+
+    def __init__(
+        self,
+        client_factory=None,  # callable returning a cdsapi.Client-like object, default cdsapi.Client
+        download_dir=".",
+        max_workers=4,
+        retries=3,
+        retry_wait=5.0,  # seconds before the first retry, doubled after each failure
+        split="month",  # e.g., "month", "year"; calendar period each API request is limited to
+    ):
+        self.client_factory = client_factory
+        self.download_dir = download_dir
+        self.max_workers = max_workers
+        self.retries = retries
+        self.retry_wait = retry_wait
+        self.split = split
+        self._local = threading.local()
+
+    def configure(self, **kwargs):
+        for name, value in kwargs.items():
+            if not hasattr(self, name) or name.startswith("_"):
+                raise ValueError(f"Invalid CDS downloader option: {name}")
+            setattr(self, name, value)
+        self._local = threading.local()
+
+    def _client(self):
+        # one client per thread, cdsapi.Client keeps a requests session that is not shared safely
+        if getattr(self._local, "client", None) is None:
+            client_factory = self.client_factory or cdsapi.Client
+            self._local.client = client_factory()
+        return self._local.client
+
+    def file_path(self, dataset, request):
+        digest = hashlib.sha1(json.dumps([dataset, request], sort_keys=True).encode()).hexdigest()[:16]
+        return os.path.join(self.download_dir, f"download_{digest}.nc")
+
+    def download(self, dataset, request):
+        """
+        Return: path of the downloaded file, reused without a new API call when a previous run already completed it
+        """
+        file_path = self.file_path(dataset, request)
+        with tracer.span("api_call", "io", dataset=dataset, request=request, file_path=file_path) as span:
+            if os.path.exists(file_path):
+                tracer.log("download reused:", file_path)
+                span.set(reused=True)
+                return file_path
+            os.makedirs(self.download_dir, exist_ok=True)
+            part_path = f"{file_path}.{threading.get_ident()}.part"
+            for attempt in range(self.retries + 1):
+                check_cancelled()
+                span.set(attempts=attempt + 1)
+                try:
+                    self._client().retrieve(dataset, request).download(part_path)
+                    os.replace(part_path, file_path)
+                    return file_path
+                except Exception as e:
+                    if os.path.exists(part_path):
+                        os.remove(part_path)
+                    if attempt == self.retries:
+                        raise
+                    wait = self.retry_wait * 2**attempt
+                    tracer.log(f"download failed ({e}), retry {attempt + 1}/{self.retries} in {wait}s")
+                    cancellable_sleep(wait)
+
+    def download_all(self, api_calls):
+        """
+        api_calls: [(dataset, request)]
+        Return: iterator of (index in api_calls, file path) in completion order
+        """
+        if self.max_workers == 1 or len(api_calls) <= 1:
+            for i, (dataset, request) in enumerate(api_calls):
+                yield i, self.download(dataset, request)
+            return
+        pool = ThreadPoolExecutor(max_workers=self.max_workers)
+        try:
+            futures = {
+                pool.submit(in_current_context(self.download), dataset, request): i
+                for i, (dataset, request) in enumerate(api_calls)
+            }
+            for future in as_completed(futures):
+                yield futures[future], future.result()
+        finally:
+            # after a failure, or when the caller stops early, queued requests are dropped, only those in flight finish
+            pool.shutdown(wait=True, cancel_futures=True)
+
+
+cds_downloader = CDSDownloader()
@@ -0,0 +1,89 @@
+import numpy as np
+
+PERIOD_FREQ = {"day": "D", "month": "M", "year": "Y"}
+
+
+class ChunkPolicy:
+    """
+    Dask chunking of catalog files at open time: valid_time chunks follow calendar periods and latitude / longitude
+    chunks are tiles rounded to whole on-disk chunks, so every Dask task reads complete NetCDF chunks.
+    """
+
+    def __init__(
+        self,
+        time="month",  # e.g., "day", "month", "year", a number of time steps, or None for one chunk
+        latitude=240,  # grid points per tile, rounded to the on-disk chunk size; None for one chunk
+        longitude=240,
+        max_chunk_bytes=2**28,  # set tiles shrink, down to the on-disk chunk, when a chunk would be larger
+        enabled=True,  # False to keep files lazily indexed without Dask
+    ):
+        self.time = time
+        self.latitude = latitude
+        self.longitude = longitude
+        self.max_chunk_bytes = max_chunk_bytes
+        self.enabled = enabled
+
+    def configure(self, **kwargs):
+        for name, value in kwargs.items():
+            if not hasattr(self, name) or name.startswith("_"):
+                raise ValueError(f"Invalid chunk policy option: {name}")
+            setattr(self, name, value)
+
+    def key(self):
+        return (self.time, self.latitude, self.longitude, self.max_chunk_bytes, self.enabled)
+
+    def _time_chunks(self, ds, disk_chunk):
+        if self.time is None:
+            return -1
+        if isinstance(self.time, int):
+            return self.time
+        if self.time not in PERIOD_FREQ:
+            raise ValueError("Invalid chunk policy time")
+        labels = ds.indexes["valid_time"]
+        if len(labels) == 0:
+            return -1
+        periods = labels.to_period(PERIOD_FREQ[self.time])
+        bounds = np.flatnonzero(periods[1:] != periods[:-1]) + 1
+        sizes = np.diff(np.concatenate([[0], bounds, [len(labels)]]))
+        # a period inside a larger on-disk chunk would decompress the whole chunk once per period
+        if disk_chunk is not None and disk_chunk > sizes.max():
+            return min(disk_chunk, len(labels))
+        return tuple(int(size) for size in sizes)
+
+    @staticmethod
+    def _tile_chunks(tile, size, disk_chunk):
+        if tile is None or tile >= size:
+            return -1
+        if disk_chunk is None or disk_chunk >= size:
+            return tile
+        return max(disk_chunk, tile // disk_chunk * disk_chunk)
+
+    def chunks(self, ds):
+        """
+        Return: {dim: chunks} for Dataset.chunk of a whole catalog file, before any selection
+        """
+        disk_chunks = {}
+        for da in ds.data_vars.values():
+            disk_chunks.update(da.encoding.get("preferred_chunks", {}))
+        chunks = {}
+        time_steps = 1
+        if "valid_time" in ds.dims:
+            chunks["valid_time"] = self._time_chunks(ds, disk_chunks.get("valid_time"))
+            time_steps = np.max(chunks["valid_time"]) if chunks["valid_time"] != -1 else ds.sizes["valid_time"]
+        itemsize = max([da.dtype.itemsize for da in ds.data_vars.values()] or [4])
+        # e.g. year-long on-disk time chunks get narrower tiles
+        tile_points = int(np.sqrt(self.max_chunk_bytes / (max(time_steps, 1) * itemsize)))
+        for dim, tile in (("latitude", self.latitude), ("longitude", self.longitude)):
+            if dim in ds.dims:
+                if tile is not None:
+                    tile = min(tile, tile_points)
+                chunks[dim] = self._tile_chunks(tile, ds.sizes[dim], disk_chunks.get(dim))
+        return chunks
+
+    def apply(self, ds):
+        if not self.enabled:
+            return ds
+        return ds.chunk(self.chunks(ds))
+
+
+chunk_policy = ChunkPolicy()
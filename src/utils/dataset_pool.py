@@ -0,0 +1,97 @@
+import os
+import threading
+from collections import OrderedDict
+
+import xarray as xr
+
+from .cancellation import check_cancelled
+from .chunk_policy import chunk_policy
+from .tracing import tracer
+
+
+def file_engine(file_path, default="netcdf4"):
+    """
+    Return: xarray engine of a catalog file, "zarr" for Zarr groups (*.zarr)
+    """
+    return "zarr" if file_path.rstrip("/").endswith(".zarr") else default
+
+
+class DatasetPool:
+    """
+    LRU pool of open xarray Datasets keyed by (path, mtime).
+    Reusing a handle skips the HDF5 open and metadata parsing; evicted handles are closed.
+    open returns the lazily indexed file, open_chunked the same file as Dask chunks of a ChunkPolicy.
+    """
+
+    def __init__(self, maxsize=32, engine="netcdf4"):
+        self.maxsize = maxsize
+        self.engine = engine
+        self._datasets = OrderedDict()
+        self._chunked = {}
+        self._open_locks = {}  # per file path, held while the file is opened
+        self.opens = 0  # files actually opened, i.e. pool misses
+        self._lock = threading.Lock()
+
+    def open(self, file_path):
+        check_cancelled()
+        key = (os.path.abspath(file_path), os.path.getmtime(file_path))
+        with self._lock:
+            ds = self._lookup(key)
+            if ds is not None:
+                return ds
+            open_lock = self._open_locks.setdefault(key[0], threading.Lock())
+        # HDF5 fails on concurrent opens of the same file, different files are opened concurrently
+        with open_lock:
+            with self._lock:
+                ds = self._lookup(key)
+                if ds is not None:
+                    return ds
+            ds = xr.open_dataset(file_path, engine=file_engine(file_path, self.engine))
+            with self._lock:
+                self.opens += 1
+                self._datasets[key] = ds
+                self._evict()
+        tracer.current().add("files_opened")
+        return ds
+
+    def _lookup(self, key):
+        if key not in self._datasets:
+            return None
+        self._datasets.move_to_end(key)
+        return self._datasets[key]
+
+    def open_chunked(self, file_path, policy=chunk_policy):
+        """
+        Return: the pooled Dataset chunked by policy, the Dask graph is built once per file and policy
+        """
+        ds = self.open(file_path)
+        key = (id(ds), policy.key())
+        with self._lock:
+            if key not in self._chunked:
+                self._chunked[key] = policy.apply(ds)
+            return self._chunked[key]
+
+    def _evict(self):
+        while len(self._datasets) > self.maxsize:
+            _, ds = self._datasets.popitem(last=False)
+            self._drop_chunked(ds)
+            ds.close()
+
+    def _drop_chunked(self, ds):
+        for key in [key for key in self._chunked if key[0] == id(ds)]:
+            del self._chunked[key]
+
+    def resize(self, maxsize):
+        with self._lock:
+            self.maxsize = maxsize
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            while self._datasets:
+                _, ds = self._datasets.popitem(last=False)
+                self._drop_chunked(ds)
+                ds.close()
+
+
+dataset_pool = DatasetPool()
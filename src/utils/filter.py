@@ -0,0 +1,46 @@
+import numpy as np
+
+
+def apply_filter(ds, filter_predicate, filter_value):
+    """
+    Return: ds as bool, True where filter_predicate holds against filter_value
+    """
+    if filter_predicate == ">":
+        res = ds.where(ds > filter_value, drop=False)
+    elif filter_predicate == "<":
+        res = ds.where(ds < filter_value, drop=False)
+    elif filter_predicate == "==":
+        res = ds.where(ds == filter_value, drop=False)
+    elif filter_predicate == "!=":
+        res = ds.where(ds != filter_value, drop=False)
+    elif filter_predicate == ">=":
+        res = ds.where(ds >= filter_value, drop=False)
+    elif filter_predicate == "<=":
+        res = ds.where(ds <= filter_value, drop=False)
+    else:
+        raise ValueError("Invalid filter_predicate")
+    res = res.fillna(False)
+    res = res.astype(bool)
+    return res
+
+
+def decide_by_bounds(filter_predicate, filter_value, lower, upper):
+    """
+    lower, upper: np.ndarray, bounds of every value an entry (period or cell) can take
+    Return: (predicate holds for the whole entry, predicate holds nowhere in the entry)
+    """
+    never = np.zeros(np.shape(lower), dtype=bool)
+    if filter_predicate == ">":
+        return lower > filter_value, upper <= filter_value
+    elif filter_predicate == "<":
+        return upper < filter_value, lower >= filter_value
+    elif filter_predicate == "==":
+        return never, (lower > filter_value) | (upper < filter_value)
+    elif filter_predicate == "!=":
+        return (lower > filter_value) | (upper < filter_value), (lower == filter_value) & (upper == filter_value)
+    elif filter_predicate == ">=":
+        return lower >= filter_value, upper < filter_value
+    elif filter_predicate == "<=":
+        return upper <= filter_value, lower > filter_value
+    else:
+        raise ValueError("Invalid filter_predicate")
@@ -1,6 +1,9 @@
+import numpy as np
 import pandas as pd
 import calendar
 
+from .tracing import tracer
+
 
 def get_last_date_of_month(dt):
     return calendar.monthrange(dt.year, dt.month)[1]
@@ -121,19 +124,19 @@ def get_whole_period_between(start, end):
             for res in residual:
                 hours = get_whole_hour_between(pd.Timestamp(res[0]), pd.Timestamp(res[1]))
                 whole_hours.extend(hours)
-    print("******************")
-    print("whole year")
+    tracer.log("******************")
+    tracer.log("whole year")
     for y in whole_years:
-        print(y)
-    print("whole month")
+        tracer.log(y)
+    tracer.log("whole month")
     for m in whole_months:
-        print(m)
-    print("whole day")
+        tracer.log(m)
+    tracer.log("whole day")
     for d in whole_days:
-        print(d)
-    print("whole hour")
+        tracer.log(d)
+    tracer.log("whole hour")
     for h in whole_hours:
-        print(h)
+        tracer.log(h)
     return whole_years, whole_months, whole_days, whole_hours
 
 
@@ -165,19 +168,19 @@ def get_whole_ranges_between(start, end):
                 hour_start = pd.Timestamp(f"{res[0]}")
                 hour_end = pd.Timestamp(f"{res[1]}")
                 hour_range.append([hour_start, hour_end])
-    print("******************")
-    print("year range")
+    tracer.log("******************")
+    tracer.log("year range")
     for y in year_range:
-        print(y)
-    print("month range")
+        tracer.log(y)
+    tracer.log("month range")
     for m in month_range:
-        print(m)
-    print("day range")
+        tracer.log(m)
+    tracer.log("day range")
     for d in day_range:
-        print(d)
-    print("hour range")
+        tracer.log(d)
+    tracer.log("hour range")
     for h in hour_range:
-        print(h)
+        tracer.log(h)
     return year_range, month_range, day_range, hour_range
 
 
@@ -241,8 +244,7 @@ def time_array_to_range(time_array, resolution):
             time_range.append([start_dt, end_dt])
             start_dt = pd.Timestamp(time)
         end_dt = pd.Timestamp(time)
-    if start_dt != end_dt:
-        time_range.append([start_dt, end_dt])
+    time_range.append([start_dt, end_dt])
 
     # post processing
     if resolution == "year":
@@ -256,3 +258,74 @@ def time_array_to_range(time_array, resolution):
             r[1] = pd.Timestamp(f"{r[1].year}-{r[1].month}-{r[1].day} 23:00:00")
 
     return time_range
+
+
+def get_period_bounds(time_labels, resolution):
+    """
+    time_labels: valid_time labels of pre-aggregated data, e.g. year-end / month-end / day
+    Return: (first hour, last hour) of the period each label aggregates, as datetime64 arrays
+    """
+    period_freq = {"year": "Y", "month": "M", "day": "D"}[resolution]
+    periods = pd.DatetimeIndex(time_labels).to_period(period_freq)
+    return periods.start_time.values, periods.end_time.floor("h").values
+
+
+def mark_periods(time_points, period_starts, period_ends, selected):
+    """
+    Return: bool mask over time_points, True where the point falls in a selected [start, end] period
+    """
+    period = period_starts.searchsorted(time_points, side="right") - 1
+    inside = (period >= 0) & (time_points <= period_ends[period.clip(0)])
+    return inside & selected[period.clip(0)]
+
+
+def mask_to_index_ranges(mask):
+    """
+    Return: [[start, end], ...] inclusive index ranges of consecutive True runs in mask
+    """
+    edges = np.diff(np.concatenate([[0], mask.astype(np.int8), [0]]))
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1) - 1
+    return [[start, end] for start, end in zip(starts, ends)]
+
+
+def get_time_products(start, end, split="month"):
+    """
+    Decompose the hours [start, end] into disjoint year x months x days x hours products, e.g. for CDS API requests:
+    a partial first day, whole days per calendar month, a partial last day.
+    split: "month" for one product per month, "year" to also join the whole months of a year into one product
+    Return: [(year, [months], [days], [hours])], exactly covering [start, end]
+    """
+    start = pd.Timestamp(start)
+    end = pd.Timestamp(end)
+    if start.normalize() == end.normalize():
+        return [(start.year, [start.month], [start.day], list(range(start.hour, end.hour + 1)))]
+    products = []
+    whole_start = start.normalize()
+    whole_end = end.normalize()
+    if start.hour != 0:
+        products.append((start.year, [start.month], [start.day], list(range(start.hour, 24))))
+        whole_start += pd.Timedelta(days=1)
+    if end.hour != 23:
+        whole_end -= pd.Timedelta(days=1)
+    if whole_start <= whole_end:
+        for period in pd.period_range(whole_start, whole_end, freq="M"):
+            first = max(period.start_time, whole_start)
+            last = min(period.end_time.normalize(), whole_end)
+            whole_month = first.day == 1 and last.day == get_last_date_of_month(last)
+            previous = products[-1] if products else None
+            if (
+                split == "year"
+                and whole_month
+                and previous is not None
+                and previous[0] == first.year
+                and previous[2] == list(range(1, 32))
+            ):
+                previous[1].append(first.month)
+            elif split == "year" and whole_month:
+                products.append((first.year, [first.month], list(range(1, 32)), list(range(24))))
+            else:
+                products.append((first.year, [first.month], list(range(first.day, last.day + 1)), list(range(24))))
+    if end.hour != 23:
+        products.append((end.year, [end.month], [end.day], list(range(0, end.hour + 1))))
+    return products
@@ -0,0 +1,127 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+import xarray as xr
+
+
+class RasterCache:
+    """
+    Two-tier cache of computed GetRasterExecutor results keyed on normalized query parameters.
+    Memory tier: LRU bounded by memory_bytes. Disk tier (off unless disk_dir is set): one NetCDF file per key,
+    least recently used files removed once disk_bytes is exceeded.
+    Off unless enabled: a cached query computes its result inside execute() instead of returning it lazily.
+    Results larger than max_item_bytes are not cached, so big queries stay lazy.
+    Entries are deep copies, so a caller modifying its result in place does not change the cache.
+    """
+
+    def __init__(
+        self,
+        memory_bytes=512 * 2**20,
+        disk_dir=None,  # e.g., "cache/raster"
+        disk_bytes=8 * 2**30,
+        max_item_bytes=256 * 2**20,
+        enabled=False,
+    ):
+        self.memory_bytes = memory_bytes
+        self.disk_dir = disk_dir
+        self.disk_bytes = disk_bytes
+        self.max_item_bytes = max_item_bytes
+        self.enabled = enabled
+        self._memory = OrderedDict()
+        self._memory_used = 0
+        self._lock = threading.Lock()
+
+    def configure(self, **kwargs):
+        for name, value in kwargs.items():
+            if not hasattr(self, name) or name.startswith("_"):
+                raise ValueError(f"Invalid raster cache option: {name}")
+            setattr(self, name, value)
+        with self._lock:
+            self._evict_memory()
+
+    def cacheable(self, ds):
+        return self.enabled and ds.nbytes <= self.max_item_bytes
+
+    def get(self, key):
+        if not self.enabled:
+            return None
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return self._memory[key].copy(deep=True)
+        path = self._disk_path(key)
+        if path is None or not os.path.exists(path):
+            return None
+        try:
+            with xr.open_dataset(path, engine="netcdf4") as ds:
+                ds = ds.load()
+            os.utime(path)
+        except (OSError, ValueError):
+            # evicted by another process or partially written, treat as a miss
+            return None
+        self._put_memory(key, ds)
+        return ds.copy(deep=True)
+
+    def put(self, key, ds):
+        """
+        ds: computed (in-memory) result
+        """
+        if not self.cacheable(ds):
+            return
+        self._put_memory(key, ds.copy(deep=True))
+        path = self._disk_path(key)
+        if path is not None and not os.path.exists(path):
+            os.makedirs(self.disk_dir, exist_ok=True)
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            ds.to_netcdf(tmp_path, engine="netcdf4")
+            os.replace(tmp_path, path)
+            self._evict_disk()
+
+    def clear(self, disk=False):
+        with self._lock:
+            self._memory.clear()
+            self._memory_used = 0
+        if disk and self.disk_dir is not None and os.path.isdir(self.disk_dir):
+            for name in os.listdir(self.disk_dir):
+                if name.endswith(".nc"):
+                    os.remove(os.path.join(self.disk_dir, name))
+
+    def _put_memory(self, key, ds):
+        with self._lock:
+            if key in self._memory:
+                self._memory_used -= self._memory.pop(key).nbytes
+            self._memory[key] = ds
+            self._memory_used += ds.nbytes
+            self._evict_memory()
+
+    def _evict_memory(self):
+        while self._memory and self._memory_used > self.memory_bytes:
+            _, ds = self._memory.popitem(last=False)
+            self._memory_used -= ds.nbytes
+
+    def _disk_path(self, key):
+        if self.disk_dir is None:
+            return None
+        digest = hashlib.sha1(repr(key).encode()).hexdigest()
+        return os.path.join(self.disk_dir, f"{digest}.nc")
+
+    def _evict_disk(self):
+        files = []
+        for name in os.listdir(self.disk_dir):
+            if name.endswith(".nc"):
+                stat = os.stat(os.path.join(self.disk_dir, name))
+                files.append((stat.st_mtime, stat.st_size, name))
+        used = sum(size for _, size, _ in files)
+        for _, size, name in sorted(files):
+            if used <= self.disk_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.disk_dir, name))
+            except FileNotFoundError:
+                pass
+            used -= size
+
+
+raster_cache = RasterCache()
@@ -0,0 +1,200 @@
+import contextlib
+import contextvars
+import functools
+import json
+import os
+import threading
+import time
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+def read_bytes():
+    """
+    Return: bytes this process read through read / pread calls, page cache hits included; None off Linux
+    """
+    try:
+        with open("/proc/self/io") as f:
+            for line in f:
+                if line.startswith("rchar:"):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+    return None
+
+
+def in_current_context(fn):
+    """
+    Return: callable running fn in a copy of the caller's context, so the spans fn opens in a worker thread nest
+    under the caller's span; make one per task, a context is entered by one thread at a time
+    """
+    return functools.partial(contextvars.copy_context().run, fn)
+
+
+class Span:
+    """
+    One timed step of a query, e.g. an executor, a metadata lookup, a file read or an API call, with its child steps.
+    bytes_read is process-wide, so it includes reads of steps running concurrently in other threads.
+    """
+
+    def __init__(self, name, category, attrs):
+        self.name = name
+        self.category = category  # e.g., "executor", "metadata", "io", "compute", "assembly"
+        self.attrs = attrs
+        self.events = []
+        self.children = []
+        self.thread_id = threading.get_ident()
+        self.start = time.perf_counter()
+        self.end = None
+        self._bytes_start = read_bytes()
+        self._lock = threading.Lock()
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def add(self, name, value=1):
+        with self._lock:
+            self.attrs[name] = self.attrs.get(name, 0) + value
+
+    def event(self, message):
+        with self._lock:
+            self.events.append((time.perf_counter(), message))
+
+    def _add_child(self, span):
+        with self._lock:
+            self.children.append(span)
+
+    def finish(self):
+        self.end = time.perf_counter()
+        if self._bytes_start is not None:
+            self.attrs["bytes_read"] = read_bytes() - self._bytes_start
+
+    @property
+    def duration(self):
+        return (self.end if self.end is not None else time.perf_counter()) - self.start
+
+    def walk(self):
+        yield self
+        for child in self.children:
+            yield from child.walk()
+
+    def to_dict(self, origin=None):
+        """
+        Return: the span tree as a JSON-serializable dict, times in milliseconds from the root's start
+        """
+        origin = self.start if origin is None else origin
+        return {
+            "name": self.name,
+            "category": self.category,
+            "start_ms": (self.start - origin) * 1e3,
+            "duration_ms": self.duration * 1e3,
+            "thread": self.thread_id,
+            "attrs": self.attrs,
+            "events": [{"time_ms": (t - origin) * 1e3, "message": message} for t, message in self.events],
+            "children": [child.to_dict(origin) for child in self.children],
+        }
+
+    def to_chrome_trace(self):
+        """
+        Return: dict in the Chrome trace event format, for chrome://tracing or Perfetto
+        """
+        events = []
+        pid = os.getpid()
+        for span in self.walk():
+            events.append(
+                {
+                    "name": span.name,
+                    "cat": span.category,
+                    "ph": "X",
+                    "ts": (span.start - self.start) * 1e6,
+                    "dur": span.duration * 1e6,
+                    "pid": pid,
+                    "tid": span.thread_id,
+                    "args": span.attrs,
+                }
+            )
+            for t, message in span.events:
+                events.append(
+                    {
+                        "name": message,
+                        "cat": span.category,
+                        "ph": "i",
+                        "s": "t",
+                        "ts": (t - self.start) * 1e6,
+                        "pid": pid,
+                        "tid": span.thread_id,
+                    }
+                )
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def save_json(self, path):
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=2, default=str)
+
+    def save_chrome_trace(self, path):
+        with open(path, "w") as f:
+            json.dump(self.to_chrome_trace(), f, default=str)
+
+
+class _NullSpan:
+    def set(self, **attrs):
+        pass
+
+    def add(self, name, value=1):
+        pass
+
+    def event(self, message):
+        pass
+
+
+_null_span = _NullSpan()
+
+
+class Tracer:
+    """
+    Records the spans of queries as trees; an executor keeps the tree of its own span, see QueryExecutor.trace.
+    Disabled by default, spans are then free.
+    quiet silences the progress messages executors print; they are still recorded as span events when tracing.
+    """
+
+    def __init__(self, enabled=False, quiet=False):
+        self.enabled = enabled
+        self.quiet = quiet
+
+    def configure(self, **kwargs):
+        for name, value in kwargs.items():
+            if not hasattr(self, name) or name.startswith("_"):
+                raise ValueError(f"Invalid tracer option: {name}")
+            setattr(self, name, value)
+
+    @contextlib.contextmanager
+    def span(self, name, category="executor", **attrs):
+        if not self.enabled:
+            yield _null_span
+            return
+        parent = _current_span.get()
+        span = Span(name, category, attrs)
+        if parent is not None:
+            parent._add_child(span)
+        token = _current_span.set(span)
+        try:
+            yield span
+        finally:
+            span.finish()
+            _current_span.reset(token)
+
+    def current(self):
+        """
+        Return: the innermost open span of this context, a no-op span when there is none
+        """
+        span = _current_span.get() if self.enabled else None
+        return _null_span if span is None else span
+
+    def log(self, *args):
+        if self.enabled:
+            self.current().event(" ".join(str(arg) for arg in args))
+        if not self.quiet:
+            print(*args)
+
+
+tracer = Tracer()
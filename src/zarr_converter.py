@@ -0,0 +1,78 @@
+import argparse
+import os
+
+import xarray as xr
+
+from .metadata import ZARR_LAYOUTS, load_metadata, to_catalog_zarr
+from .utils.dataset_pool import file_engine
+from .utils.tracing import tracer
+
+
+def convert_file(file_path, output_dir, layout="balanced"):
+    """
+    Copy one NetCDF catalog file into a Zarr group, reading and writing one Zarr chunk per Dask task.
+    Return: path of the Zarr group
+    """
+    ds = xr.open_dataset(file_path, engine="netcdf4", chunks=ZARR_LAYOUTS[layout])
+    if "number" in ds.coords:
+        ds = ds.drop_vars("number")
+    if "expver" in ds.coords:
+        ds = ds.drop_vars("expver")
+    store_path = os.path.join(output_dir, f"{os.path.splitext(os.path.basename(file_path))[0]}.zarr")
+    to_catalog_zarr(ds, store_path, layout)
+    ds.close()
+    return store_path
+
+
+def convert_catalog(metadata, output_dir, variables=None, temporal_resolutions=None, layout="balanced", repoint=True):
+    """
+    Convert the catalog's NetCDF files to Zarr groups under output_dir/variable.
+    metadata: metadata file path or Metadata instance
+    Return: {NetCDF file path: Zarr group path}, the catalog rows are pointed at the groups when repoint is True
+    """
+    if isinstance(metadata, str):
+        metadata = load_metadata(metadata)
+    if layout not in ZARR_LAYOUTS:
+        raise ValueError("Invalid zarr layout")
+    df = metadata.df_meta
+    if variables is not None:
+        df = df[df["variable"].isin(variables)]
+    if temporal_resolutions is not None:
+        df = df[df["temporal_resolution"].isin(temporal_resolutions)]
+    file_paths = {}
+    for row in df.itertuples():
+        if file_engine(row.file_path) == "zarr" or row.file_path in file_paths:
+            continue
+        tracer.log("zarr:", row.file_path)
+        variable_dir = os.path.join(output_dir, row.variable)
+        os.makedirs(variable_dir, exist_ok=True)
+        file_paths[row.file_path] = convert_file(row.file_path, variable_dir, layout)
+    if repoint and file_paths:
+        metadata.repoint(file_paths)
+    return file_paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert NetCDF catalog files to chunked Zarr groups")
+    parser.add_argument("metadata", help="metadata.csv path")
+    parser.add_argument("output_dir", help="directory to write Zarr groups into")
+    parser.add_argument("--variable", action="append", help="only convert this variable (repeatable)")
+    parser.add_argument("--temporal-resolution", action="append", help="e.g. hour, day, month, year (repeatable)")
+    parser.add_argument("--layout", default="balanced", choices=sorted(ZARR_LAYOUTS), help="on-disk chunk layout")
+    parser.add_argument("--no-repoint", action="store_true", help="write Zarr groups without changing the catalog")
+    args = parser.parse_args()
+
+    file_paths = convert_catalog(
+        args.metadata,
+        args.output_dir,
+        variables=args.variable,
+        temporal_resolutions=args.temporal_resolution,
+        layout=args.layout,
+        repoint=not args.no_repoint,
+    )
+    for file_path, store_path in file_paths.items():
+        print(f"{file_path} -> {store_path}")
+
+
+if __name__ == "__main__":
+    main()
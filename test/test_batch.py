@@ -0,0 +1,59 @@
+import unittest
+import xarray as xr
+
+import sys
+import os
+
+# Add the 'src' directory to the Python path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+
+from query_batch import BatchExecutor
+from query_executor_heatmap import HeatmapExecutor
+from query_executor_timeseries import TimeseriesExecutor
+
+variable = "2m_temperature"
+start_datetime = "2021-03-01 05:00:00"
+end_datetime = "2021-05-20 17:00:00"
+# overlapping regions of Greenland
+regions = [
+    dict(min_lat=60, max_lat=75, min_lon=-55, max_lon=-35),
+    dict(min_lat=70, max_lat=85, min_lon=-45, max_lon=-20),
+    dict(min_lat=65, max_lat=80, min_lon=-50, max_lon=-30),
+]
+
+
+class TestBatch(unittest.TestCase):
+
+    def _gen_queries(self):
+        queries = []
+        for region in regions:
+            queries.append(
+                TimeseriesExecutor(
+                    variable=variable,
+                    start_datetime=start_datetime,
+                    end_datetime=end_datetime,
+                    temporal_resolution="hour",
+                    temporal_aggregation=None,
+                    time_series_aggregation_method="mean",
+                    spatial_resolution=0.25,
+                    **region,
+                )
+            )
+            queries.append(
+                HeatmapExecutor(
+                    variable=variable,
+                    start_datetime=start_datetime,
+                    end_datetime=end_datetime,
+                    heatmap_aggregation_method="max",
+                    **region,
+                )
+            )
+        return queries
+
+    def test_batch_matches_single_queries(self):
+        batch = BatchExecutor(self._gen_queries())
+        reads = batch.plan()
+        self.assertLess(len(reads), sum(len(read.members) for read in reads))
+        results = batch.compute()
+        for query, res in zip(self._gen_queries(), results):
+            xr.testing.assert_allclose(query.compute(), res)
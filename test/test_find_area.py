@@ -1,3 +1,5 @@
+import shutil
+import tempfile
 import unittest
 import xarray as xr
 
@@ -7,7 +9,9 @@ import os
 # Add the 'src' directory to the Python path
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
 
+from benchmark import gen_synthetic_catalog
 from query_executor_find_area import FindAreaExecutor
+from query_executor_heatmap import HeatmapExecutor
 
 variable = "2m_temperature"
 # Greenland
@@ -85,3 +89,45 @@ class TestFindArea(unittest.TestCase):
         filter_predicate = ">"
         filter_value = 263
         self._test_suite(start_datetime, end_datetime, heatmap_aggregation_method, filter_predicate, filter_value)
+
+    def test_pyramid_matches_baseline(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        extent = dict(min_lat=70, max_lat=73, min_lon=-40, max_lon=-37)
+        metadata_path = gen_synthetic_catalog(
+            tmp_dir,
+            years=(2020,),
+            extent=tuple(extent.values()),
+            temporal_resolutions=("day", "month"),
+            spatial_resolutions=(0.25, 1.0),
+        )
+        # whole months and days with residual hours at both ends
+        start_datetime = "2020-02-27 10:00:00"
+        end_datetime = "2020-04-02 20:00:00"
+        for spatial_resolution in [0.25, 1.0]:
+            for heatmap_aggregation_method in ["mean", "max", "min"]:
+                spatial_aggregation = None if spatial_resolution == 0.25 else heatmap_aggregation_method
+                hm = HeatmapExecutor(
+                    variable,
+                    start_datetime,
+                    end_datetime,
+                    heatmap_aggregation_method=heatmap_aggregation_method,
+                    spatial_resolution=spatial_resolution,
+                    spatial_aggregation=spatial_aggregation,
+                    metadata=metadata_path,
+                    **extent,
+                ).execute()
+                # the median leaves cells on both sides and cells the bounds do not decide
+                qe = FindAreaExecutor(
+                    variable=variable,
+                    start_datetime=start_datetime,
+                    end_datetime=end_datetime,
+                    heatmap_aggregation_method=heatmap_aggregation_method,
+                    filter_predicate=">",
+                    filter_value=float(hm.t2m.compute().median()),
+                    spatial_resolution=spatial_resolution,
+                    spatial_aggregation=spatial_aggregation,
+                    metadata=metadata_path,
+                    **extent,
+                )
+                xr.testing.assert_equal(qe.execute(), qe.execute_baseline())
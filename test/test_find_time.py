@@ -1,4 +1,8 @@
+import shutil
+import tempfile
 import unittest
+import numpy as np
+import pandas as pd
 import xarray as xr
 
 import sys
@@ -8,6 +12,9 @@ import os
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
 
 from query_executor_find_time import FindTimeExecutor
+from query_executor_get_raster import temporal_resample
+from query_executor_timeseries import TimeseriesExecutor
+from metadata import catalog_row, to_catalog_netcdf
 
 variable = "2m_temperature"
 # Greenland
@@ -74,3 +81,61 @@ class TestFindTime(unittest.TestCase):
         filter_predicate = ">"
         filter_value = 363
         self._test_suite(start_datetime, end_datetime, time_resolution, time_agg_method, filter_predicate, filter_value)
+
+    def _gen_rough_catalog(self, tmp_dir):
+        """
+        Return: metadata path of an hourly summer over a rough 0.25 degree field, and its day / month min / max;
+        coarse cells whose windows are shifted by a grid point differ by up to a few K
+        """
+        valid_time = pd.date_range("2020-06-01 00:00", "2020-08-31 23:00", freq="h")
+        lat = np.arange(74, 69.875, -0.25)
+        lon = np.arange(-30, -23.875, 0.25)
+        rng = np.random.default_rng(0)
+        field = rng.normal(0, 4, (len(lat), len(lon)))
+        daily = 3 * np.sin(2 * np.pi * np.arange(len(valid_time)) / 24)[:, None, None]
+        drift = rng.normal(0, 0.5, (len(valid_time), 1, 1))
+        ds = xr.Dataset(
+            {"t2m": (["valid_time", "latitude", "longitude"], (265 + field + daily + drift).astype("float32"))},
+            coords=dict(valid_time=valid_time, latitude=lat, longitude=lon),
+        )
+        start, end = valid_time[0], valid_time[-1]
+        rows = []
+        levels = [("hour", None)] + [(res, agg) for res in ("day", "month") for agg in ("min", "max")]
+        for temporal_resolution, temporal_aggregation in levels:
+            file_path = os.path.join(tmp_dir, f"{temporal_resolution}-{temporal_aggregation}.nc")
+            ds_level = temporal_resample(ds, temporal_resolution, temporal_aggregation)
+            to_catalog_netcdf(ds_level, file_path)
+            rows.append(
+                catalog_row(
+                    ds_level, variable, start, end, temporal_resolution, temporal_aggregation, 0.25, None, file_path
+                )
+            )
+        metadata_path = os.path.join(tmp_dir, "metadata.csv")
+        pd.DataFrame(rows).to_csv(metadata_path, index=False)
+        return metadata_path
+
+    def test_coarse_bounds_match_baseline(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        metadata_path = self._gen_rough_catalog(tmp_dir)
+        query = dict(
+            variable=variable,
+            start_datetime="2020-06-01 00:00:00",
+            end_datetime="2020-08-31 23:00:00",
+            min_lat=70.25,
+            max_lat=73.0,
+            min_lon=-29.75,
+            max_lon=-27.0,
+            temporal_resolution="hour",
+            temporal_aggregation=None,
+            spatial_resolution=1.0,
+            spatial_aggregation="mean",
+            metadata=metadata_path,
+        )
+        for time_agg in ("mean", "max"):
+            ts = TimeseriesExecutor(**query, time_series_aggregation_method=time_agg).compute()
+            for filter_value in np.quantile(ts.t2m.values, [0.1, 0.3, 0.5, 0.7, 0.9]):
+                qe = FindTimeExecutor(
+                    **query, time_series_aggregation_method=time_agg, filter_predicate=">", filter_value=filter_value
+                )
+                xr.testing.assert_equal(qe.execute().compute(), qe.execute_baseline().compute())
@@ -1,4 +1,10 @@
+import asyncio
+import shutil
+import tempfile
+import time
 import unittest
+import numpy as np
+import pandas as pd
 import xarray as xr
 
 import sys
@@ -7,7 +13,12 @@ import os
 # Add the 'src' directory to the Python path
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
 
-from query_executor_get_raster import GetRasterExecutor
+from benchmark import gen_synthetic_catalog
+from query_executor_get_raster import GetRasterExecutor, assemble_parts
+from metadata import Metadata
+from utils.cds_downloader import CDSDownloader
+from utils.chunk_policy import ChunkPolicy
+from utils.raster_cache import raster_cache
 
 variable = "2m_temperature"
 # Greenland
@@ -17,6 +28,50 @@ min_lon = -70
 max_lon = -10
 
 
+class StalledClient:
+    calls = []
+
+    def retrieve(self, dataset, request):
+        StalledClient.calls.append(request)
+        time.sleep(1)
+        raise RuntimeError("CDS API unavailable")
+
+
+class FailingClient:
+    calls = []
+
+    def retrieve(self, dataset, request):
+        FailingClient.calls.append(request)
+        time.sleep(0.2)
+        raise RuntimeError("CDS API request rejected")
+
+
+class ConstantClient:
+    """
+    Writes every requested hour and grid point of the area with the value 1.0
+    """
+
+    class Result:
+        def __init__(self, request):
+            self.request = request
+
+        def download(self, file_path):
+            r = self.request
+            days = pd.to_datetime([f"{y}-{m}-{d}" for y in r["year"] for m in r["month"] for d in r["day"]])
+            hours = pd.to_timedelta([int(t[:2]) for t in r["time"]], unit="h")
+            valid_time = pd.DatetimeIndex(sorted(day + hour for day in days for hour in hours))
+            north, west, south, east = r["area"]
+            lat = np.arange(north, south - 0.125, -0.25)
+            lon = np.arange(west, east + 0.125, 0.25)
+            xr.Dataset(
+                {"t2m": (["valid_time", "latitude", "longitude"], np.ones((len(valid_time), len(lat), len(lon))))},
+                coords=dict(valid_time=valid_time, latitude=lat, longitude=lon),
+            ).to_netcdf(file_path)
+
+    def retrieve(self, dataset, request):
+        return ConstantClient.Result(request)
+
+
 class TestGetRaster(unittest.TestCase):
 
     def _test_suite(self, start_dt, end_dt, time_res, time_agg):
@@ -79,3 +134,427 @@ class TestGetRaster(unittest.TestCase):
         self.assertGreater(res.valid_time.size, 0)
         self.assertGreater(res.latitude.size, 0)
         self.assertGreater(res.longitude.size, 0)
+
+    def test_derived_spatial_resolution(self):
+        start_datetime = "2021-01-01 00:00:00"
+        end_datetime = "2021-12-31 23:00:00"
+        qe = GetRasterExecutor(
+            variable=variable,
+            start_datetime=start_datetime,
+            end_datetime=end_datetime,
+            temporal_resolution="month",
+            temporal_aggregation="max",
+            spatial_resolution=1.0,
+            spatial_aggregation="max",
+            min_lat=min_lat,
+            max_lat=max_lat,
+            min_lon=min_lon,
+            max_lon=max_lon,
+        )
+        _, derived, api = qe._check_metadata()
+        self.assertGreater(len(derived), 0)
+        self.assertEqual(api, [])
+        res = qe.execute()
+        self.assertEqual(res.valid_time.size, 12)
+        self.assertTrue((abs(res.latitude.diff("latitude")) == 1.0).all())
+
+    def test_api_requests_split_by_month(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        # an empty catalog, every hour of the query is downloaded
+        metadata_path = os.path.join(tmp_dir, "metadata.csv")
+        with open(metadata_path, "w") as f:
+            f.write(
+                "variable,start_datetime,end_datetime,max_lat,min_lat,max_lon,min_lon,temporal_resolution,"
+                "temporal_aggregation,spatial_resolution,spatial_aggregation,file_path\n"
+            )
+        months = {}
+        for split in ("month", "year"):
+            qe = GetRasterExecutor(
+                variable=variable,
+                start_datetime="2023-10-10 10:00:00",
+                end_datetime="2024-02-10 20:00:00",
+                min_lat=84,
+                max_lat=85,
+                min_lon=-11,
+                max_lon=-10,
+                metadata=metadata_path,
+                downloader=CDSDownloader(download_dir=tmp_dir, split=split),
+            )
+            _, _, api = qe._check_metadata()
+            months[split] = [request["year"] + request["month"] for _, request in api]
+        self.assertTrue(all(len(request) == 2 for request in months["month"]))
+        self.assertEqual(
+            sorted(set(map(tuple, months["month"]))),
+            [("2023", "10"), ("2023", "11"), ("2023", "12"), ("2024", "01"), ("2024", "02")],
+        )
+        # whole months of a year are joined into one request
+        self.assertIn(["2023", "11", "12"], months["year"])
+
+    def test_api_requests_exact(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        metadata_path = os.path.join(tmp_dir, "metadata.csv")
+        with open(metadata_path, "w") as f:
+            f.write(
+                "variable,start_datetime,end_datetime,max_lat,min_lat,max_lon,min_lon,temporal_resolution,"
+                "temporal_aggregation,spatial_resolution,spatial_aggregation,file_path\n"
+            )
+        qe = GetRasterExecutor(
+            variable=variable,
+            start_datetime="2023-10-10 10:00:00",
+            end_datetime="2024-02-10 20:00:00",
+            min_lat=84,
+            max_lat=85,
+            min_lon=-11,
+            max_lon=-10,
+            metadata=metadata_path,
+        )
+        _, _, api = qe._check_metadata()
+        months = [request["month"] for _, request in api]
+        self.assertEqual(months, [["10"], ["10"], ["11"], ["12"], ["01"], ["02"], ["02"]])
+        self.assertEqual(api[0][1]["day"], ["10"])
+        self.assertEqual(api[0][1]["time"][0], "10:00")
+        self.assertEqual(api[-1][1]["day"], ["10"])
+        self.assertEqual(api[-1][1]["time"][-1], "20:00")
+        self.assertEqual(api[0][1]["area"], [85, -11, 84, -10])
+
+    def test_download_labels_match_local(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        valid_time = pd.date_range("2021-01-01 00:00", "2021-01-04 23:00", freq="h")
+        lat = np.arange(85, 83.875, -0.25)
+        lon = np.arange(-11, -9.875, 0.25)
+        local_path = os.path.join(tmp_dir, "local.nc")
+        xr.Dataset(
+            {"t2m": (["valid_time", "latitude", "longitude"], np.full((len(valid_time), len(lat), len(lon)), 2.0))},
+            coords=dict(valid_time=valid_time, latitude=lat, longitude=lon),
+        ).to_netcdf(local_path)
+        header = (
+            "variable,start_datetime,end_datetime,max_lat,min_lat,max_lon,min_lon,temporal_resolution,"
+            "temporal_aggregation,spatial_resolution,spatial_aggregation,file_path\n"
+        )
+        local_row = f"{variable},2021-01-01 00:00,2021-01-04 23:00,85,84,-10,-11,hour,none,0.25,none,{local_path}\n"
+        labels = []
+        # downloaded, then derived from the local file
+        for rows in ("", local_row):
+            metadata_path = os.path.join(tmp_dir, f"metadata-{len(labels)}.csv")
+            with open(metadata_path, "w") as f:
+                f.write(header + rows)
+            # the query starts mid-day, its first partial day is not part of the result
+            qe = GetRasterExecutor(
+                variable=variable,
+                start_datetime="2021-01-01 05:00:00",
+                end_datetime="2021-01-04 23:00:00",
+                min_lat=84,
+                max_lat=85,
+                min_lon=-11,
+                max_lon=-10,
+                temporal_resolution="day",
+                temporal_aggregation="max",
+                metadata=metadata_path,
+                downloader=CDSDownloader(client_factory=ConstantClient, download_dir=tmp_dir),
+            )
+            labels.append(qe.execute().indexes["valid_time"].tolist())
+        self.assertEqual(labels[0], labels[1])
+        self.assertEqual(labels[0], list(pd.date_range("2021-01-02", "2021-01-04", freq="D")))
+
+    def test_chunked_by_month(self):
+        qe = GetRasterExecutor(
+            variable=variable,
+            start_datetime="2021-01-01 00:00:00",
+            end_datetime="2021-03-31 23:00:00",
+            min_lat=min_lat,
+            max_lat=max_lat,
+            min_lon=min_lon,
+            max_lon=max_lon,
+        )
+        res = qe.execute()
+        da = next(iter(res.data_vars.values()))
+        self.assertEqual(da.chunksizes["valid_time"], (744, 672, 744))
+
+    def test_chunk_policy_tiles(self):
+        valid_time = pd.date_range("2021-01-01 00:00", "2021-01-31 23:00", freq="h")
+        ds = xr.Dataset(
+            {"t2m": (["valid_time", "latitude", "longitude"], np.zeros((valid_time.size, 40, 40), dtype="float32"))},
+            coords=dict(valid_time=valid_time, latitude=np.arange(40) * -0.25, longitude=np.arange(40) * 0.25),
+        )
+        # None is one chunk, max_chunk_bytes only shrinks tiles that are set
+        chunks = ChunkPolicy(latitude=None, longitude=None, max_chunk_bytes=2**20).chunks(ds)
+        self.assertEqual((chunks["latitude"], chunks["longitude"]), (-1, -1))
+        chunks = ChunkPolicy(latitude=30, longitude=30, max_chunk_bytes=2**20).chunks(ds)
+        self.assertEqual((chunks["latitude"], chunks["longitude"]), (18, 18))
+
+    def test_assemble_overlapping_files(self):
+        def part(start, periods, value):
+            return xr.Dataset(
+                data_vars={"t2m": (["valid_time", "latitude", "longitude"], np.full((periods, 2, 2), value))},
+                coords=dict(
+                    valid_time=pd.date_range(start, periods=periods, freq="h"),
+                    latitude=[85.0, 84.75],
+                    longitude=[-11.0, -10.75],
+                ),
+            )
+
+        res = assemble_parts([part("2021-01-01 06:00", 6, 2.0), part("2021-01-01 00:00", 8, 1.0)])
+        self.assertEqual(res.valid_time.size, 12)
+        self.assertTrue(res.indexes["valid_time"].is_monotonic_increasing)
+        self.assertEqual(float(res.t2m.isel(valid_time=7).max()), 1.0)
+        self.assertEqual(float(res.t2m.isel(valid_time=8).max()), 2.0)
+
+    def test_tile_index(self):
+        rows = [
+            "variable,start_datetime,end_datetime,max_lat,min_lat,max_lon,min_lon,temporal_resolution,"
+            "temporal_aggregation,spatial_resolution,spatial_aggregation,file_path"
+        ]
+        for south in range(-90, 90, 10):
+            for west in range(-180, 180, 10):
+                rows.append(
+                    f"{variable},2021-01-01 00:00,2021-12-31 23:00,{south + 9.75},{south},{west + 9.75},{west},"
+                    f"hour,none,0.25,none,tile-{south}-{west}.nc"
+                )
+        with tempfile.NamedTemporaryFile("w", suffix=".csv", delete=False) as f:
+            f.write("\n".join(rows) + "\n")
+        self.addCleanup(os.remove, f.name)
+        metadata = Metadata(f.name)
+        df_overlap, leftover = metadata.query_get_overlap_and_leftover(
+            variable, "2021-06-01 00:00", "2021-06-30 23:00", 71, 78, -40, -25, "hour", None, 0.25, None
+        )
+        self.assertEqual(sorted(df_overlap["file_path"]), ["tile-70--30.nc", "tile-70--40.nc"])
+        self.assertEqual(leftover, [])
+
+    def test_derive_from_tiles(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        valid_time = pd.date_range("2021-01-01 00:00", "2021-01-01 23:00", freq="h")
+        lon = np.arange(-12, -7.75, 0.25)
+        rows = []
+        for north, value in ((86, 1.0), (84, 3.0)):
+            lat = np.arange(north, north - 1.875, -0.25)
+            values = np.full((valid_time.size, lat.size, lon.size), value)
+            file_path = os.path.join(tmp_dir, f"tile-{north}.nc")
+            xr.Dataset(
+                {"t2m": (["valid_time", "latitude", "longitude"], values)},
+                coords=dict(valid_time=valid_time, latitude=lat, longitude=lon),
+            ).to_netcdf(file_path)
+            rows.append(
+                f"{variable},2021-01-01 00:00,2021-01-01 23:00,{north},{north - 1.75},-8,-12,hour,none,0.25,none,"
+                f"{file_path}"
+            )
+        metadata_path = os.path.join(tmp_dir, "metadata.csv")
+        with open(metadata_path, "w") as f:
+            f.write(
+                "variable,start_datetime,end_datetime,max_lat,min_lat,max_lon,min_lon,temporal_resolution,"
+                "temporal_aggregation,spatial_resolution,spatial_aggregation,file_path\n" + "\n".join(rows) + "\n"
+            )
+        qe = GetRasterExecutor(
+            variable=variable,
+            start_datetime="2021-01-01 00:00:00",
+            end_datetime="2021-01-01 23:00:00",
+            min_lat=83,
+            max_lat=85,
+            min_lon=-11,
+            max_lon=-9,
+            spatial_resolution=1.0,
+            spatial_aggregation="mean",
+            metadata=metadata_path,
+        )
+        _, derived, api = qe._check_metadata()
+        self.assertEqual(len(derived[0][2]), 2)
+        self.assertEqual(api, [])
+        res = qe.execute().compute()
+        # the northern coarse cell straddles both tiles
+        self.assertEqual(res.latitude.values.tolist(), [84.375, 83.375])
+        self.assertTrue((res.t2m.isel(latitude=0) == (3 * 1.0 + 3.0) / 4).all())
+        self.assertTrue((res.t2m.isel(latitude=1) == 3.0).all())
+
+    def test_derive_partly_local(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        valid_time = pd.date_range("2021-01-02 00:00", "2021-01-03 23:00", freq="h")
+        lat = np.arange(85, 83.875, -0.25)
+        lon = np.arange(-11, -9.875, 0.25)
+        local_path = os.path.join(tmp_dir, "local.nc")
+        xr.Dataset(
+            {"t2m": (["valid_time", "latitude", "longitude"], np.full((len(valid_time), len(lat), len(lon)), 2.0))},
+            coords=dict(valid_time=valid_time, latitude=lat, longitude=lon),
+        ).to_netcdf(local_path)
+        metadata_path = os.path.join(tmp_dir, "metadata.csv")
+        with open(metadata_path, "w") as f:
+            f.write(
+                "variable,start_datetime,end_datetime,max_lat,min_lat,max_lon,min_lon,temporal_resolution,"
+                "temporal_aggregation,spatial_resolution,spatial_aggregation,file_path\n"
+                f"{variable},2021-01-02 00:00,2021-01-03 23:00,85,84,-10,-11,hour,none,0.25,none,{local_path}\n"
+            )
+        qe = GetRasterExecutor(
+            variable=variable,
+            start_datetime="2021-01-01 00:00:00",
+            end_datetime="2021-01-04 23:00:00",
+            min_lat=84,
+            max_lat=85,
+            min_lon=-11,
+            max_lon=-10,
+            temporal_resolution="day",
+            temporal_aggregation="max",
+            metadata=metadata_path,
+            downloader=CDSDownloader(client_factory=ConstantClient, download_dir=tmp_dir),
+        )
+        _, derived, api = qe._check_metadata()
+        # the local days are derived, only the days around them are downloaded
+        self.assertEqual([(box.start_datetime.day, box.end_datetime.day) for box, _, _ in derived], [(2, 3)])
+        self.assertEqual([request["day"] for _, request in api], [["01"], ["04"]])
+        res = qe.execute().compute()
+        series = res.t2m.max(dim=["latitude", "longitude"])
+        self.assertEqual(series.values.tolist(), [1.0, 2.0, 2.0, 1.0])
+
+    def test_derived_matches_pyramid(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        extent = dict(min_lat=70, max_lat=71, min_lon=-40, max_lon=-39)
+        catalog = dict(years=(2020, 2021), extent=tuple(extent.values()), spatial_resolutions=(0.25,))
+        pyramid_path = gen_synthetic_catalog(os.path.join(tmp_dir, "pyramid"), **catalog)
+        raw_path = gen_synthetic_catalog(os.path.join(tmp_dir, "raw"), temporal_resolutions=(), **catalog)
+        # edge steps only partly inside the query window aggregate their whole period, as the pyramid files do
+        for temporal_resolution, aggregation, spatial_resolution in [
+            ("day", "min", 0.25),
+            ("month", "min", 0.25),
+            ("year", "mean", 0.25),
+            ("month", "max", 1.0),
+        ]:
+            res = []
+            for metadata_path in (pyramid_path, raw_path):
+                qe = GetRasterExecutor(
+                    variable=variable,
+                    start_datetime="2020-02-03 05:00:00",
+                    end_datetime="2021-03-20 17:00:00",
+                    temporal_resolution=temporal_resolution,
+                    temporal_aggregation=aggregation,
+                    spatial_resolution=spatial_resolution,
+                    spatial_aggregation=None if spatial_resolution == 0.25 else aggregation,
+                    metadata=metadata_path,
+                    **extent,
+                )
+                res.append(qe.execute().compute())
+            xr.testing.assert_allclose(res[0], res[1])
+
+    def test_execute_async_timeout(self):
+        download_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, download_dir)
+        downloader = CDSDownloader(
+            client_factory=StalledClient, download_dir=download_dir, max_workers=2, retry_wait=10
+        )
+        qe = GetRasterExecutor(
+            variable=variable,
+            start_datetime="2024-01-01 00:00:00",
+            end_datetime="2024-06-30 23:00:00",
+            min_lat=84,
+            max_lat=85,
+            min_lon=-11,
+            max_lon=-10,
+            downloader=downloader,
+        )
+        start = time.perf_counter()
+        with self.assertRaises(TimeoutError):
+            asyncio.run(qe.execute_async(timeout=0.5))
+        self.assertLess(time.perf_counter() - start, 2)
+        # the two calls in flight fail once, then neither the retry waits nor the queued months start
+        time.sleep(2)
+        self.assertEqual(len(StalledClient.calls), 2)
+
+    def test_download_failure_drops_queued_requests(self):
+        download_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, download_dir)
+        downloader = CDSDownloader(client_factory=FailingClient, download_dir=download_dir, max_workers=2, retries=0)
+        api_calls = [("reanalysis-era5-single-levels", {"month": [f"{month:02d}"]}) for month in range(1, 13)]
+        start = time.perf_counter()
+        with self.assertRaises(RuntimeError):
+            list(downloader.download_all(api_calls))
+        # the first failure is raised without waiting for the queued months
+        self.assertLess(time.perf_counter() - start, 1)
+        self.assertLessEqual(len(FailingClient.calls), 4)
+
+    def test_local_between_downloads(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        valid_time = pd.date_range("2021-01-02 00:00", "2021-01-03 23:00", freq="h")
+        lat = np.arange(85, 83.875, -0.25)
+        lon = np.arange(-11, -9.875, 0.25)
+        local_path = os.path.join(tmp_dir, "local.nc")
+        xr.Dataset(
+            {"t2m": (["valid_time", "latitude", "longitude"], np.full((len(valid_time), len(lat), len(lon)), 2.0))},
+            coords=dict(valid_time=valid_time, latitude=lat, longitude=lon),
+        ).to_netcdf(local_path)
+        metadata_path = os.path.join(tmp_dir, "metadata.csv")
+        with open(metadata_path, "w") as f:
+            f.write(
+                "variable,start_datetime,end_datetime,max_lat,min_lat,max_lon,min_lon,temporal_resolution,"
+                "temporal_aggregation,spatial_resolution,spatial_aggregation,file_path\n"
+                f"{variable},2021-01-02 00:00,2021-01-03 23:00,85,84,-10,-11,hour,none,0.25,none,{local_path}\n"
+            )
+        qe = GetRasterExecutor(
+            variable=variable,
+            start_datetime="2021-01-01 20:00:00",
+            end_datetime="2021-01-04 03:00:00",
+            min_lat=84,
+            max_lat=85,
+            min_lon=-11,
+            max_lon=-10,
+            metadata=metadata_path,
+            downloader=CDSDownloader(client_factory=ConstantClient, download_dir=tmp_dir),
+        )
+        res = qe.execute().compute()
+        self.assertEqual(res.valid_time.size, 4 + 48 + 4)
+        series = res.t2m.max(dim=["latitude", "longitude"])
+        self.assertTrue((series.sel(valid_time=valid_time) == 2.0).all())
+        self.assertEqual(float(series.sum()), 8 * 1.0 + 48 * 2.0)
+
+    def test_raster_cache(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        local_path = os.path.join(tmp_dir, "local.nc")
+
+        def write_local(value):
+            valid_time = pd.date_range("2021-01-01 00:00", "2021-01-01 23:00", freq="h")
+            lat = np.arange(85, 83.875, -0.25)
+            lon = np.arange(-11, -9.875, 0.25)
+            values = np.full((valid_time.size, lat.size, lon.size), value)
+            tmp_path = os.path.join(tmp_dir, "local.tmp.nc")
+            xr.Dataset(
+                {"t2m": (["valid_time", "latitude", "longitude"], values)},
+                coords=dict(valid_time=valid_time, latitude=lat, longitude=lon),
+            ).to_netcdf(tmp_path)
+            os.replace(tmp_path, local_path)
+
+        write_local(1.0)
+        metadata_path = os.path.join(tmp_dir, "metadata.csv")
+        with open(metadata_path, "w") as f:
+            f.write(
+                "variable,start_datetime,end_datetime,max_lat,min_lat,max_lon,min_lon,temporal_resolution,"
+                "temporal_aggregation,spatial_resolution,spatial_aggregation,file_path\n"
+                f"{variable},2021-01-01 00:00,2021-01-01 23:00,85,84,-10,-11,hour,none,0.25,none,{local_path}\n"
+            )
+        qe = GetRasterExecutor(
+            variable=variable,
+            start_datetime="2021-01-01 00:00:00",
+            end_datetime="2021-01-01 23:00:00",
+            min_lat=84,
+            max_lat=85,
+            min_lon=-11,
+            max_lon=-10,
+            metadata=metadata_path,
+        )
+        # off by default, execute() stays lazy
+        self.assertIsNotNone(qe.execute().t2m.chunks)
+
+        raster_cache.configure(enabled=True)
+        self.addCleanup(raster_cache.clear)
+        self.addCleanup(raster_cache.configure, enabled=False)
+        res = qe.execute()
+        self.assertIsNone(res.t2m.chunks)
+        # results do not share buffers with the cache
+        res.t2m.values[:] = 0
+        self.assertEqual(float(qe.execute().t2m.min()), 1.0)
+        # a rewritten file misses
+        time.sleep(0.01)
+        write_local(2.0)
+        self.assertEqual(float(qe.execute().t2m.min()), 2.0)
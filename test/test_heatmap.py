@@ -1,4 +1,5 @@
 import unittest
+import pandas as pd
 import xarray as xr
 
 import sys
@@ -8,6 +9,7 @@ import os
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
 
 from query_executor_heatmap import HeatmapExecutor
+from utils.tracing import tracer
 
 variable = "2m_temperature"
 # Greenland
@@ -71,3 +73,47 @@ class TestHeatmap(unittest.TestCase):
         end_datetime = "2023-12-31 20:00:00"
         heatmap_aggregation_method = "min"
         self._test_suite(start_datetime, end_datetime, heatmap_aggregation_method)
+
+    def test_plan_covers_range(self):
+        qe = HeatmapExecutor(
+            variable=variable,
+            start_datetime="2020-05-10 10:00:00",
+            end_datetime="2022-10-10 20:00:00",
+            min_lat=min_lat,
+            max_lat=max_lat,
+            min_lon=min_lon,
+            max_lon=max_lon,
+            heatmap_aggregation_method="max",
+        )
+        plan = sorted(qe.plan(), key=lambda step: step.start_datetime)
+        self.assertEqual(str(plan[0].start_datetime), "2020-05-10 10:00:00")
+        self.assertEqual(str(plan[-1].end_datetime), "2022-10-10 20:00:00")
+        for step, next_step in zip(plan, plan[1:]):
+            self.assertEqual(next_step.start_datetime - step.end_datetime, pd.Timedelta(hours=1))
+        self.assertTrue(all(step.local for step in plan))
+        self.assertIn("total", qe.explain())
+
+    def test_trace_nests_sub_executors(self):
+        qe = HeatmapExecutor(
+            variable=variable,
+            start_datetime="2020-05-10 10:00:00",
+            end_datetime="2021-10-10 20:00:00",
+            min_lat=min_lat,
+            max_lat=max_lat,
+            min_lon=min_lon,
+            max_lon=max_lon,
+            heatmap_aggregation_method="mean",
+        )
+        tracer.configure(enabled=True, quiet=True)
+        try:
+            qe.execute()
+        finally:
+            tracer.configure(enabled=False, quiet=False)
+        trace = qe.trace
+        self.assertEqual(trace.name, "HeatmapExecutor")
+        children = [span.name for span in trace.children]
+        self.assertIn("plan", children)
+        self.assertEqual(children.count("GetRasterExecutor"), len(qe.plan()))
+        self.assertTrue(any(span.category == "io" for span in trace.walk()))
+        events = trace.to_chrome_trace()["traceEvents"]
+        self.assertEqual(len([e for e in events if e["ph"] == "X"]), len(list(trace.walk())))
@@ -1,3 +1,5 @@
+import shutil
+import tempfile
 import unittest
 import xarray as xr
 
@@ -8,6 +10,8 @@ import os
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
 
 from query_executor_timeseries import TimeseriesExecutor
+from metadata import load_metadata
+from zarr_converter import convert_catalog
 
 variable = "2m_temperature"
 # Greenland
@@ -78,3 +82,30 @@ class TestTimeseries(unittest.TestCase):
         temporal_resolution = "hour"
         temporal_aggregation = "min"
         self._test_suite(start_datetime, end_datetime, temporal_resolution, temporal_aggregation)
+
+    def test_zarr_catalog_matches_netcdf(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        df_meta = load_metadata("metadata.csv").df_meta
+        zarr_metadata = os.path.join(tmp_dir, "metadata.csv")
+        df_meta[df_meta["temporal_resolution"] == "year"].to_csv(zarr_metadata, index=False)
+        convert_catalog(zarr_metadata, tmp_dir, layout="series")
+        self.assertTrue(load_metadata(zarr_metadata).df_meta["file_path"].str.endswith(".zarr").all())
+
+        results = []
+        for metadata in ("metadata.csv", zarr_metadata):
+            qe = TimeseriesExecutor(
+                variable=variable,
+                start_datetime="2020-01-01 00:00:00",
+                end_datetime="2023-12-31 23:00:00",
+                min_lat=min_lat,
+                max_lat=max_lat,
+                min_lon=min_lon,
+                max_lon=max_lon,
+                temporal_resolution="year",
+                temporal_aggregation="mean",
+                time_series_aggregation_method="mean",
+                metadata=metadata,
+            )
+            results.append(qe.execute())
+        xr.testing.assert_allclose(results[0], results[1])